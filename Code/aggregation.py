@@ -0,0 +1,153 @@
+"""
+Description: Columnar engine for collapsing several rows that share a key (e.g. the share
+classes of one Permco on one datadate) down to a single row.
+
+Every group is computed at once: the frame is sorted once by group and by the sort variable,
+the first row of each group is located from the group boundaries, and sums are done as segment
+reductions with np.bincount. No Python code runs per group.
+
+The operation done on each variable is declared in a dictionary such as AGG_VAR_TYPES in
+write_crsp.py, mapping the name of an aggregation kind to a list of variables. Each kind is
+looked up in AGGREGATORS, so a new kind only needs a new entry there.
+"""
+
+import numpy as np
+import pandas as pd
+from instrumentation import instrumented
+
+MARKET_CAP_VARIABLE = 'Market Cap (Billions, CRSP)'
+PRICE_VARIABLE = 'Price'
+
+
+def segment_sum(values, group_ids, num_groups):
+    """
+    Sums values within each group, treating NaNs as zero
+
+    :param values: a numpy array of floats, sorted so that groups are contiguous
+    :param group_ids: a numpy array with the group number (0 to num_groups - 1) of each row
+    :param num_groups: the total number of groups
+    :return: a numpy array of length num_groups with the sum in each group
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.bincount(group_ids, weights=np.where(np.isnan(values), 0, values), minlength=num_groups)
+
+
+def agg_first(sorted_frame, variable, group_ids, starts):
+    """
+    Takes the value of the first row in each group (the largest share class after sorting)
+    """
+    return sorted_frame[variable].values[starts]
+
+
+def agg_add(sorted_frame, variable, group_ids, starts):
+    """
+    Adds up the variable across the group. Missing values count as zero.
+    """
+    return segment_sum(sorted_frame[variable].values, group_ids, len(starts))
+
+
+def weighted_mean(weight_variable):
+    """
+    Builds an aggregator that averages a variable with weights given by weight_variable.
+    Only rows where the variable is present enter the denominator. If the weights of a
+    group add up to zero (or are missing), the value of the first row is used instead.
+
+    :param weight_variable: the name of the variable used as weights
+    :return: an aggregation function that can be placed in AGGREGATORS
+    """
+    def aggregate(sorted_frame, variable, group_ids, starts):
+        values = sorted_frame[variable].values.astype(np.float64)
+        weights = sorted_frame[weight_variable].values.astype(np.float64)
+        valid = ~np.isnan(values) & ~np.isnan(weights)
+
+        numerator = segment_sum(np.where(valid, values * weights, 0), group_ids, len(starts))
+        denominator = segment_sum(np.where(valid, weights, 0), group_ids, len(starts))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(denominator > 0, numerator / denominator, values[starts])
+
+    return aggregate
+
+
+def first_weighted_sum(weight_variable):
+    """
+    Builds an aggregator that adds up variable * weight_variable across the group and
+    divides by the weight of the first row, e.g. share-class volumes expressed in units
+    of the largest share class. If that weight is missing or not positive, the value of
+    the first row is used instead.
+
+    :param weight_variable: the name of the variable used as weights
+    :return: an aggregation function that can be placed in AGGREGATORS
+    """
+    def aggregate(sorted_frame, variable, group_ids, starts):
+        values = sorted_frame[variable].values.astype(np.float64)
+        weights = sorted_frame[weight_variable].values.astype(np.float64)
+
+        numerator = segment_sum(values * weights, group_ids, len(starts))
+        denominator = weights[starts]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(denominator > 0, numerator / denominator, values[starts])
+
+    return aggregate
+
+
+AGGREGATORS = {'First': agg_first,
+               'Add': agg_add,
+               'Market Cap Weighted Sum': weighted_mean(MARKET_CAP_VARIABLE),
+               'Price Weighted Sum': first_weighted_sum(PRICE_VARIABLE)}
+
+
+@instrumented('aggregation')
+def aggregate_groups(df, agg_var_types, sort_variable, group_list=None, ascending=False):
+    """
+    Collapses every group of df down to one row, using the aggregation declared for each
+    variable in agg_var_types.
+
+    Within a group, rows are ordered by sort_variable (descending by default, missing values
+    last, ties kept in their original order), so 'First' picks the row with the largest value.
+
+    :param df: a pandas dataframe. The group variables may be columns or index levels
+    :param agg_var_types: a dictionary mapping an aggregation kind (a key of AGGREGATORS) to a
+    list of variable names
+    :param sort_variable: the variable used to order the rows within each group
+    :param group_list: a list of variable names to group by. Defaults to the index of df
+    :param ascending: whether to sort sort_variable in ascending order within each group
+    :return: a dataframe indexed by group_list with one row per group and the variables of
+    agg_var_types as columns
+
+    Usage:
+
+    df = pd.DataFrame({'Permco': [1, 1, 2], 'datadate': [0, 0, 0],
+                       'Market Cap (Billions, CRSP)': [1., 3., 2.], 'Return': [0.1, 0.2, 0.3]})
+    ret = aggregate_groups(df.set_index(['Permco', 'datadate']),
+                           {'Add': ['Market Cap (Billions, CRSP)'], 'Market Cap Weighted Sum': ['Return']},
+                           'Market Cap (Billions, CRSP)')
+    assert(np.allclose(ret['Return'].values, [0.175, 0.3]))
+    """
+
+    unknown = set(agg_var_types.keys()) - set(AGGREGATORS.keys())
+    assert len(unknown) == 0, 'Unknown aggregation types: ' + str(sorted(unknown))
+
+    if group_list is None:
+        group_list = list(df.index.names)
+
+    flat = df.reset_index() if any(v in df.index.names for v in group_list) else df
+
+    # Single stable sort by group, then by the sort variable with missing values last
+    group_numbers = flat.groupby(by=group_list, sort=True, dropna=False).ngroup().values
+    sort_values = flat[sort_variable].values.astype(np.float64)
+    sort_key = sort_values if ascending else -sort_values
+    sort_key = np.where(np.isnan(sort_key), np.inf, sort_key)
+    order = np.lexsort((sort_key, group_numbers))
+
+    sorted_frame = flat.iloc[order].reset_index(drop=True)
+    group_ids = group_numbers[order]
+    starts = np.flatnonzero(np.diff(group_ids, prepend=-1))
+
+    ret = sorted_frame.iloc[starts][group_list].reset_index(drop=True)
+    for kind, variables in agg_var_types.items():
+        for v in variables:
+            ret[v] = AGGREGATORS[kind](sorted_frame, v, group_ids, starts)
+
+    return ret.set_index(group_list)
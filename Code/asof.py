@@ -0,0 +1,154 @@
+"""
+Description: As-of merge of the quarterly Compustat fundamentals onto the monthly CRSP panel.
+
+Each Compustat row becomes available at the month end of its Report Date (plus an optional lag),
+or a fixed number of months after datadate when the Report Date is missing. Every CRSP month
+then takes the whole row of the latest fundamentals of the same Permco that were available by
+that month, so nothing is known before it was reported.
+
+The match is found with a single sort and a binary search on a combined Permco-date key.
+asof_positions only returns the row of Compustat matched to each CRSP row, so the columns are
+taken only when asof_merge asks for them, and the forward-filled panel is never built column
+by column.
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+from dates import parse_dates, month_codes, DATE_FORMAT
+
+NO_MATCH = -1
+
+
+def shift_month_ends(dates, months):
+    """
+    :param dates: a DatetimeIndex or datetime Series
+    :param months: a non-negative number of months
+    :return: the month end that is `months` months after the month of each date
+    """
+    dates = dates + MonthEnd(0)
+    return dates + MonthEnd(months) if months > 0 else dates
+
+
+def availability_dates(compustat, report_variable='Report Date', lag_months=0, fallback_lag_months=4,
+                       date_format=DATE_FORMAT):
+    """
+    Computes the month end at which each row of Compustat becomes public
+
+    :param compustat: a dataframe with datadate as a column or index level
+    :param report_variable: the variable with the date of the report (raw strings or dates). If None,
+    every row uses datadate + fallback_lag_months
+    :param lag_months: the number of months added after the month of the report
+    :param fallback_lag_months: the number of months after datadate used when the report date is missing
+    :param date_format: the format of report_variable when it holds strings
+    :return: a DatetimeIndex aligned with the rows of compustat. A row is never available before datadate
+    """
+    datadate = pd.DatetimeIndex(compustat['datadate'] if 'datadate' in compustat.columns else
+                                compustat.index.get_level_values('datadate'))
+    fallback = shift_month_ends(datadate, fallback_lag_months)
+    if report_variable is None or report_variable not in compustat.columns:
+        return fallback
+
+    reports = compustat[report_variable]
+    if not pd.api.types.is_datetime64_any_dtype(reports):
+        reports = parse_dates(reports, date_format)
+    available = shift_month_ends(pd.DatetimeIndex(reports), lag_months)
+    available = available.where(available.notnull(), fallback)
+    return available.where(available >= datadate, datadate + MonthEnd(0))
+
+
+def composite_key(codes, days, min_day, span):
+    return codes.astype(np.int64) * span + (days - min_day)
+
+
+def asof_positions(left_keys, left_dates, right_keys, right_dates, right_order_by=None):
+    """
+    For every left row, finds the right row with the same key and the latest date on or before the
+    left date
+
+    :param left_keys: an array of identifiers (e.g. the Permcos of CRSP)
+    :param left_dates: an array of dates
+    :param right_keys: an array of identifiers (e.g. the Permcos of Compustat)
+    :param right_dates: an array of dates at which the right rows become usable. Missing dates never match
+    :param right_order_by: an array of dates that breaks ties between right rows with the same key and
+    date: the latest one is matched. Defaults to the row order
+    :return: a numpy array with the position of the matched right row, or NO_MATCH
+
+    Usage:
+
+    pos = asof_positions(np.array([1, 1, 2]), pd.to_datetime(['2000-01-31', '2000-03-31', '2000-03-31']),
+                         np.array([1, 2]), pd.to_datetime(['2000-02-29', '2000-04-30']))
+    assert(pos.tolist() == [-1, 0, -1])
+    """
+    codes, _ = pd.factorize(np.concatenate([np.asarray(left_keys), np.asarray(right_keys)]))
+    left_codes = codes[:len(left_keys)]
+    right_codes = codes[len(left_keys):]
+
+    left_days = np.asarray(left_dates, dtype='datetime64[D]').astype(np.int64)
+    right_days = np.asarray(right_dates, dtype='datetime64[D]')
+    usable = ~np.isnat(right_days)
+    right_days = right_days.astype(np.int64)
+    if not usable.any() or len(left_days) == 0:
+        return np.full(len(left_days), NO_MATCH, dtype=np.int64)
+
+    min_day = min(left_days.min(), right_days[usable].min())
+    span = max(left_days.max(), right_days[usable].max()) - min_day + 1
+
+    # Sort the usable right rows by key, date and tie breaker; the last row of a tie is matched
+    candidates = np.flatnonzero(usable)
+    sort_keys = [right_days[candidates], right_codes[candidates]]
+    if right_order_by is not None:
+        sort_keys = [np.asarray(right_order_by, dtype='datetime64[D]').astype(np.int64)[candidates]] + sort_keys
+    candidates = candidates[np.lexsort(sort_keys)]
+    sorted_right = composite_key(right_codes[candidates], right_days[candidates], min_day, span)
+
+    found = np.searchsorted(sorted_right, composite_key(left_codes, left_days, min_day, span), side='right') - 1
+    matched = found >= 0
+    matched[matched] = right_codes[candidates[found[matched]]] == left_codes[matched]
+    return np.where(matched, candidates[np.maximum(found, 0)], NO_MATCH)
+
+
+def asof_merge(crsp, compustat, columns=None, report_variable='Report Date', lag_months=0,
+               fallback_lag_months=4, max_staleness_months=None, suffix='.comp'):
+    """
+    Adds to every CRSP row the latest Compustat fundamentals of the same Permco that were public by
+    that month
+
+    :param crsp: a dataframe indexed on Permco and datadate
+    :param compustat: a dataframe indexed on Permco and datadate, uniquely identified
+    :param columns: the Compustat variables to add. If None, every variable is added
+    :param report_variable: see availability_dates
+    :param lag_months: see availability_dates
+    :param fallback_lag_months: see availability_dates
+    :param max_staleness_months: fundamentals whose datadate is more than this many months before the
+    CRSP month are left missing. If None, fundamentals never expire
+    :param suffix: added to the Compustat variables that are also in crsp. The datadate of the matched
+    fundamentals is added as 'datadate' + suffix
+    :return: crsp with the Compustat variables, in the same row order
+
+    Usage:
+
+    merged = asof_merge(crsp, compustat, columns=['Book Equity', 'Sales'], max_staleness_months=12)
+    """
+    columns = compustat.columns.tolist() if columns is None else list(columns)
+    compustat_dates = compustat.index.get_level_values('datadate')
+    available = availability_dates(compustat, report_variable, lag_months, fallback_lag_months)
+
+    crsp_dates = crsp.index.get_level_values('datadate')
+    positions = asof_positions(crsp.index.get_level_values('Permco').values, crsp_dates.values,
+                               compustat.index.get_level_values('Permco').values, available.values,
+                               right_order_by=compustat_dates.values)
+
+    matched = positions != NO_MATCH
+    if max_staleness_months is not None:
+        age = month_codes(crsp_dates[matched]) - month_codes(compustat_dates.take(positions[matched]))
+        matched[matched] = age <= max_staleness_months
+
+    # Unmatched rows point at an extra row of missing values
+    padded = pd.concat([compustat[columns].reset_index()[['datadate'] + columns], pd.DataFrame(index=[0])],
+                       ignore_index=True)
+    fundamentals = padded.take(np.where(matched, positions, compustat.shape[0]))
+    fundamentals.index = crsp.index
+    fundamentals = fundamentals.rename(columns={v: v + suffix for v in fundamentals.columns if v in crsp.columns
+                                                or v == 'datadate'})
+    return pd.concat([crsp, fundamentals], axis=1)
@@ -0,0 +1,691 @@
+"""
+Description: Benchmarks of the pipeline and of its faster code paths, on synthetic fixtures (see
+synthetic.py). Where a code path replaced an original implementation, the original is timed first
+and the speedup over it is printed. The originals are the reference implementations of the tests in
+../tests, which check that both give the same answers; the benchmarks only time them.
+
+The pipeline benchmark writes synthetic raw files (see synthetic.write_raw_files) and times each step
+of write_crsp.py, write_compustat.py, the features and the merge on them. --scale multiplies its number
+of firms, and those of the utils and sharding benchmarks.
+
+The timings of every run are saved to ../Logs/benchmarks/. A run compared to a baseline fails if a code
+path got slower by more than the tolerance.
+
+Usage:
+
+python benchmarks.py                          # Runs every benchmark
+python benchmarks.py share_classes storage    # Runs the named benchmarks
+python benchmarks.py pipeline utils --save-baseline
+python benchmarks.py pipeline utils --compare --tolerance 0.3
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+import shutil
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+from instrumentation import peak_memory_mb
+from utils import print_message, parallel_apply, weighted_quantile, check_unique, continuous_index
+from synthetic import make_crsp_share_classes, make_merged_panel, make_compustat_panel, COMPUSTAT_YTD_VARIABLES
+from aggregation import aggregate_groups
+from storage import write_frame, read_frame
+from dedup import select_least_missing
+from ytd import decumulate_ytd
+from asof import asof_merge
+from schema import apply_schema, column_memory, memory_report
+from dates import parse_month_ends, parse_dates
+from integrity import continuity_report, duplicate_report
+from quantiles import breakpoints
+from portfolios import add_sort_variables, double_sort, portfolio_returns
+from three_pass_filter import pma_panel, three_pass_forecasts, forecast_dates
+from forecast_evaluation import expanding_forecasts, rolling_forecasts, oos_r2_by_split_date
+from features import build_features
+from features_crsp import CRSP_FEATURES
+from synthetic import write_raw_files
+from winsorize import cross_sectional_transform
+from cube import write_cube, open_cube, cross_section, firm_history
+from security_master import build_security_master, write_security_master, load_security_master, lookup_ticker, \
+    firm_frame, read_firm
+from write_crsp import load_crsp, build_crsp, verify_crsp, CRSP_SCHEMA, AGG_VAR_TYPES
+from write_compustat import load_compustat, deduplicate_compustat, quarterly_cash_flows, verify_compustat, \
+    COMPUSTAT_SCHEMA
+from features_crsp import add_crsp_features, CRSP_FEATURE_SCHEMA
+from features_compustat import add_compustat_features, COMPUSTAT_FEATURE_SCHEMA
+from merge_crsp_compustat import merge_crsp_compustat
+import sharding
+
+# The original implementations are the references of the tests
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests'))
+from test_aggregation import agg_share_classes_reference
+from test_storage import read_hdf_subset
+from test_parallel import parallel_apply_reference
+from test_dedup import select_least_missing_reference
+from test_ytd import ytd_reference
+from test_asof import join_ffill_reference
+from test_dates import month_ends_reference, dates_reference
+from test_integrity import check_unique_reference
+from test_quantiles import breakpoints_reference
+from test_portfolios import double_sort_reference
+from test_three_pass_filter import notebook_forecast
+from test_forecast_evaluation import rolling_forecast, expanding_forecast, oos_by_split_date
+from test_features import crsp_features_reference
+from test_security_master import find_permcos_reference
+from test_winsorize import winsorize_standardize_reference
+
+RESULTS_DIR = '../Logs/benchmarks'
+BASELINE_PATH = os.path.join(RESULTS_DIR, 'baseline.json')
+TOLERANCE = 0.25 # A code path is a regression if it is this much slower than in the baseline
+MIN_SECONDS = 0.05 # Shorter timings are too noisy to compare
+RESULTS = {} # Timings of this run, by benchmark and code path (see report)
+
+
+def time_call(f, *args, **kwargs):
+    """
+    :return: a tuple of the result of f(*args, **kwargs) and the wall time in seconds
+    """
+    start = time.perf_counter()
+    ret = f(*args, **kwargs)
+    return ret, time.perf_counter() - start
+
+
+def report(name, timings, speedups=True):
+    """
+    Prints the timings of a benchmark along with the speedup over the first entry, and keeps them in RESULTS
+
+    :param name: the name of the benchmark
+    :param timings: an ordered dictionary from the name of a code path to its wall time. The first entry is
+    the original implementation
+    :param speedups: False when the entries are steps rather than alternative code paths
+    """
+    print_message('Benchmark: ' + name)
+    RESULTS[name] = dict(timings)
+    baseline = list(timings.values())[0]
+    for k, v in timings.items():
+        if speedups:
+            print('{:<45s}{:>10.3f}s{:>10.1f}x'.format(k, v, baseline / v if v > 0 else np.inf))
+        else:
+            print('{:<45s}{:>10.3f}s'.format(k, v))
+
+
+def timed_with_memory(f, *args, **kwargs):
+    """
+    Calls f twice: once for the wall time and once under tracemalloc for the peak memory
+    allocated by the call (numpy and pandas buffers are traced)
+
+    :return: a tuple of the wall time in seconds and the peak memory allocated in MB
+    """
+    _, elapsed = time_call(f, *args, **kwargs)
+
+    tracemalloc.start()
+    f(*args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 2 ** 20
+
+
+################ Share classes ################
+def benchmark_share_classes(num_firms=500, num_months=60):
+    crsp = make_crsp_share_classes(num_firms=num_firms, num_months=num_months)
+    problem_children = crsp.loc[crsp.index.duplicated(keep=False)]
+
+    _, reference_time = time_call(lambda: problem_children.groupby(level=['Permco', 'datadate']).apply(
+        lambda d: agg_share_classes_reference(d, AGG_VAR_TYPES)))
+    _, aggregate_time = time_call(aggregate_groups, problem_children, AGG_VAR_TYPES, 'Market Cap (Billions, CRSP)')
+    report('share_classes (' + str(problem_children.shape[0]) + ' share class rows)',
+           {'groupby apply': reference_time,
+            'aggregate_groups': aggregate_time})
+
+
+################ Storage ################
+def benchmark_storage(num_firms=2000, num_months=360, num_float_variables=40):
+    output_dir = tempfile.mkdtemp()
+    try:
+        merged = make_merged_panel(num_firms, num_months, num_float_variables)
+        columns = ['Market Cap (Billions, CRSP)', 'Exchange Code', 'Cumulative Return']
+        hdf_path = write_frame(merged, 'merged', fmt='hdf', output_dir=output_dir)
+        write_frame(merged, 'merged', fmt='parquet', output_dir=output_dir)
+        del merged
+
+        hdf_time, hdf_memory = timed_with_memory(read_hdf_subset, hdf_path, 'merged', columns)
+        parquet_time, parquet_memory = timed_with_memory(read_frame, 'merged', columns, fmt='parquet',
+                                                         output_dir=output_dir)
+        recent_time, recent_memory = timed_with_memory(read_frame, 'merged', columns, start='1995-01-31',
+                                                       fmt='parquet', output_dir=output_dir)
+
+        report('storage (' + str(len(columns)) + ' columns)', {'pd.read_hdf': hdf_time,
+                                                               'read_frame': parquet_time,
+                                                               'read_frame (since 1995)': recent_time})
+        print('Peak memory allocated (MB): read_hdf {:.0f}, read_frame {:.0f}, read_frame since 1995 {:.0f}'.format(
+            hdf_memory, parquet_memory, recent_memory))
+    finally:
+        shutil.rmtree(output_dir)
+
+
+################ Parallel apply ################
+def benchmark_parallel_apply(num_firms=2000, num_months=360, num_float_variables=40, num_cores=4):
+    panel = make_merged_panel(num_firms, num_months, num_float_variables)
+    last_return = lambda d: d['Return'].values[-1]
+
+    _, reference_time = time_call(parallel_apply_reference, panel, ['Permco'], last_return, num_cores)
+    _, parallel_time = time_call(parallel_apply, panel, ['Permco'], last_return, num_cores, None, report_timing=True)
+    report('parallel_apply (' + str(num_cores) + ' cores)', {'pickled groupby': reference_time,
+                                                             'shared memory': parallel_time})
+
+
+################ Compustat deduplication ################
+def benchmark_dedup(num_firms=300, num_years=10):
+    compustat = make_compustat_panel(num_firms, num_years)
+
+    _, reference_time = time_call(lambda: compustat.groupby(level=['Permco', 'datadate']).apply(
+        select_least_missing_reference))
+    _, least_missing_time = time_call(select_least_missing, compustat, ['Permco', 'datadate'])
+    _, tie_broken_time = time_call(select_least_missing, compustat, ['Permco', 'datadate'],
+                                   ['Report Date', 'Gvkey'], [False, True])
+    report('dedup (' + str(compustat.shape[0]) + ' rows)', {'groupby apply': reference_time,
+                                                            'select_least_missing': least_missing_time,
+                                                            'with tie breakers': tie_broken_time})
+
+
+################ Year to date variables ################
+def benchmark_ytd(num_firms=30000, num_years=40, num_reference_firms=100):
+    compustat = make_compustat_panel(num_firms, num_years, duplicate_share=0).sort_index()
+    sample = compustat.loc[compustat.index.get_level_values('Permco') < 10000 + num_reference_firms]
+
+    _, reference_time = time_call(ytd_reference, sample, COMPUSTAT_YTD_VARIABLES)
+    _, sample_time = time_call(decumulate_ytd, sample, COMPUSTAT_YTD_VARIABLES)
+    _, ytd_time = time_call(decumulate_ytd, compustat, COMPUSTAT_YTD_VARIABLES)
+    report('ytd', {'transform (' + str(num_reference_firms) + ' firms)': reference_time,
+                   'decumulate_ytd (' + str(num_reference_firms) + ' firms)': sample_time,
+                   'decumulate_ytd (' + str(num_firms) + ' firms)': ytd_time})
+
+
+def benchmark_asof(num_firms=2000, num_months=360, num_float_variables=10):
+    crsp = make_merged_panel(num_firms, num_months, num_float_variables)
+    compustat = make_compustat_panel(num_firms, num_months // 12, duplicate_share=0, missing_share=0).sort_index()
+
+    _, reference_time = time_call(join_ffill_reference, crsp, compustat)
+    _, datadate_time = time_call(asof_merge, crsp, compustat, report_variable=None, fallback_lag_months=0)
+    _, report_time = time_call(asof_merge, crsp, compustat, max_staleness_months=12)
+    _, subset_time = time_call(asof_merge, crsp, compustat, columns=['Sales', 'Assets, Total'], max_staleness_months=12)
+
+    report('asof (' + str(crsp.shape[0]) + ' CRSP rows, ' + str(compustat.shape[0]) + ' Compustat rows)',
+           {'join + ffill': reference_time,
+            'asof_merge on datadate': datadate_time,
+            'asof_merge on Report Date': report_time,
+            'asof_merge on Report Date, 2 variables': subset_time})
+
+
+def benchmark_schema(num_firms=5000, num_years=20):
+    # The synthetic panel has the types clean_data used to give: float64, object strings and int64
+    compustat = make_compustat_panel(num_firms, num_years, duplicate_share=0)
+    compustat = compustat.assign(**{v: compustat[v].astype(object) for v in ['Company Name', 'Currency']})
+    typed, schema_time = time_call(apply_schema, compustat, COMPUSTAT_FEATURE_SCHEMA, 'compustat', verbose=False)
+
+    print_message('Benchmark: schema (' + str(compustat.shape[0]) + ' Compustat rows)')
+    print(memory_report(column_memory(compustat), column_memory(typed)).to_string())
+    print('apply_schema: {:.3f}s'.format(schema_time))
+
+
+def benchmark_dates(num_rows=50000000, seed=0):
+    # Raw CRSP dates: the last trading day of each month since 1926, repeated over many rows
+    trading_days = pd.bdate_range('1925-12-31', '2018-12-31')
+    last_days = trading_days.to_series().groupby(trading_days.to_period('M')).max()
+    distinct = pd.DatetimeIndex(last_days.values).strftime('%Y/%m/%d').values
+    raw = pd.Series(distinct[np.random.RandomState(seed).randint(0, len(distinct), size=num_rows)], dtype=str)
+
+    _, month_end_reference_time = time_call(month_ends_reference, raw)
+    _, month_end_time = time_call(parse_month_ends, raw.values)
+    _, reference_time = time_call(dates_reference, raw)
+    _, exact_time = time_call(parse_dates, raw.values)
+    report('dates (' + str(num_rows) + ' rows, ' + str(len(distinct)) + ' distinct)',
+           {'to_datetime + MonthEnd': month_end_reference_time,
+            'parse_month_ends': month_end_time,
+            'to_datetime': reference_time,
+            'parse_dates': exact_time})
+
+
+def benchmark_integrity(num_firms=20000, num_months=240, num_float_variables=8, missing_share=0.01, seed=0):
+    # About the size of the monthly CRSP panel, with a few months missing
+    crsp = make_merged_panel(num_firms, num_months, num_float_variables, seed)
+    crsp = crsp.loc[np.random.RandomState(seed).random_sample(crsp.shape[0]) > missing_share]
+
+    _, reference_time = time_call(parallel_apply, crsp, ['Permco'], continuous_index, 2, None)
+    _, continuity_time = time_call(continuity_report, crsp)
+    _, unique_reference_time = time_call(check_unique_reference, crsp, ['Permco', 'datadate'])
+    _, duplicate_time = time_call(duplicate_report, crsp, ['Permco', 'datadate'])
+    report('integrity (' + str(crsp.shape[0]) + ' rows)',
+           {'parallel_apply(continuous_index), 2 cores': reference_time,
+            'continuity_report': continuity_time,
+            'check_unique (groupby count)': unique_reference_time,
+            'duplicate_report': duplicate_time})
+
+
+def benchmark_quantiles(num_dates=600, num_firms=5000, seed=0):
+    quantiles = [0.05, 0.10, 0.25, 0.5, 0.75, 0.90, 0.95, 0.99, 1]
+    merged = make_merged_panel(num_firms, num_dates, 0, seed)
+    size = 'Market Cap (Billions, CRSP)'
+
+    _, reference_time = time_call(breakpoints_reference, merged, size, quantiles)
+    _, breakpoint_time = time_call(breakpoints, merged, size, quantiles, size, exchange_codes=[1])
+    report('quantiles (' + str(num_dates) + ' dates x ' + str(num_firms) + ' firms)',
+           {'groupby apply(weighted_quantile)': reference_time,
+            'breakpoints': breakpoint_time})
+
+
+def benchmark_portfolios(num_dates=600, num_firms=5000, seed=0):
+    # 50 years of monthly CRSP sorted into 10 x 10 momentum and size portfolios
+    merged = make_merged_panel(num_firms, num_dates, 0, seed)
+    variables, variable_time = time_call(add_sort_variables, merged)
+
+    def sort_and_return(df):
+        df = pd.concat([df, double_sort(df, 'Return Momentum', 'Lagged Market Cap', 10, 10, exchange_codes=[1])],
+                       axis=1)
+        return portfolio_returns(df, ['Return Momentum Portfolio', 'Lagged Market Cap Portfolio'])
+
+    _, sort_time = time_call(sort_and_return, variables)
+    complete = variables.dropna(subset=['Return Momentum', 'Lagged Market Cap'])
+    _, reference_time = time_call(double_sort_reference, complete, 'Return Momentum', 'Lagged Market Cap', 10)
+    report('portfolios (' + str(num_dates) + ' dates x ' + str(num_firms) + ' firms, 10 x 10)',
+           {'groupby apply(weighted_quantile) + groupby': reference_time,
+            'double_sort + portfolio_returns': sort_time,
+            'add_sort_variables': variable_time})
+
+
+def benchmark_three_pass(num_firms=400, num_months=240, num_forecasts=60, company_per_date=100, seed=0):
+    rng = np.random.RandomState(seed)
+    crsp = make_merged_panel(num_firms, num_months, 0, seed)
+    crsp = crsp.loc[rng.random_sample(crsp.shape[0]) > 0.15]
+    dates = crsp.index.get_level_values('datadate').unique()
+    returns = rng.normal(0.01, 0.05, len(dates))
+    sp500 = pd.DataFrame({'S&P 500 Return': returns, 'Next Month Return': np.r_[returns[1:], np.nan]},
+                         index=pd.Index(dates, name='datadate')).dropna()
+    panel = pma_panel(crsp, sp500)
+    targets = forecast_dates(panel)[-num_forecasts:]
+
+    # The notebook's regressions take the intercept as a column
+    with_intercept = panel.assign(Intercept=1)
+    _, reference_time = time_call(lambda: [notebook_forecast(with_intercept, t, 5, company_per_date) for t in targets])
+    _, forecast_time = time_call(three_pass_forecasts, panel, targets, 5, company_per_date)
+    report('three_pass (' + str(num_forecasts) + ' forecast dates, ' + str(company_per_date) + ' firms)',
+           {'statsmodels OLS per firm and date': reference_time,
+            'three_pass_forecasts': forecast_time})
+
+
+def benchmark_forecast_evaluation(num_months=1060, window=480, min_periods=120, seed=0):
+    # About the length of the 3PRF forecasts from 1930 to 2018
+    rng = np.random.RandomState(seed)
+    factor = rng.normal(0, 0.2, num_months)
+    frame = pd.DataFrame({'Factor': factor,
+                          'Next Month Return': 0.005 + 0.01 * factor + rng.normal(0, 0.05, num_months),
+                          'datadate': pd.date_range('1930-01-31', periods=num_months, freq=MonthEnd()),
+                          'Intercept': 1})
+    dates = frame['datadate']
+
+    def refits():
+        return ([rolling_forecast(frame, t, window, min_periods) for t in dates],
+                [expanding_forecast(frame, t, min_periods) for t in dates],
+                [oos_by_split_date(frame, t, min_periods) for t in dates])
+
+    _, reference_time = time_call(refits)
+    _, rolling_time = time_call(rolling_forecasts, frame, window, min_periods)
+    _, expanding_time = time_call(expanding_forecasts, frame, min_periods)
+    _, oos_time = time_call(oos_r2_by_split_date, frame, min_periods=min_periods)
+    report('forecast_evaluation (' + str(num_months) + ' months)',
+           {'statsmodels refit on every date': reference_time,
+            'running sums': rolling_time + expanding_time + oos_time,
+            'rolling_forecasts': rolling_time,
+            'expanding_forecasts': expanding_time,
+            'oos_r2_by_split_date': oos_time})
+
+
+def benchmark_features(num_firms=20000, num_months=240, missing_share=0.01, seed=0):
+    # About the size of the monthly CRSP panel
+    rng = np.random.RandomState(seed)
+    crsp = make_merged_panel(num_firms, num_months, 0, seed)
+    crsp = crsp.loc[rng.random_sample(crsp.shape[0]) > missing_share]
+    crsp['Log Return'] = np.log(1 + crsp['Return'])
+    crsp['Price Volume (Billions)'] = np.where(rng.random_sample(crsp.shape[0]) > missing_share,
+                                               rng.lognormal(-3, 2, crsp.shape[0]), np.nan)
+
+    _, reference_time = time_call(crsp_features_reference, crsp)
+    _, features_time = time_call(build_features, crsp, CRSP_FEATURES)
+    report('features (' + str(crsp.shape[0]) + ' rows)', {'groupby cumsum + groupby rolling': reference_time,
+                                                          'build_features': features_time})
+
+
+################ Security master ################
+def benchmark_security_master(num_firms=20000, num_months=240, num_float_variables=10, num_lookups=50, seed=0):
+    merged = make_merged_panel(num_firms, num_months, num_float_variables, seed)
+    merged['Gvkey'] = pd.array(merged.index.get_level_values('Permco') + 1000, dtype='Int32')
+    tickers = ['T' + str(p) for p in np.random.RandomState(seed).randint(0, num_firms, size=num_lookups)]
+
+    def lookups_reference():
+        return [merged.xs(find_permcos_reference(merged, t).index[0], level='Permco', drop_level=False)
+                for t in tickers]
+
+    def lookups(master):
+        return [firm_frame(merged, master, lookup_ticker(master, t)) for t in tickers]
+
+    output_dir = tempfile.mkdtemp()
+    try:
+        master, build_time = time_call(build_security_master, merged)
+        _, reference_time = time_call(lookups_reference)
+        _, lookup_time = time_call(lookups, master)
+
+        write_frame(merged, 'merged', fmt='parquet', output_dir=output_dir)
+        write_security_master(master, fmt='parquet', output_dir=output_dir)
+        master = load_security_master(fmt='parquet', output_dir=output_dir)
+        permco = lookup_ticker(master, tickers[0])
+        _, full_time = time_call(lambda: read_frame('merged', fmt='parquet', output_dir=output_dir)
+                                 .xs(permco, level='Permco', drop_level=False))
+        _, firm_time = time_call(read_firm, master, permco, fmt='parquet', output_dir=output_dir)
+    finally:
+        shutil.rmtree(output_dir)
+
+    report('security_master (' + str(merged.shape[0]) + ' rows, ' + str(num_lookups) + ' lookups)',
+           {'find_permcos + xs': reference_time,
+            'build_security_master': build_time,
+            'lookup_ticker + firm_frame': lookup_time})
+    report('security_master (one firm from disk)', {'read_frame + xs': full_time, 'read_firm': firm_time})
+
+
+################ Winsorization ################
+def benchmark_winsorize(num_firms=10000, num_months=240, num_variables=20, missing_share=0.02, seed=0):
+    merged = make_merged_panel(num_firms, num_months, num_variables, seed)
+    variables = ['Variable ' + str(ind) for ind in range(num_variables)]
+    rng = np.random.RandomState(seed)
+    for variable in variables:
+        merged.loc[rng.random_sample(merged.shape[0]) < missing_share, variable] = np.nan
+
+    _, reference_time = time_call(winsorize_standardize_reference, merged, variables, 0.01, 0.99, [1])
+    _, transform_time = time_call(cross_sectional_transform, merged, variables, 0.01, 0.99, z_scores=True,
+                                  exchange_codes=[1])
+    report('winsorize (' + str(merged.shape[0]) + ' rows x ' + str(num_variables) + ' variables)',
+           {'loop over dates and variables': reference_time,
+            'cross_sectional_transform': transform_time})
+
+
+################ Cube ################
+def benchmark_cube(num_firms=20000, num_months=240, num_float_variables=10, num_slices=50, seed=0):
+    merged = make_merged_panel(num_firms, num_months, num_float_variables, seed)
+    merged = merged.loc[np.random.RandomState(seed).random_sample(merged.shape[0]) > 0.3] # Firms enter and exit
+    variables = ['Return', 'Market Cap (Billions, CRSP)', 'Cumulative Return']
+    dates = merged.index.get_level_values('datadate').unique()[::max(num_months // num_slices, 1)]
+    permcos = merged.index.get_level_values('Permco').unique()[::max(num_firms // num_slices, 1)]
+
+    def slices_reference():
+        sections = [merged.xs(d, level='datadate')['Market Cap (Billions, CRSP)'].values for d in dates]
+        histories = [merged.xs(p, level='Permco')['Return'].values for p in permcos]
+        return sections, histories
+
+    def slices(cube):
+        sections = [cross_section(cube, d, 'Market Cap (Billions, CRSP)') for d in dates]
+        histories = [firm_history(cube, p, 'Return') for p in permcos]
+        return sections, histories
+
+    path = tempfile.mkdtemp()
+    try:
+        _, write_time = time_call(write_cube, merged, variables, os.path.join(path, 'cube'))
+        cube, open_time = time_call(open_cube, os.path.join(path, 'cube'))
+        _, reference_time = time_call(slices_reference)
+        _, slice_time = time_call(slices, cube)
+    finally:
+        shutil.rmtree(path)
+
+    report('cube (' + str(merged.shape[0]) + ' rows, ' + str(len(dates)) + ' cross-sections and '
+           + str(len(permcos)) + ' firm histories)',
+           {'xs on the MultiIndex': reference_time,
+            'write_cube': write_time,
+            'open_cube': open_time,
+            'cross_section + firm_history': slice_time})
+
+
+################ Pipeline ################
+def benchmark_pipeline(num_firms=2000, num_months=240, scale=1.0, seed=0):
+    # Runs the steps of the build scripts, in the order of the Makefile, from a scratch directory
+    scratch = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        num_firms = int(num_firms * scale)
+        crsp_rows, compustat_rows = write_raw_files(os.path.join(scratch, 'Data'), num_firms, num_months, seed)
+        os.makedirs(os.path.join(scratch, 'Code'))
+        os.chdir(os.path.join(scratch, 'Code'))
+
+        timings = {}
+        def timed(step, f, *args, **kwargs):
+            ret, timings[step] = time_call(f, *args, **kwargs)
+            return ret
+
+        crsp = timed('write_crsp: load', load_crsp)
+        crsp = timed('write_crsp: build', build_crsp, crsp)
+        timed('write_crsp: verify', verify_crsp, crsp)
+        timed('write_crsp: write', write_frame, crsp, 'crsp_clean')
+
+        crsp = timed('features_crsp: read', read_frame, 'crsp_clean')
+        crsp = timed('features_crsp: features', add_crsp_features, apply_schema(crsp, CRSP_SCHEMA, 'crsp', verbose=False))
+        timed('features_crsp: write', write_frame, crsp, 'crsp')
+
+        compustat = timed('write_compustat: load', load_compustat)
+        compustat = timed('write_compustat: dedup', deduplicate_compustat, compustat)
+        compustat = timed('write_compustat: quarterly', quarterly_cash_flows, compustat)
+        timed('write_compustat: verify', verify_compustat, compustat)
+        timed('write_compustat: write', write_frame, compustat, 'compustat_clean')
+
+        compustat = timed('features_compustat: read', read_frame, 'compustat_clean')
+        compustat = timed('features_compustat: features', add_compustat_features,
+                          apply_schema(compustat, COMPUSTAT_SCHEMA, 'compustat', verbose=False))
+        timed('features_compustat: write', write_frame, compustat, 'compustat')
+
+        crsp = timed('merge: read crsp', read_frame, 'crsp')
+        compustat = timed('merge: read compustat', read_frame, 'compustat')
+        merged = timed('merge: merge', merge_crsp_compustat, apply_schema(crsp, CRSP_FEATURE_SCHEMA, 'crsp', verbose=False),
+                       apply_schema(compustat, COMPUSTAT_FEATURE_SCHEMA, 'compustat', verbose=False))
+        timed('merge: write', write_frame, merged, 'merged')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+    report('pipeline (' + str(crsp_rows) + ' CRSP rows, ' + str(compustat_rows) + ' Compustat rows)',
+           dict(timings, **{'total': sum(timings.values())}), speedups=False)
+
+
+################ Sharding ################
+def benchmark_sharding(num_firms=2000, num_months=240, num_shards=4, num_workers=2, scale=1.0, seed=0):
+    # The build with every firm in one shard against a sharded build, from a scratch directory
+    scratch = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        num_firms = int(num_firms * scale)
+        crsp_rows, compustat_rows = write_raw_files(os.path.join(scratch, 'Data'), num_firms, num_months, seed)
+        os.makedirs(os.path.join(scratch, 'Code'))
+        os.chdir(os.path.join(scratch, 'Code'))
+
+        # Shards are built in worker processes, whose largest peak memory is kept by the system
+        _, sharded_time = time_call(sharding.build, num_shards, num_workers)
+        sharded_memory = peak_memory_mb(children=True)
+        _, single_time = time_call(sharding.build, 1, 2)
+        single_memory = peak_memory_mb(children=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+    report('sharding (' + str(crsp_rows) + ' CRSP rows, ' + str(compustat_rows) + ' Compustat rows, '
+           + str(num_shards) + ' shards, ' + str(num_workers) + ' workers)',
+           {'one shard': single_time,
+            str(num_shards) + ' shards': sharded_time})
+    print('Peak memory of a worker (MB): one shard {:.0f}, {} shards {:.0f}'.format(single_memory, num_shards,
+                                                                                    sharded_memory))
+
+
+################ Utils ################
+def benchmark_utils(num_firms=2000, num_months=240, num_float_variables=10, scale=1.0, seed=0):
+    # The primitives of utils.py on a merged panel, on their own
+    panel = make_merged_panel(int(num_firms * scale), num_months, num_float_variables, seed)
+    values = panel['Return'].to_numpy(dtype=np.float64, na_value=np.nan)
+    weights = panel['Market Cap (Billions, CRSP)'].to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = ~np.isnan(values) & ~np.isnan(weights)
+    last_return = lambda d: d['Return'].values[-1]
+
+    _, parallel_time = time_call(parallel_apply, panel, ['Permco'], last_return, 2, None)
+    _, quantile_time = time_call(weighted_quantile, values[valid], [0.1, 0.3, 0.5, 0.7, 0.9], weights[valid])
+    _, unique_time = time_call(check_unique, panel, ['Permco', 'datadate'])
+
+    report('utils (' + str(panel.shape[0]) + ' rows)',
+           {'parallel_apply, 2 cores': parallel_time,
+            'weighted_quantile': quantile_time,
+            'check_unique': unique_time}, speedups=False)
+
+
+################ Startup ################
+# Header of a module that imports utils, as utils was loaded before and after the lazy imports
+STARTUP_HEADERS = {'original': 'import matplotlib\nmatplotlib.use("TkAgg")\nfrom multiprocess import Pool, cpu_count\n'
+                               'import scipy as sci\nfrom utils import *\n',
+                   'lazy': 'from utils import *\n'}
+
+SPIN_UP = """import time, multiprocess, startup_module
+start = time.perf_counter()
+with multiprocess.get_context('spawn').Pool(2) as p:
+    p.map(startup_module.identity, range(2))
+print(time.perf_counter() - start)"""
+
+
+def run_python(code, module_dir, num_runs):
+    """
+    :return: the shortest wall time of num_runs new interpreters running code, where module_dir and
+    this directory are on the path, and the last line the code printed
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([module_dir, os.getcwd(), os.environ.get('PYTHONPATH', '')]))
+    times = []
+    for _ in range(num_runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True).stdout
+        times.append(time.perf_counter() - start)
+    return min(times), output.strip().split('\n')[-1]
+
+
+def benchmark_startup(num_runs=5):
+    # Both the import of utils and the start of spawned workers, which import the module of the function they run
+    imports, spin_ups = {}, {}
+    for name, header in STARTUP_HEADERS.items():
+        module_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(module_dir, 'startup_module.py'), 'w') as f:
+                f.write(header + '\n\ndef identity(x):\n    return x\n')
+            imports[name], _ = run_python('import startup_module', module_dir, num_runs)
+            spin_ups[name] = min(float(run_python(SPIN_UP, module_dir, 1)[1]) for _ in range(num_runs))
+        finally:
+            shutil.rmtree(module_dir)
+
+    report('startup: import', imports)
+    report('startup: spawn 2 workers', spin_ups)
+    print('Modules loaded by utils: ' + run_python('import sys, utils; print(sorted(m for m in ["matplotlib", "scipy", '
+                                                   '"multiprocess"] if m in sys.modules))', os.getcwd(), 1)[1])
+
+
+################ Baselines ################
+def write_results(results, path):
+    """
+    Writes the timings of a run along with the versions they were measured with
+
+    :param results: a dictionary of benchmark name to a dictionary of code path to wall time
+    :param path: the path of the JSON file
+    :return: path
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'finished': str(datetime.now()),
+                   'python': platform.python_version(),
+                   'pandas': pd.__version__,
+                   'numpy': np.__version__,
+                   'machine': platform.node(),
+                   'cpu_count': os.cpu_count(),
+                   'results': results}, f, indent=2)
+    return path
+
+
+def compare_to_baseline(results, baseline, tolerance=TOLERANCE, min_seconds=MIN_SECONDS):
+    """
+    :param results: the timings of this run (see write_results)
+    :param baseline: the timings of an earlier run. Only the benchmarks and code paths in both are compared,
+    so benchmarks of a different size are not compared
+    :param tolerance: the relative slowdown above which a code path is a regression
+    :param min_seconds: code paths faster than this in both runs are not compared
+    :return: a dataframe with the baseline and current timings of every code path, their ratio and
+    whether it is a regression
+    """
+    rows = [{'Benchmark': name, 'Code Path': path, 'Baseline': baseline[name][path], 'Current': seconds}
+            for name, timings in results.items() if name in baseline
+            for path, seconds in timings.items() if path in baseline[name]]
+    ret = pd.DataFrame(rows, columns=['Benchmark', 'Code Path', 'Baseline', 'Current'])
+    ret['Ratio'] = ret['Current'] / ret['Baseline']
+    ret['Regression'] = (ret['Ratio'] > 1 + tolerance) & (ret[['Baseline', 'Current']].max(axis=1) >= min_seconds)
+    return ret
+
+
+BENCHMARKS = {'share_classes': benchmark_share_classes,
+              'storage': benchmark_storage,
+              'parallel_apply': benchmark_parallel_apply,
+              'dedup': benchmark_dedup,
+              'ytd': benchmark_ytd,
+              'asof': benchmark_asof,
+              'schema': benchmark_schema,
+              'dates': benchmark_dates,
+              'integrity': benchmark_integrity,
+              'quantiles': benchmark_quantiles,
+              'portfolios': benchmark_portfolios,
+              'three_pass': benchmark_three_pass,
+              'forecast_evaluation': benchmark_forecast_evaluation,
+              'features': benchmark_features,
+              'pipeline': benchmark_pipeline,
+              'utils': benchmark_utils,
+              'startup': benchmark_startup,
+              'security_master': benchmark_security_master,
+              'cube': benchmark_cube,
+              'winsorize': benchmark_winsorize,
+              'sharding': benchmark_sharding}
+
+# Benchmarks whose size is set by --scale
+SCALED_BENCHMARKS = ['pipeline', 'utils', 'sharding']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the pipeline and of its faster code paths')
+    parser.add_argument('names', nargs='*', help='the benchmarks to run (keys of BENCHMARKS). Defaults to all of them')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies the size of ' + ', '.join(SCALED_BENCHMARKS))
+    parser.add_argument('--save-baseline', action='store_true', help='saves the timings as the baseline')
+    parser.add_argument('--compare', nargs='?', const=BASELINE_PATH, default=None, metavar='BASELINE',
+                        help='compares the timings to a baseline (defaults to ' + BASELINE_PATH + ')')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(unknown))
+
+    for name in args.names or list(BENCHMARKS.keys()):
+        if name in SCALED_BENCHMARKS:
+            BENCHMARKS[name](scale=args.scale)
+        else:
+            BENCHMARKS[name]()
+
+    results_path = os.path.join(RESULTS_DIR, 'benchmarks-' + datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    print('Timings written to ' + write_results(RESULTS, results_path))
+    if args.save_baseline:
+        print('Baseline written to ' + write_results(RESULTS, BASELINE_PATH))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            comparison = compare_to_baseline(RESULTS, json.load(f)['results'], args.tolerance)
+        print_message('Comparison to ' + args.compare)
+        print(comparison.to_string(index=False))
+        if comparison['Regression'].any():
+            print('Regressions above ' + str(args.tolerance) + ':')
+            print(comparison.loc[comparison['Regression'], ['Benchmark', 'Code Path', 'Ratio']].to_string(index=False))
+            sys.exit(1)
@@ -0,0 +1,192 @@
+"""
+Description: Exports the numeric variables of merged as a dense Permco x month x variable cube of
+memory-mapped NumPy arrays, so that a date cross-section or a firm history is a view into the file
+rather than a groupby on the (Permco, datadate) MultiIndex.
+
+The cube is a directory (../Output/cube) with:
+
+values.npy - the cube, of shape (number of Permcos, number of months, number of variables). Firm-months
+that are not in merged are NaN.
+permcos.npy - the sorted Permcos, the first axis.
+months.npy - every month end from the first to the last month of merged, the second axis.
+variables.json - the variables, the third axis.
+
+Files are opened with np.load(mmap_mode='r'), so several processes can read the same cube and only
+the pages they touch are loaded. A firm history is contiguous; a cross-section takes one value per
+firm. A new cube is written to a temporary directory that then replaces the old one, so processes
+that opened the old cube keep reading it.
+
+Usage:
+
+python cube.py                                                  # After merge_crsp_compustat.py
+
+cube = open_cube()
+market_caps = cross_section(cube, '2000-12-31', 'Market Cap (Billions, CRSP)')  # One value per Permco
+history = firm_history(cube, 7)                                                  # Months x variables
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+from utils import print_message
+from instrumentation import enable_reports
+from storage import OUTPUT_DIR, DATE_VARIABLE, read_frame
+from dates import month_codes
+from integrity import variable_array
+
+CUBE_DIR = os.path.join(OUTPUT_DIR, 'cube')
+CUBE_DTYPE = np.float64
+FIRMS_PER_BLOCK = 1000 # Permcos filled with NaN at a time when the cube is created
+
+# Variables of merged used by the cross-sectional analyses (sorts, percentiles, 3PRF)
+CUBE_VARIABLES = ['Return', 'Cumulative Return', 'Market Cap (Billions, CRSP)', 'Exchange Code',
+                  'Volume (% of Market Cap, 3mma)', 'Market Cap (Compustat)', 'Book Equity']
+
+
+def write_cube(merged, variables=CUBE_VARIABLES, path=CUBE_DIR, dtype=CUBE_DTYPE):
+    """
+    Writes the cube of the variables of merged
+
+    :param merged: a dataframe indexed on Permco and datadate (month ends)
+    :param variables: the numeric (or numeric category) variables to export
+    :param path: the directory of the cube. It is replaced
+    :param dtype: the type of the values
+    :return: path
+    """
+    permcos = np.asarray(variable_array(merged, 'Permco'))
+    codes = month_codes(variable_array(merged, DATE_VARIABLE))
+    firm_values = np.unique(permcos)
+    first_month, last_month = codes.min(), codes.max()
+    firms = np.searchsorted(firm_values, permcos)
+    months = codes - first_month
+    first_month_end = pd.Timestamp(year=first_month // 12, month=first_month % 12 + 1, day=1) + MonthEnd(0)
+    month_ends = pd.date_range(first_month_end, periods=last_month - first_month + 1, freq=MonthEnd())
+
+    temporary = path + '.tmp-' + str(os.getpid())
+    if os.path.exists(temporary):
+        shutil.rmtree(temporary)
+    os.makedirs(temporary)
+    values = np.lib.format.open_memmap(os.path.join(temporary, 'values.npy'), mode='w+', dtype=dtype,
+                                       shape=(len(firm_values), len(month_ends), len(variables)))
+    for start in range(0, len(firm_values), FIRMS_PER_BLOCK):
+        values[start:start + FIRMS_PER_BLOCK] = np.nan
+    for k, variable in enumerate(variables):
+        column = merged[variable]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            column = column.astype(np.float64)
+        values[firms, months, k] = column.to_numpy(dtype=np.float64, na_value=np.nan)
+    values.flush()
+    del values
+
+    np.save(os.path.join(temporary, 'permcos.npy'), firm_values.astype(np.int64))
+    np.save(os.path.join(temporary, 'months.npy'), month_ends.values)
+    with open(os.path.join(temporary, 'variables.json'), 'w') as f:
+        json.dump(list(variables), f, indent=2)
+
+    # Processes that opened the old cube keep their open files
+    if os.path.exists(path):
+        old = path + '.old-' + str(os.getpid())
+        os.rename(path, old)
+        os.rename(temporary, path)
+        shutil.rmtree(old)
+    else:
+        os.rename(temporary, path)
+    return path
+
+
+def open_cube(path=CUBE_DIR):
+    """
+    :return: a dictionary with the read-only memory-mapped 'values', the 'permcos', 'months' and
+    'variables' of its axes, and 'first_month', the month code of its first month (see dates.month_codes)
+    """
+    with open(os.path.join(path, 'variables.json')) as f:
+        variables = json.load(f)
+    months = np.load(os.path.join(path, 'months.npy'))
+    return {'values': np.load(os.path.join(path, 'values.npy'), mmap_mode='r'),
+            'permcos': np.load(os.path.join(path, 'permcos.npy')),
+            'months': months,
+            'variables': variables,
+            'first_month': month_codes(months[:1])[0] if len(months) > 0 else 0}
+
+
+def permco_position(cube, permco):
+    """
+    :return: the position of permco on the first axis of the cube
+    """
+    position = np.searchsorted(cube['permcos'], permco)
+    if position == len(cube['permcos']) or cube['permcos'][position] != permco:
+        raise KeyError('Permco ' + str(permco) + ' is not in the cube')
+    return position
+
+
+def month_position(cube, date):
+    """
+    :return: the position of the month of date on the second axis of the cube
+    """
+    position = month_codes([date])[0] - cube['first_month']
+    if position < 0 or position >= len(cube['months']):
+        raise KeyError(str(date) + ' is not in the cube')
+    return position
+
+
+def variable_position(cube, variable):
+    """
+    :return: the position of variable on the third axis of the cube
+    """
+    return cube['variables'].index(variable)
+
+
+def cross_section(cube, date, variable=None):
+    """
+    :return: a view of the values of every Permco (in the order of cube['permcos']) in the month of date:
+    a vector for a single variable, or a Permcos x variables array if variable is None
+    """
+    t = month_position(cube, date)
+    if variable is None:
+        return cube['values'][:, t, :]
+    return cube['values'][:, t, variable_position(cube, variable)]
+
+
+def firm_history(cube, permco, variable=None):
+    """
+    :return: a view of the values of permco in every month (in the order of cube['months']): a vector for
+    a single variable, or a months x variables array if variable is None
+    """
+    i = permco_position(cube, permco)
+    if variable is None:
+        return cube['values'][i]
+    return cube['values'][i, :, variable_position(cube, variable)]
+
+
+def variable_matrix(cube, variable):
+    """
+    :return: a Permcos x months view of a single variable
+    """
+    return cube['values'][:, :, variable_position(cube, variable)]
+
+
+def cross_section_frame(cube, date, variables=None):
+    """
+    Same as merged.xs(date, level = 'datadate')[variables], without the firms whose variables are all missing
+
+    :return: a dataframe indexed on Permco (a copy of the cross-section)
+    """
+    variables = cube['variables'] if variables is None else list(variables)
+    t = month_position(cube, date)
+    values = cube['values'][:, t, :][:, [variable_position(cube, v) for v in variables]]
+    present = ~np.isnan(values).all(axis=1)
+    return pd.DataFrame(values[present], index=pd.Index(cube['permcos'][present], name='Permco'), columns=variables)
+
+
+if __name__ == '__main__':
+    enable_reports()
+    print_message('Loading Data')
+    merged = read_frame('merged', columns=CUBE_VARIABLES)
+
+    print_message('Writing the cube')
+    write_cube(merged)
+    cube = open_cube()
+    print('Cube of ' + str(cube['values'].shape) + ' (Permcos x months x variables) written to ' + CUBE_DIR)
@@ -0,0 +1,71 @@
+"""
+Description: Parsing of the raw date strings of the WRDS files.
+
+A date column of CRSP has tens of millions of rows but only about a thousand distinct
+values. The strings are factorized once, only the distinct values are parsed and moved to
+their month end, and the result is spread back to every row with an array lookup, so the
+per-row work is a hash of the string and a take.
+
+Used by clean_data (and so by every loader that calls it: CRSP, Compustat, the S&P 500
+returns of the 3PRF notebook) and by the row filters of ingest.py.
+"""
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import MonthEnd
+
+DATE_FORMAT = '%Y/%m/%d'
+
+
+def lookup(values, parse):
+    """
+    Applies parse to the distinct values only and spreads the result back to every row
+
+    :param values: an array-like of raw values
+    :param parse: a function that takes an Index of distinct values and returns a DatetimeIndex
+    :return: a DatetimeIndex with one date per value. Missing values give NaT
+    """
+    codes, uniques = pd.factorize(values)
+    parsed = parse(uniques)
+    table = np.append(parsed.values, np.array(['NaT'], dtype=parsed.values.dtype))
+    return pd.DatetimeIndex(table[codes])  # code -1 (missing) takes the NaT at the end
+
+
+def parse_dates(values, date_format=DATE_FORMAT):
+    """
+    :param values: an array-like of date strings
+    :param date_format: the format of the strings
+    :return: a DatetimeIndex. Strings that cannot be parsed give NaT
+    """
+    return lookup(values, lambda uniques: pd.to_datetime(uniques, format=date_format, errors='coerce'))
+
+
+def parse_month_ends(values, date_format=DATE_FORMAT):
+    """
+    Same as pd.to_datetime(values, format=date_format, errors='coerce') + MonthEnd(0), with the
+    parsing and the month end arithmetic done once per distinct value
+
+    :param values: an array-like of date strings (or dates)
+    :param date_format: the format of the strings
+    :return: a DatetimeIndex of month ends
+
+    Usage:
+
+    dates = parse_month_ends(pd.Series(['2000/01/15', '2000/01/15', '', '2000/02/29']))
+    assert(dates.strftime('%Y-%m-%d').tolist()[:2] == ['2000-01-31', '2000-01-31'])
+    """
+    def parse(uniques):
+        return pd.to_datetime(uniques, format=date_format, errors='coerce') + MonthEnd(0)
+
+    return lookup(values, parse)
+
+
+def month_codes(dates):
+    """
+    :param dates: an array-like of dates
+    :return: a numpy array of year * 12 + month - 1, so that consecutive months differ by one.
+    Missing dates give -1
+    """
+    dates = pd.DatetimeIndex(dates)
+    codes = dates.values.astype('datetime64[M]').astype(np.int64) + 1970 * 12
+    return np.where(dates.isnull(), -1, codes)
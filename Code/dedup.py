@@ -0,0 +1,103 @@
+"""
+Description: Reduces a dataframe to one row per key, keeping the row with the fewest missing
+values. Used in write_compustat.py so that Compustat is uniquely identified by Permco-datadate.
+
+Keys that are already unique (the vast majority) are passed through untouched. Duplicated keys
+are found by counting integer key codes rather than by grouping. Only the rows
+of duplicated keys are counted and sorted, in a single pass over all of them.
+"""
+
+import numpy as np
+import pandas as pd
+from instrumentation import instrumented
+
+MISSING_COUNT = 'Missing Count'
+
+
+def key_frame(df, key_list):
+    """
+    :return: a dataframe with the variables of key_list, which can be columns or index levels of df
+    """
+    return pd.DataFrame({v: df[v].values if v in df.columns else df.index.get_level_values(v)
+                         for v in key_list})
+
+
+def key_codes(df, key_list, max_codes=2 ** 26):
+    """
+    Numbers the distinct keys of df. Each variable is factorized and the codes are combined into
+    a single integer; when the combination gets too large, it is factorized again
+
+    :param df: a pandas dataframe
+    :param key_list: a list of variable names (columns or index levels)
+    :param max_codes: the largest number of possible codes before the combination is factorized
+    :return: a tuple of an int64 numpy array with the code of each row (missing values are a value
+    of their own) and the number of possible codes
+    """
+    codes = np.zeros(df.shape[0], dtype=np.int64)
+    num_codes = 1
+    for v in key_list:
+        values = df[v].values if v in df.columns else df.index.get_level_values(v)
+        variable_codes, uniques = pd.factorize(values)
+        codes = codes * (len(uniques) + 1) + (variable_codes + 1)
+        num_codes *= len(uniques) + 1
+        if num_codes > max_codes:
+            codes, uniques = pd.factorize(codes)
+            num_codes = len(uniques)
+    return codes, num_codes
+
+
+def duplicated_keys(df, key_list):
+    """
+    Flags every row whose key appears more than once, by counting the rows of each key code
+
+    :param df: a pandas dataframe
+    :param key_list: a list of variable names (columns or index levels)
+    :return: a boolean numpy array, True for the rows of keys that are not unique
+    """
+    codes, num_codes = key_codes(df, key_list)
+    return np.bincount(codes, minlength=num_codes)[codes] > 1
+
+
+@instrumented('dedup')
+def select_least_missing(df, key_list, tie_breakers=None, tie_ascending=None):
+    """
+    Keeps one row per key: the row with the fewest missing variables. Ties are broken by
+    tie_breakers, in order, and then by the original row order, so the result is deterministic.
+
+    :param df: a pandas dataframe
+    :param key_list: a list of variable names (columns or index levels) that should identify each row
+    :param tie_breakers: a list of variables used to choose between rows with the same number of
+    missing values. Variables that are not in df are ignored
+    :param tie_ascending: a list of booleans, one per tie breaker. True keeps the smallest value.
+    Defaults to True for every tie breaker
+    :return: a dataframe uniquely identified by key_list, sorted on its index
+
+    Usage:
+
+    df = pd.DataFrame({'Permco': [1, 1, 2], 'Gvkey': [20, 10, 30], 'Sales': [1., 1., np.nan]}).set_index('Permco')
+    ret = select_least_missing(df, ['Permco'], tie_breakers=['Gvkey'])
+    assert(ret['Gvkey'].tolist() == [10, 30])
+    """
+    duplicated = duplicated_keys(df, key_list)
+    if not duplicated.any():
+        return df.sort_index()
+
+    tie_breakers = [] if tie_breakers is None else tie_breakers
+    tie_ascending = [True] * len(tie_breakers) if tie_ascending is None else tie_ascending
+    used = [(v, a) for v, a in zip(tie_breakers, tie_ascending) if v in df.columns or v in df.index.names]
+
+    candidates = df.loc[duplicated]
+    keys = key_frame(candidates, key_list)
+    sort_frame = keys.assign(**{MISSING_COUNT: candidates.isnull().sum(axis=1).values})
+    for ind, (v, _) in enumerate(used):
+        sort_frame['_Tie ' + str(ind)] = candidates[v].values if v in candidates.columns else \
+            candidates.index.get_level_values(v)
+    sort_frame['_Row'] = np.arange(candidates.shape[0])
+
+    sort_variables = key_list + [MISSING_COUNT] + ['_Tie ' + str(ind) for ind in range(len(used))] + ['_Row']
+    ascending = [True] * (len(key_list) + 1) + [a for _, a in used] + [True]
+    winners = sort_frame.sort_values(sort_variables, ascending=ascending, kind='mergesort', na_position='last')
+    winners = winners.drop_duplicates(subset=key_list, keep='first')
+
+    ret = pd.concat([df.loc[~duplicated], candidates.iloc[winners['_Row'].values]])
+    return ret.sort_index()
@@ -0,0 +1,114 @@
+"""
+Description: Engine for the per-Permco features of a panel (cumulative sums, rolling means and sums,
+lags), computed on contiguous arrays instead of groupby objects.
+
+The panel is sorted by Permco and datadate, so the rows of each Permco are contiguous. The position of
+every row within its Permco is found once from the group boundaries. A lag of k rows is then a shift of
+the whole array, kept where the position is at least k, and a rolling window of w rows is the sum of w
+shifted arrays, kept where the position is at least w - 1. The features come back aligned with the
+panel, so nothing needs to be reindexed.
+
+Features are declared in a dictionary of output variable to (operation, input variable, parameter),
+such as CRSP_FEATURES in features_crsp.py. Each operation is looked up in FEATURE_OPERATIONS, and an
+input can be a variable of the panel or an earlier feature of the same dictionary.
+"""
+
+import numpy as np
+import pandas as pd
+from integrity import variable_array
+
+
+def group_positions(df, group='Permco'):
+    """
+    :param df: a pandas dataframe sorted on its index, so that the rows of each group are contiguous
+    :param group: the variable that identifies a firm (column or index level)
+    :return: a numpy array with the position of every row within its group (0 for the first row)
+    """
+    assert df.index.is_monotonic_increasing, 'df should be sorted on its index'
+    groups = np.asarray(variable_array(df, group))
+    rows = np.arange(len(groups))
+    is_start = np.r_[True, groups[1:] != groups[:-1]] if len(groups) > 0 else np.zeros(0, dtype=bool)
+    return rows - np.maximum.accumulate(np.where(is_start, rows, 0))
+
+
+def group_lag(values, positions, periods):
+    """
+    Same as groupby(group).shift(periods): the value periods rows earlier in the same group
+    """
+    ret = np.full(len(values), np.nan)
+    if periods < len(values):
+        ret[periods:] = values[:len(values) - periods]
+    ret[positions < periods] = np.nan
+    return ret
+
+
+def group_rolling_sum(values, positions, window):
+    """
+    Same as groupby(group).rolling(window).sum(): missing unless the last window rows of the group all have
+    a value
+    """
+    ret = values.copy()
+    for lag in range(1, window):
+        ret[lag:] += values[:len(values) - lag]
+    ret[positions < window - 1] = np.nan
+    return ret
+
+
+def group_rolling_mean(values, positions, window):
+    """
+    Same as groupby(group).rolling(window).mean()
+    """
+    return group_rolling_sum(values, positions, window) / window
+
+
+def group_cumsum(values, positions, parameter=None):
+    """
+    Same as groupby(group).cumsum(): missing values are skipped and stay missing
+    """
+    missing = np.isnan(values)
+    running = np.cumsum(np.where(missing, 0, values))
+    rows = np.arange(len(values))
+    starts = rows - positions
+    ret = running - (running[starts] - np.where(missing, 0, values)[starts])
+    ret[missing] = np.nan
+    return ret
+
+
+FEATURE_OPERATIONS = {'lag': group_lag,
+                      'rolling_sum': group_rolling_sum,
+                      'rolling_mean': group_rolling_mean,
+                      'cumsum': group_cumsum}
+
+
+def build_features(df, spec, group='Permco'):
+    """
+    Computes the features declared in spec within each group of df
+
+    :param df: a pandas dataframe sorted on its index (e.g. Permco and datadate)
+    :param spec: a dictionary of output variable to a tuple of (operation, input variable, parameter),
+    where operation is a key of FEATURE_OPERATIONS and parameter is the number of rows of a lag or window
+    :param group: the variable that identifies a firm (column or index level)
+    :return: a dataframe aligned with df with one float variable per feature
+
+    Usage:
+
+    momentum = build_features(merged, {'Lagged Cumulative Return (3)': ('lag', 'Cumulative Return', 3),
+                                       'Price Moving Average': ('rolling_mean', 'Cumulative Return', 36)})
+    """
+    positions = group_positions(df, group)
+    ret = pd.DataFrame(index=df.index)
+    for output, (operation, variable, parameter) in spec.items():
+        source = ret if variable in ret.columns else df
+        values = source[variable].to_numpy(dtype=np.float64, na_value=np.nan)
+        ret[output] = FEATURE_OPERATIONS[operation](values, positions, parameter)
+    return ret
+
+
+def lag(df, variable, periods=1, group='Permco'):
+    """
+    Same as df[variable].groupby(level=group).shift(periods) for a df sorted on its index
+
+    :return: a float Series aligned with df
+    """
+    values = df[variable].to_numpy(dtype=np.float64, na_value=np.nan)
+    return pd.Series(group_lag(values, group_positions(df, group), periods), index=df.index, name=variable)
@@ -1,19 +1,38 @@
 from utils import *
+from instrumentation import enable_reports
+from storage import read_frame, write_frame
+from schema import apply_schema
+from write_compustat import COMPUSTAT_SCHEMA
 
-compustat = pd.read_hdf('../Output/compustat.h5', 'compustat')
+# Types of the output (see schema.py)
+COMPUSTAT_FEATURE_SCHEMA = dict(COMPUSTAT_SCHEMA, **{'Market Cap (Compustat)': 'float32', 'Book Equity': 'float32'})
 
-################ Creating Features ################
 
-# Make some variables
-print('Making features')
-compustat['Market Cap (Compustat)'] = compustat['Price (Compustat)'] * compustat['Shares Outstanding (Compustat)'] / 1e3
+def add_compustat_features(compustat):
+    """
+    Builds market cap and book equity. Every feature only uses the same row, so new quarters can be
+    processed on their own.
 
+    :param compustat: the output of write_compustat.py
+    :return: compustat with the new features
+    """
+    print('Making features')
+    compustat['Market Cap (Compustat)'] = compustat['Price (Compustat)'] * compustat['Shares Outstanding (Compustat)'] / 1e3
 
+    # Fill missing shareholder equity with common + preferred equity, then with assets - liabilities
+    compustat['Shareholder Equity, Total'] = np.where(compustat['Shareholder Equity, Total'].isnull(), \
+                                                      compustat['Common Equity, Total'] + compustat['Preferred Equity, Total'], compustat['Shareholder Equity, Total'])
+    compustat['Shareholder Equity, Total'] = np.where(compustat['Shareholder Equity, Total'].isnull(), \
+                                                      compustat['Assets, Total'] - compustat['Liabilities, Total'], compustat['Shareholder Equity, Total'])
+    compustat['Book Equity'] = compustat['Shareholder Equity, Total'] + compustat['Deferred Tax Assets'] - compustat['Preferred Equity, Total']
+    return apply_schema(compustat, COMPUSTAT_FEATURE_SCHEMA, 'compustat features')
 
-compustat['Shareholder Equity, Total'] = np.select(compustat['Shareholder Equity, Total'].isnull(), \
-                                                   compustat['Common Equity, Total'] + compustat['Preferred Equity, Total'], compustat['Shareholder Equity, Total'])
-compustat['Shareholder Equity, Total'] = np.select(compustat['Shareholder Equity, Total'].isnull(), \
-                                                   compustat['Assets, Total'] - compustat['Liabilities, Total'], compustat['Shareholder Equity, Total'])
-compustat['Book Equity'] = compustat['Shareholder Equity, Total'] + compustat['Deferred Tax Assets'] - compustat['Preferred Equity, Total']
 
-compustat.to_hdf('../Output/compustat.h5', 'compustat')
\ No newline at end of file
+if __name__ == '__main__':
+    enable_reports()
+    compustat = apply_schema(read_frame('compustat_clean'), COMPUSTAT_SCHEMA, 'compustat', verbose = False)
+
+    ################ Creating Features ################
+    compustat = add_compustat_features(compustat)
+
+    write_frame(compustat, 'compustat')
@@ -1,24 +1,68 @@
 from utils import *
+from instrumentation import enable_reports
+from storage import read_frame, write_frame
+from state import write_state, tail_rows
+from schema import apply_schema
+from write_crsp import CRSP_SCHEMA
+from features import build_features
 import numpy as np
-import time
-from copy import copy
 
-NUM_CORES = 4
+ROLLING_WINDOW = 3 # Number of months in the moving averages
 
-print_message('Loading Data')
-crsp = pd.read_hdf('../Output/crsp.h5', 'crsp')
-crsp = crsp.safe_index(['Permco', 'datadate'])
-print(crsp.head())
+# Variables an incremental update needs from the previous months (see state.py)
+STATE_VARIABLES = ['Cumulative Return', 'Price Volume (Billions)', 'Market Cap (Billions, CRSP)']
 
-################ Generate Features ################
-print_message('Building features')
-crsp['Price Volume (Billions)'] = crsp['Price'] * crsp['Volume'] / 1e9
-crsp['Log Return'] = np.log(1 + crsp['Return'])
-crsp['Cumulative Return'] = crsp['Log Return'].groupby(['Permco'], group_keys = False).cumsum()
-crsp['Price Volume (3mma)'] = crsp['Price Volume (Billions)'].groupby(['Permco'], group_keys = False).rolling(3).mean()
-crsp['Market Cap (3mma)'] = crsp['Market Cap (Billions, CRSP)'].groupby(['Permco'], group_keys = False).rolling(3).mean()
-crsp['Volume (% of Market Cap, 3mma)'] = crsp['Price Volume (3mma)'] / crsp['Market Cap (3mma)']
+# Types of the output (see schema.py). Returns stay in double precision because they are compounded
+CRSP_FEATURE_SCHEMA = dict(CRSP_SCHEMA, **{'Price Volume (Billions)': 'float32',
+                                           'Log Return': 'float64',
+                                           'Cumulative Return': 'float64',
+                                           'Price Volume (3mma)': 'float32',
+                                           'Market Cap (3mma)': 'float32',
+                                           'Volume (% of Market Cap, 3mma)': 'float32'})
 
-################ Writing ################
-crsp.to_hdf('../Output/crsp.h5', 'crsp')
+# Features computed within each Permco (see features.py)
+CRSP_FEATURES = {'Cumulative Return': ('cumsum', 'Log Return', None),
+                 'Price Volume (3mma)': ('rolling_mean', 'Price Volume (Billions)', ROLLING_WINDOW),
+                 'Market Cap (3mma)': ('rolling_mean', 'Market Cap (Billions, CRSP)', ROLLING_WINDOW)}
 
+
+def add_crsp_features(crsp, history = None):
+    """
+    Builds the return and volume features of the CRSP panel
+
+    :param crsp: the output of write_crsp.py, indexed on Permco and datadate
+    :param history: the last months of an earlier output of this function (at least the variables in
+    STATE_VARIABLES), used to continue the cumulative returns and moving averages when only new months
+    are in crsp. None when building from the full history
+    :return: crsp with the new features, sorted on its index
+    """
+    print_message('Building features')
+    crsp = crsp.safe_index(['Permco', 'datadate']).sort_index()
+    crsp['Price Volume (Billions)'] = crsp['Price'] * crsp['Volume'] / 1e9
+    crsp['Log Return'] = np.log(1 + crsp['Return'])
+
+    if history is None:
+        features = build_features(crsp, CRSP_FEATURES)
+    else:
+        # The moving averages start from the stored months, and the cumulative returns from their last value
+        inputs = [variable for _, variable, _ in CRSP_FEATURES.values()]
+        panel = pd.concat([history[STATE_VARIABLES], crsp[inputs]]).sort_index()
+        features = build_features(panel, CRSP_FEATURES).reindex(crsp.index)
+        last_cumulative = history['Cumulative Return'].groupby(level = 'Permco').last()
+        features['Cumulative Return'] += last_cumulative.reindex(crsp.index.get_level_values('Permco')).fillna(0).values
+    crsp[list(CRSP_FEATURES.keys())] = features
+    crsp['Volume (% of Market Cap, 3mma)'] = crsp['Price Volume (3mma)'] / crsp['Market Cap (3mma)']
+    return apply_schema(crsp, CRSP_FEATURE_SCHEMA, 'crsp features')
+
+
+if __name__ == '__main__':
+    enable_reports()
+    print_message('Loading Data')
+    crsp = apply_schema(read_frame('crsp_clean'), CRSP_SCHEMA, 'crsp', verbose = False)
+    print(crsp.head())
+
+    crsp = add_crsp_features(crsp)
+
+    ################ Writing ################
+    write_frame(crsp, 'crsp')
+    write_state(tail_rows(crsp[STATE_VARIABLES], ROLLING_WINDOW - 1), 'crsp')
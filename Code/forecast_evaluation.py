@@ -0,0 +1,176 @@
+"""
+Description: Out of sample evaluation of the 3PRF forecasts of the Visualizing the replication notebook:
+expanding and rolling window forecasts of the Next Month Return from the Factor, and the out of sample
+R squared of every split date.
+
+Every forecast is an OLS regression of 'Next Month Return' on 'Factor' with an intercept, and an OLS
+regression only needs the sums of 1, x, y, x^2, xy and y^2 over its sample. These sums are accumulated
+once over the rows in date order, so the sums of any block of rows are the difference of two running
+sums: the rows up to the end of the block are added, and the rows before its start removed. Every date
+then costs a few array operations instead of a statsmodels fit on the whole history.
+
+The Factor and the returns are demeaned first (OLS forecasts do not depend on it) so that the
+differences of running sums keep their precision.
+
+Usage:
+
+forecast_frame = read_frame('forecasts_3prf', fmt = 'hdf')
+forecast_frame = evaluate_forecasts(forecast_frame)
+"""
+
+import numpy as np
+import pandas as pd
+
+ROLL_WINDOW = 40 # Number of years for rolling window
+MIN_WINDOW = 10 # Number of years for minimum window
+DAYS_PER_MONTH = 30.436875 # Length of a month in the notebook (pandas' former 'M' Timedelta unit)
+
+# Columns of the running sums
+N, SX, SY, SXX, SXY, SYY = range(6)
+
+
+def centered_variables(df):
+    """
+    :param df: a forecast frame
+    :return: a tuple of the Factor and the Next Month Return minus their means over the rows where both are
+    available, and the mean of the Next Month Return
+    """
+    x = df['Factor'].to_numpy(dtype=np.float64)
+    y = df['Next Month Return'].to_numpy(dtype=np.float64)
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x_mean = x[valid].mean() if valid.any() else np.nan
+    y_mean = y[valid].mean() if valid.any() else np.nan
+    return x - x_mean, y - y_mean, y_mean
+
+
+def running_sums(x, y):
+    """
+    :param x: a numpy array of regressors
+    :param y: a numpy array of outcomes
+    :return: an array with len(x) + 1 rows, where row k holds the sums of 1, x, y, x^2, xy and y^2 over the
+    first k rows. Rows where x or y is missing are left out
+    """
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x = np.where(valid, x, 0)
+    y = np.where(valid, y, 0)
+    stats = np.column_stack([valid, x, y, x * x, x * y, y * y]).astype(np.float64)
+    return np.vstack([np.zeros((1, stats.shape[1])), np.cumsum(stats, axis=0)])
+
+
+def fit(sums):
+    """
+    :param sums: an array of sums, one row per regression (see running_sums)
+    :return: a tuple of the intercepts and slopes of the OLS regressions of y on x
+    """
+    n = sums[:, N]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (sums[:, SXY] - sums[:, SX] * sums[:, SY] / n) / (sums[:, SXX] - sums[:, SX] ** 2 / n)
+        intercept = (sums[:, SY] - slope * sums[:, SX]) / n
+    return intercept, slope
+
+
+def window_forecasts(df, starts, min_periods):
+    """
+    Forecasts the Next Month Return of every row from a regression on the rows starts[i] to i - 1
+
+    :param df: a forecast frame sorted by datadate, with 'Factor' and 'Next Month Return'
+    :param starts: a numpy array with the first row of the estimation sample of every row
+    :param min_periods: the smallest number of rows, from starts[i] to i included, to forecast row i
+    :return: a numpy array of forecasts
+    """
+    x, y, y_mean = centered_variables(df)
+    sums = running_sums(x, y)
+    rows = np.arange(len(x))
+
+    # Add every row before row i, remove the rows before the start of its window
+    intercept, slope = fit(sums[rows] - sums[starts])
+    forecasts = intercept + slope * x + y_mean
+    forecasts[rows - starts + 1 < min_periods] = np.nan
+    return forecasts
+
+
+def expanding_forecasts(df, min_periods=MIN_WINDOW * 12):
+    """
+    Same as expanding_forecast_on_date of the notebook on every date: the forecast from all earlier rows
+
+    :param df: a forecast frame sorted by datadate
+    :param min_periods: the smallest number of rows up to the forecast date included
+    :return: a numpy array of forecasts
+    """
+    return window_forecasts(df, np.zeros(df.shape[0], dtype=np.int64), min_periods)
+
+
+def rolling_forecasts(df, window=ROLL_WINDOW * 12, min_periods=MIN_WINDOW * 12):
+    """
+    Same as rolling_forecast_on_date of the notebook on every date: the forecast from the earlier rows
+    dated at or after the forecast date minus window months of DAYS_PER_MONTH days
+
+    :param df: a forecast frame sorted by datadate
+    :param window: the number of months of the estimation window
+    :param min_periods: the smallest number of rows in the window, forecast date included
+    :return: a numpy array of forecasts
+    """
+    dates = pd.DatetimeIndex(df['datadate']).as_unit('ns') # The window start has a time of day
+    starts = np.searchsorted(dates.values, (dates - pd.Timedelta(days=DAYS_PER_MONTH * window)).values, side='left')
+    return window_forecasts(df, starts, min_periods)
+
+
+def oos_r2_by_split_date(df, split_dates=None, min_periods=MIN_WINDOW * 12):
+    """
+    Same as oos_by_split_date of the notebook on every split date: the out of sample R squared of the
+    forecasts estimated on the rows before the split date, against the mean return before the split date,
+    over the rows from the split date onwards
+
+    :param df: a forecast frame sorted by datadate
+    :param split_dates: the split dates. Defaults to the dates of df
+    :param min_periods: the smallest number of rows both before and after the split date
+    :return: a numpy array with the R squared of every split date
+    """
+    x, y, _ = centered_variables(df)
+    dates = pd.DatetimeIndex(df['datadate']).values
+    split_dates = dates if split_dates is None else pd.DatetimeIndex(split_dates).values
+    splits = np.searchsorted(dates, split_dates, side='left')
+
+    sums = running_sums(x, y)
+    before = sums[splits]
+    after = sums[-1] - before
+    intercept, slope = fit(before)
+
+    # Sums of squared errors over the rows after the split, expanded in terms of their sums
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = before[:, SY] / before[:, N]
+    sse_3prf = (after[:, SYY] - 2 * intercept * after[:, SY] - 2 * slope * after[:, SXY] + intercept ** 2 * after[:, N]
+                + 2 * intercept * slope * after[:, SX] + slope ** 2 * after[:, SXX])
+    sse_mean = after[:, SYY] - 2 * mean * after[:, SY] + mean ** 2 * after[:, N]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ret = 1 - sse_3prf / sse_mean
+    ret[(splits < min_periods) | (len(dates) - splits < min_periods)] = np.nan
+    return ret
+
+
+def evaluate_forecasts(forecast_frame, roll_window=ROLL_WINDOW, min_window=MIN_WINDOW):
+    """
+    Adds the forecasts, errors and out of sample R squared of the Visualizing the replication notebook
+
+    :param forecast_frame: the output of three_pass_filter.py
+    :param roll_window: the number of years of the rolling window
+    :param min_window: the number of years of the minimum window
+    :return: forecast_frame sorted by datadate, with the new variables
+    """
+    ret = forecast_frame.sort_values('datadate').reset_index(drop=True)
+    ret['OOS By Split Date'] = oos_r2_by_split_date(ret, min_periods=min_window * 12)
+    ret['Rolling Forecast'] = rolling_forecasts(ret, roll_window * 12, min_window * 12)
+    ret['Expanding Forecast'] = expanding_forecasts(ret, min_window * 12)
+    ret['Average So Far'] = ret['Next Month Return'].shift(1).expanding(min_window * 12).mean()
+
+    for forecast, error in [('Expanding Forecast', 'Expanding Forecast Error'), ('Rolling Forecast', 'Rolling Forecast Error'),
+                            ('Average So Far', 'Sample Mean Error')]:
+        ret[error] = (ret['Next Month Return'] - ret[forecast]) ** 2
+
+    ret['Rolling 3PRF MSE'] = ret['Rolling Forecast Error'].rolling(min_window * 12).mean()
+    ret['Expanding 3PRF MSE'] = ret['Expanding Forecast Error'].rolling(min_window * 12).mean()
+    ret['Rolling Sample Mean MSE'] = ret['Sample Mean Error'].rolling(min_window * 12).mean()
+    ret['Expanding Sample Mean MSE'] = ret['Sample Mean Error'].rolling(min_window * 12).mean()
+    ret['OOS R Squared (Expanding)'] = 1 - ret['Expanding 3PRF MSE'] / ret['Expanding Sample Mean MSE']
+    ret['OOS R Squared (Rolling)'] = 1 - ret['Rolling 3PRF MSE'] / ret['Rolling Sample Mean MSE']
+    return ret
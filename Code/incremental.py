@@ -0,0 +1,182 @@
+"""
+Description: Append-only update of the crsp, compustat and merged outputs when new months
+arrive in the raw files, without rebuilding the full history.
+
+A full build (make merged) stores, next to each output, the state the next update needs
+(see state.py). An update then:
+
+1. Reads only the raw CRSP rows dated after the last stored month of their own Permco, so late
+filers are picked up, collapses their share classes and continues the cumulative returns and
+moving averages from the stored tails.
+2. Reads only the raw Compustat rows dated after the last stored quarter of their own Permco,
+deduplicates them and converts their year to date cash flows using the stored values of the
+current fiscal year. The stored quarters of that fiscal year are converted again, since a
+variable that no quarter has reported yet is missing in all of them (see ytd.decumulate_ytd).
+3. Re-merges the months from the first new CRSP or Compustat date onwards, with the Compustat
+rows that are recent enough to be merged onto them.
+
+The new rows are appended with storage.append_frame and the states are replaced.
+
+Limitations: rows dated on or before the last stored date of their Permco (late corrections,
+restatements) are not picked up, and the raw rows of a Permco for a new date must arrive
+complete. Run a full build after a restatement. `python incremental.py verify` rebuilds everything in memory and checks that
+the updated outputs match.
+
+Usage:
+
+python incremental.py update
+python incremental.py verify
+"""
+
+import sys
+from utils import *
+from instrumentation import enable_reports
+from ingest import firm_date_filter
+from storage import read_frame, append_frame
+from state import read_state, write_state, tail_rows, last_fiscal_year
+from write_crsp import load_crsp, build_crsp, verify_crsp
+from write_compustat import load_compustat, deduplicate_compustat, quarterly_cash_flows, verify_compustat, \
+    yearly_variables
+from ytd import decumulate_ytd
+from features_crsp import add_crsp_features, ROLLING_WINDOW, STATE_VARIABLES, CRSP_FEATURE_SCHEMA
+from features_compustat import add_compustat_features, COMPUSTAT_FEATURE_SCHEMA
+from merge_crsp_compustat import merge_crsp_compustat, compustat_window_start, MERGED_SCHEMA
+from security_master import update_security_master
+from schema import apply_schema
+
+RTOL = 1e-6 # Sums are added in a different order and single precision variables are rounded, so allow for it
+
+
+def last_date(df):
+    return df.index.get_level_values('datadate').max()
+
+
+def first_date(df):
+    return df.index.get_level_values('datadate').min()
+
+
+def last_dates(df):
+    """
+    :return: a pandas series with the last datadate of every Permco of df
+    """
+    return df.index.to_frame(index=False).groupby('Permco')['datadate'].max()
+
+
+def restated_quarters(state, compustat):
+    """
+    Converts again the year to date cash flows of the stored quarters of the fiscal years that get new
+    quarters. A variable that no quarter of a fiscal year has reported is missing in every quarter, and
+    becomes zeros once a later quarter reports it, so these stored quarters can change
+
+    :param state: the compustat state, with the year to date values of the latest fiscal year of every Permco
+    :param compustat: the new deduplicated quarters, before their conversion
+    :return: the stored compustat rows of those quarters, with their new quarterly values, or None if there are none
+    """
+    def fiscal_years(df):
+        return pd.MultiIndex.from_arrays([df.index.get_level_values('Permco'), df['Fiscal Year']])
+
+    history = state.loc[fiscal_years(state).isin(fiscal_years(compustat))]
+    if history.shape[0] == 0:
+        return None
+    quarterly = decumulate_ytd(pd.concat([history, compustat[state.columns]]), yearly_variables,
+                               ['Permco', 'Fiscal Year'], 'Fiscal Quarter').iloc[:history.shape[0]]
+    stored = read_frame('compustat', start = first_date(history))
+    stored = apply_schema(stored.loc[stored.index.isin(history.index)], COMPUSTAT_FEATURE_SCHEMA, 'compustat',
+                          verbose = False)
+    stored[yearly_variables] = quarterly.loc[stored.index].values
+    return stored
+
+
+def update_crsp():
+    """
+    Appends the new CRSP months to the crsp output
+
+    :return: the first new datadate, or None if there are no new months
+    """
+    state = read_state('crsp')
+    crsp = load_crsp(row_filter = firm_date_filter('PERMCO', 'date', last_dates(state)))
+    if crsp.shape[0] == 0:
+        print('No new CRSP months after ' + str(last_date(state)))
+        return None
+
+    crsp = build_crsp(crsp)
+    verify_crsp(crsp)
+    crsp = add_crsp_features(crsp, history = state)
+
+    append_frame(crsp, 'crsp', replace_rows = True)
+    write_state(tail_rows(pd.concat([state, crsp[STATE_VARIABLES]]), ROLLING_WINDOW - 1), 'crsp')
+    return first_date(crsp)
+
+
+def update_compustat():
+    """
+    Appends the new Compustat quarters to the compustat output
+
+    :return: the first new datadate, or None if there are no new quarters
+    """
+    state = read_state('compustat')
+    compustat = load_compustat(row_filter = firm_date_filter('LPERMCO', 'datadate', last_dates(state)))
+    if compustat.shape[0] == 0:
+        print('No new Compustat quarters after ' + str(last_date(state)))
+        return None
+
+    compustat = deduplicate_compustat(compustat)
+    new_state = last_fiscal_year(pd.concat([state, compustat[state.columns]]))
+    restated = restated_quarters(state, compustat)
+    compustat = quarterly_cash_flows(compustat, history = state)
+    verify_compustat(compustat)
+    compustat = add_compustat_features(compustat)
+
+    compustat = apply_schema(pd.concat([restated, compustat]).sort_index(), COMPUSTAT_FEATURE_SCHEMA, 'compustat',
+                             verbose = False)
+    append_frame(compustat, 'compustat', replace_rows = True)
+    write_state(new_state, 'compustat')
+    return first_date(compustat)
+
+
+def update_merged(start):
+    """
+    Re-merges every month from start onwards and replaces them in the merged output, then rebuilds its
+    security master
+    """
+    crsp = apply_schema(read_frame('crsp', start = start), CRSP_FEATURE_SCHEMA, 'crsp', verbose = False)
+    compustat = apply_schema(read_frame('compustat', start = compustat_window_start(start)), COMPUSTAT_FEATURE_SCHEMA,
+                             'compustat', verbose = False)
+    merged = merge_crsp_compustat(crsp, compustat)
+    append_frame(merged, 'merged')
+    update_security_master()
+
+
+def update():
+    starts = [d for d in [update_crsp(), update_compustat()] if d is not None]
+    if len(starts) == 0:
+        print_message('Nothing to update')
+        return
+    update_merged(min(starts))
+    print_message('Update finished')
+
+
+def verify():
+    """
+    Rebuilds every output from the raw files in memory and compares it with the stored output
+    """
+    crsp = add_crsp_features(build_crsp(load_crsp()))
+    compustat = add_compustat_features(quarterly_cash_flows(deduplicate_compustat(load_compustat())))
+    rebuilt = {'crsp': (crsp, CRSP_FEATURE_SCHEMA),
+               'compustat': (compustat, COMPUSTAT_FEATURE_SCHEMA),
+               'merged': (merge_crsp_compustat(crsp, compustat), MERGED_SCHEMA)}
+
+    for name, (df, schema) in rebuilt.items():
+        print_message('Comparing ' + name)
+        stored = apply_schema(read_frame(name), schema, name, verbose = False)
+        pd.testing.assert_frame_equal(stored, df.sort_index()[stored.columns], check_dtype = False,
+                                      check_index_type = False, check_categorical = False, rtol = RTOL)
+        print(str(stored.shape[0]) + ' rows match')
+
+
+if __name__ == '__main__':
+    enable_reports()
+    commands = {'update': update, 'verify': verify}
+    command = sys.argv[1] if len(sys.argv) > 1 else 'update'
+    assert command in commands, 'Unknown command: ' + command
+    commands[command]()
@@ -0,0 +1,181 @@
+"""
+Description: Streaming ingest of the raw tab-separated WRDS dumps (crsp.txt and
+compustat-merged.txt).
+
+Instead of reading the whole file, keeping a raw copy and cleaning a second copy, the file
+is read in chunks of a bounded number of rows. Each chunk is reduced to the requested columns
+while parsing, filtered, and coerced with clean_data before the next chunk is read, so the
+peak memory is roughly one raw chunk plus the typed frame that is being built up.
+"""
+
+import numpy as np
+import pandas as pd
+from utils import clean_data, print_message, peak_memory_mb
+from schema import column_memory, memory_report
+from dates import parse_month_ends, DATE_FORMAT
+from instrumentation import instrumented
+
+DEFAULT_CHUNKSIZE = 1000000
+
+
+def restrict_types(type_dict, columns):
+    """
+    Drops the variables of type_dict that are not in columns
+
+    :param type_dict: a dictionary in the format used by clean_data
+    :param columns: the list of columns that are being read
+    :return: a new dictionary with the same keys
+    """
+    return {k: [v for v in variables if v in columns] for k, variables in type_dict.items()}
+
+
+def share_code_filter(share_codes=(10, 11), variable='SHRCD'):
+    """
+    Builds a row filter that keeps only the given CRSP share codes (common shares by default)
+
+    :param share_codes: the share codes to keep
+    :param variable: the name of the share code variable
+    :return: a function that takes a raw chunk and returns a boolean mask of the rows to keep
+    """
+    def keep(chunk):
+        return pd.to_numeric(chunk[variable], errors='coerce').isin(share_codes).values
+
+    keep.columns = [variable]
+    return keep
+
+
+def date_filter(variable, after=None, until=None, date_format=DATE_FORMAT):
+    """
+    Builds a row filter that keeps the rows whose raw date is strictly after `after` and at or
+    before `until` (after moving both the raw dates and the bounds to month ends, like clean_data)
+
+    :param variable: the name of the raw date variable, e.g. 'date' in CRSP
+    :param after: a date, or None for no lower bound
+    :param until: a date, or None for no upper bound
+    :param date_format: the format of the raw dates
+    :return: a function that takes a raw chunk and returns a boolean mask of the rows to keep
+    """
+    after = None if after is None else pd.Timestamp(after) + pd.offsets.MonthEnd(0)
+    until = None if until is None else pd.Timestamp(until) + pd.offsets.MonthEnd(0)
+
+    def keep(chunk):
+        dates = parse_month_ends(chunk[variable].values, date_format)
+        mask = dates.notnull()
+        if after is not None:
+            mask &= dates > after
+        if until is not None:
+            mask &= dates <= until
+        return mask
+
+    keep.columns = [variable]
+    return keep
+
+
+def firm_date_filter(firm_variable, date_variable, last_dates, date_format=DATE_FORMAT):
+    """
+    Builds a row filter that keeps the rows dated strictly after the last stored date of their own
+    firm (after moving the raw dates to month ends, like clean_data). Every row of a firm without a
+    stored date is kept, so late filers and new firms are picked up.
+
+    :param firm_variable: the name of the raw firm variable, e.g. 'PERMCO' in CRSP
+    :param date_variable: the name of the raw date variable, e.g. 'date' in CRSP
+    :param last_dates: a pandas series of the last stored date, indexed by firm
+    :param date_format: the format of the raw dates
+    :return: a function that takes a raw chunk and returns a boolean mask of the rows to keep
+    """
+    last_dates = pd.Series(pd.to_datetime(last_dates.values), index=pd.to_numeric(last_dates.index))
+
+    def keep(chunk):
+        dates = parse_month_ends(chunk[date_variable].values, date_format)
+        firms = pd.to_numeric(chunk[firm_variable], errors='coerce').values
+        last = pd.DatetimeIndex(last_dates.reindex(firms).values)
+        return dates.notnull() & (last.isnull() | (dates > last))
+
+    keep.columns = [firm_variable, date_variable]
+    return keep
+
+
+def combine_filters(*row_filters):
+    """
+    :return: a row filter that keeps the rows kept by every one of row_filters
+    """
+    def keep(chunk):
+        mask = np.ones(chunk.shape[0], dtype=bool)
+        for f in row_filters:
+            mask &= f(chunk)
+        return mask
+
+    keep.columns = [v for f in row_filters for v in getattr(f, 'columns', [])]
+    return keep
+
+
+@instrumented('load')
+def read_chunked(path, type_dict, columns=None, row_filter=None, chunksize=DEFAULT_CHUNKSIZE, sep='\t',
+                 verbose=True):
+    """
+    Reads a delimited file in chunks, keeping only the requested columns and rows and coercing
+    the types of each chunk before moving on to the next.
+
+    :param path: the path to the file
+    :param type_dict: a dictionary in the format used by clean_data. Variables that are not read
+    are ignored
+    :param columns: a list of the columns to keep. If None, every column is kept
+    :param row_filter: a function that takes a raw chunk and returns a boolean mask of the rows to
+    keep. The columns it needs are listed in its attribute `columns` (see share_code_filter) and are
+    read even if they are not in columns
+    :param chunksize: the number of rows parsed at a time
+    :param sep: the delimiter of the file
+    :param verbose: if True, prints the memory of each variable before and after typing the first chunk,
+    and the number of rows and the memory high-water mark after every chunk
+    :return: the typed dataframe with only the requested rows and columns
+    """
+    filter_columns = getattr(row_filter, 'columns', [])
+    usecols = None if columns is None else list(dict.fromkeys(list(columns) + list(filter_columns)))
+    chunk_types = restrict_types(type_dict, usecols) if usecols is not None else type_dict
+
+    # Untyped variables are read as strings so that every chunk ends up with the same dtypes
+    typed = set(v for variables in chunk_types.values() for v in variables)
+    string_dtypes = None if usecols is None else {v: str for v in usecols if v not in typed}
+
+    chunks = []
+    rows_read = 0
+    rows_kept = 0
+    reader = pd.read_csv(path, sep=sep, usecols=usecols, dtype=string_dtypes, chunksize=chunksize)
+    for ind, chunk in enumerate(reader):
+        rows_read += chunk.shape[0]
+        if row_filter is not None:
+            chunk = chunk.loc[row_filter(chunk)]
+        if columns is not None:
+            chunk = chunk[list(columns)]
+
+        raw_memory = column_memory(chunk) if verbose and ind == 0 else None
+        chunk = clean_data(chunk.copy(), chunk_types, verbose=False)
+        rows_kept += chunk.shape[0]
+        chunks.append(chunk)
+
+        if raw_memory is not None:
+            print('Memory of the first chunk by variable, as read and after typing')
+            print(memory_report(raw_memory, column_memory(chunk)).to_string())
+
+        if verbose:
+            print('Chunk {}: {:,} rows read, {:,} kept, {:.1f} MB typed, peak memory {:.1f} MB'.format(
+                ind, rows_read, rows_kept, chunk.memory_usage(deep=True).sum() / 2 ** 20, peak_memory_mb()))
+
+    # Categoricals of different chunks are given the same categories so that they stay categoricals
+    for v in chunk_types.get('category_vars', []):
+        if len(chunks) > 0 and v in chunks[0].columns:
+            categories = pd.Index(np.concatenate([c[v].cat.categories.values for c in chunks])).unique().sort_values()
+            for c in chunks:
+                c[v] = c[v].cat.set_categories(categories)
+
+    ret = pd.concat(chunks, ignore_index=True) if len(chunks) > 0 else pd.DataFrame(columns=columns)
+    del chunks
+
+    if verbose:
+        print_message('Finished reading ' + path)
+        print('Rows read: {:,}, rows kept: {:,}'.format(rows_read, rows_kept))
+        print('Final frame: {:.1f} MB, peak memory {:.1f} MB'.format(
+            ret.memory_usage(deep=True).sum() / 2 ** 20, peak_memory_mb()))
+        print(ret.dtypes)
+
+    return ret
@@ -0,0 +1,238 @@
+"""
+Description: Wall time, CPU time, memory, row counts and bytes written of each step of a run, written
+as a JSON run report to the Logs directory of the repository when the run ends.
+
+Reports are opt-in: the build scripts call enable_reports when they are run directly, and nothing is
+recorded or written when they are only imported (notebooks, tests, benchmarks).
+
+Two kinds of records are kept:
+
+'phase' - the stretch of a script between two calls of utils.print_message, named after the message.
+Every script is covered without changes.
+'step' - a call of a function decorated with @instrumented (loading, clean_data, the share class
+aggregation, deduplication, integrity checks, writing), or a block in `with step(name)`. Steps record the
+rows of their input and output and, for writers, the bytes written.
+
+Each record has its wall time, CPU time, the peak resident memory of the whole process so far at its end
+(process_peak_rss_mb, not the peak of the step alone) and how much the step raised that peak
+(process_peak_increase_mb, zero when the step stayed below an earlier peak). Measuring costs two system
+calls per record.
+
+Steps named in the PROFILE_STEPS environment variable (comma separated) also run under cProfile, and the
+statistics are saved next to the report. Steps named in TRACE_MEMORY_STEPS run under tracemalloc, and their
+peak traced Python memory is added to their record. Both slow the named steps down.
+
+Usage:
+
+if __name__ == '__main__':
+    enable_reports()
+    ...
+
+PROFILE_STEPS=clean_data,aggregate_groups TRACE_MEMORY_STEPS=clean_data python write_crsp.py
+
+@instrumented()
+def load_crsp(...):
+    ...
+
+with step('rename', crsp) as record:
+    crsp = crsp.rename(columns = crsp_names)
+    record['rows_out'] = crsp.shape[0]
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import cProfile
+import functools
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Logs')
+PROFILED_STEPS = set(filter(None, os.environ.get('PROFILE_STEPS', '').split(',')))
+TRACED_STEPS = set(filter(None, os.environ.get('TRACE_MEMORY_STEPS', '').split(',')))
+
+RUN = {'name': os.path.splitext(os.path.basename(sys.argv[0] or 'interactive'))[0],
+       'started': datetime.now(),
+       'records': [],
+       'stack': [],
+       'phase': None,
+       'pid': os.getpid(),
+       'enabled': False}
+
+
+def peak_memory_mb(children=False):
+    """
+    :param children: if True, the high-water mark of the largest child process that has ended instead
+    :return: the high-water mark of the resident memory of this process in megabytes, or NaN
+    if the platform does not report it
+    """
+    try:
+        import resource
+    except ImportError:
+        return float('nan')
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # Bytes on macOS, KB on Linux
+
+
+def num_rows(value):
+    """
+    :return: the number of rows of a dataframe (or of the first dataframe of a tuple), or None
+    """
+    if isinstance(value, tuple) and len(value) > 0:
+        value = value[0]
+    shape = getattr(value, 'shape', None)
+    return int(shape[0]) if shape is not None and len(shape) > 0 else None
+
+
+def path_bytes(path):
+    """
+    :return: the size in bytes of a file, or of every file under a directory
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def enable_reports():
+    """
+    Turns on the run report of this process: steps and phases are recorded from now on, and the report is
+    written to LOG_DIR when the process exits
+    """
+    if not RUN['enabled']:
+        atexit.register(write_run_report)
+        RUN['enabled'] = True
+
+
+def start_record(kind, name, rows_in=None):
+    record = {'kind': kind, 'name': name, 'parent': RUN['stack'][-1]['name'] if RUN['stack'] else None,
+              'started': str(datetime.now()), 'rows_in': rows_in, 'rows_out': None, 'bytes_written': None,
+              '_wall': time.perf_counter(), '_cpu': time.process_time(), '_peak': peak_memory_mb()}
+    if RUN['enabled'] and name in TRACED_STEPS:
+        record['_tracing'] = not tracemalloc.is_tracing()
+        tracemalloc.start() if record['_tracing'] else tracemalloc.reset_peak()
+    if RUN['enabled'] and name in PROFILED_STEPS:
+        record['_profile'] = cProfile.Profile()
+        record['_profile'].enable()
+    return record
+
+
+def finish_record(record):
+    if '_profile' in record:
+        record['_profile'].disable()
+        os.makedirs(LOG_DIR, exist_ok=True)
+        record['profile'] = os.path.join(LOG_DIR, '-'.join([report_name(), record['name'], str(len(RUN['records']))]) + '.prof')
+        record['_profile'].dump_stats(record['profile'])
+    if '_tracing' in record:
+        record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        if record['_tracing']:
+            tracemalloc.stop()
+
+    peak = peak_memory_mb()
+    record.update({'wall_seconds': time.perf_counter() - record['_wall'],
+                   'cpu_seconds': time.process_time() - record['_cpu'],
+                   'process_peak_rss_mb': peak,
+                   'process_peak_increase_mb': peak - record['_peak']})
+    if RUN['enabled']:
+        RUN['records'].append({k: v for k, v in record.items() if not k.startswith('_')})
+
+
+@contextmanager
+def step(name, df=None):
+    """
+    Records the block as a step
+
+    :param name: the name of the step
+    :param df: the input of the step, whose rows are counted, or None
+    :return: the record of the step, where the block can set 'rows_out' and 'bytes_written'
+    """
+    record = start_record('step', name, num_rows(df))
+    RUN['stack'].append(record)
+    try:
+        yield record
+    finally:
+        RUN['stack'].pop()
+        finish_record(record)
+
+
+def instrumented(name=None, writes_path=False):
+    """
+    Decorator that records every call of a function as a step. The rows of the first argument and of
+    the result are counted when they are dataframes
+
+    :param name: the name of the step. Defaults to the name of the function
+    :param writes_path: if True, the function returns the path it wrote, whose size is recorded
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with step(name or f.__name__, args[0] if len(args) > 0 else None) as record:
+                result = f(*args, **kwargs)
+                record['rows_out'] = num_rows(result)
+                if writes_path and isinstance(result, str) and os.path.exists(result):
+                    record['bytes_written'] = path_bytes(result)
+            return result
+        return wrapper
+    return decorator
+
+
+def phase(text):
+    """
+    Ends the current phase and starts one called text (see utils.print_message). Does nothing unless
+    reports are enabled
+    """
+    end_phase()
+    if not RUN['enabled']:
+        return
+    RUN['phase'] = start_record('phase', text)
+
+
+def end_phase():
+    if RUN['phase'] is not None:
+        finish_record(RUN['phase'])
+        RUN['phase'] = None
+
+
+def start_run(name):
+    """
+    Starts a new run report called name, e.g. for each stage of pipeline.py. The records of the current
+    run are written first, unless they were inherited from the parent of a forked worker
+
+    :param name: the name of the run, used in the name of its report
+    """
+    if RUN['pid'] == os.getpid():
+        write_run_report(reset=True)
+    RUN.update({'name': name, 'started': datetime.now(), 'records': [], 'stack': [], 'phase': None,
+                'pid': os.getpid()})
+
+
+def report_name():
+    return 'run-' + RUN['name'] + '-' + RUN['started'].strftime('%Y%m%d-%H%M%S-%f') + '-' + str(os.getpid())
+
+
+def write_run_report(path=None, reset=False):
+    """
+    Writes the records of the run as JSON. Called when the process exits if reports are enabled
+
+    :param path: the path of the report. Defaults to LOG_DIR/run-<script>-<start time>-<pid>.json
+    :param reset: if True, the records are cleared afterwards (e.g. between the stages of pipeline.py)
+    :return: the path of the report, or None if nothing was recorded
+    """
+    end_phase()
+    if len(RUN['records']) == 0:
+        return None
+    path = os.path.join(LOG_DIR, report_name() + '.json') if path is None else path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    report = {'run': RUN['name'],
+              'argv': sys.argv,
+              'pid': os.getpid(),
+              'started': str(RUN['started']),
+              'finished': str(datetime.now()),
+              'records': RUN['records']}
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    if reset:
+        RUN['records'] = []
+    return path
@@ -0,0 +1,120 @@
+"""
+Description: Integrity checks of the Permco-datadate panels, in a single vectorized pass.
+
+continuity_report sorts the rows once by Permco and month, takes the difference of integer
+month codes within each Permco and summarizes the gaps of every Permco. duplicate_report
+turns the keys into integer codes and only groups the rows of codes that appear more than
+once, instead of a groupby count over the whole panel.
+"""
+
+import numpy as np
+import pandas as pd
+from dates import month_codes
+from instrumentation import instrumented
+from dedup import key_frame, duplicated_keys
+
+CONTINUITY_COLUMNS = ['Observations', 'First Date', 'Last Date', 'Max Gap (Months)', 'Gaps',
+                      'First Gap Start', 'First Gap End']
+
+
+def variable_array(df, variable):
+    """
+    :return: the values of variable, whether it is a column or an index level of df
+    """
+    return df[variable].values if variable in df.columns else df.index.get_level_values(variable)
+
+
+@instrumented('integrity')
+def continuity_report(df, group='Permco', date_variable='datadate', max_gap_months=1):
+    """
+    Summarizes, for every group, how many months separate its consecutive observations
+
+    :param df: a pandas dataframe. group and date_variable can be columns or index levels
+    :param group: the variable that identifies a firm
+    :param date_variable: the date of each observation
+    :param max_gap_months: the largest number of months between two consecutive observations that
+    is not a gap (1 for monthly data, 3 for quarterly data)
+    :return: a dataframe indexed on group with the columns of CONTINUITY_COLUMNS. 'Gaps' counts the
+    consecutive observations more than max_gap_months apart, and 'First Gap Start' and 'First Gap End'
+    are the dates on each side of the first one (NaT without gaps). Rows with a missing group or
+    date are ignored
+
+    Usage:
+
+    report = continuity_report(crsp)
+    print(report.loc[report['Gaps'] > 0])
+    """
+    codes, groups = pd.factorize(variable_array(df, group), sort=True)
+    dates = pd.DatetimeIndex(variable_array(df, date_variable))
+    months = month_codes(dates)
+
+    order = np.flatnonzero((codes >= 0) & (months >= 0))
+    if len(order) == 0:
+        return pd.DataFrame(columns=CONTINUITY_COLUMNS, index=pd.Index([], name=group))
+
+    # Panels are usually already sorted by Permco and date, in which case the sort is skipped
+    sort_key = codes[order] * (months[order].max() + 1) + months[order]
+    if not (sort_key[1:] >= sort_key[:-1]).all():
+        order = order[np.argsort(sort_key, kind='stable')]
+
+    sorted_codes = codes[order]
+    sorted_months = months[order]
+    sorted_dates = dates.values[order]
+    is_start = np.r_[True, sorted_codes[1:] != sorted_codes[:-1]]
+    starts = np.flatnonzero(is_start)
+    ends = np.r_[starts[1:], len(order)] - 1
+    group_ids = np.cumsum(is_start) - 1
+
+    gaps = np.diff(sorted_months, prepend=sorted_months[0])
+    gaps[is_start] = 0
+    is_gap = gaps > max_gap_months
+
+    # The first gap of each group is the first flagged row of that group
+    gap_rows = np.flatnonzero(is_gap)
+    first_gap_groups, first = np.unique(group_ids[gap_rows], return_index=True)
+    first_gap_start = np.full(len(starts), np.datetime64('NaT'), dtype=sorted_dates.dtype)
+    first_gap_end = first_gap_start.copy()
+    first_gap_start[first_gap_groups] = sorted_dates[gap_rows[first] - 1]
+    first_gap_end[first_gap_groups] = sorted_dates[gap_rows[first]]
+
+    report = pd.DataFrame({'Observations': np.diff(np.r_[starts, len(order)]),
+                           'First Date': sorted_dates[starts],
+                           'Last Date': sorted_dates[ends],
+                           'Max Gap (Months)': np.maximum.reduceat(gaps, starts),
+                           'Gaps': np.add.reduceat(is_gap.astype(np.int64), starts),
+                           'First Gap Start': first_gap_start,
+                           'First Gap End': first_gap_end},
+                          index=pd.Index(groups.take(sorted_codes[starts]), name=group))
+    return report
+
+
+@instrumented('integrity')
+def duplicate_report(df, key_list):
+    """
+    Same as utils.check_unique: the keys that identify more than one row. Only the rows flagged by
+    dedup.duplicated_keys are grouped
+
+    :param df: a pandas dataframe
+    :param key_list: a list of variable names (columns or index levels)
+    :return: a dataframe indexed on key_list with the number of rows of each duplicated key in 'Count'.
+    Empty if df is uniquely identified. Keys with a missing value are ignored
+    """
+    keys = key_frame(df, key_list)
+    keys = keys.loc[keys.notnull().all(axis=1).values]
+    ret = keys.loc[duplicated_keys(keys, key_list)].groupby(key_list).size()
+    ret.name = 'Count'
+    return ret.loc[ret > 1].to_frame()
+
+
+def print_continuity(report, name):
+    """
+    Prints how many groups of a continuity report have gaps and the groups with the most gaps
+
+    :return: the rows of report with at least one gap
+    """
+    with_gaps = report.loc[report['Gaps'] > 0]
+    print('{}: {:,} of {:,} Permcos have gaps ({:,} gaps in total)'.format(
+        name, with_gaps.shape[0], report.shape[0], int(with_gaps['Gaps'].sum())))
+    if with_gaps.shape[0] > 0:
+        print(with_gaps.sort_values('Gaps', ascending=False).head(10))
+    return with_gaps
@@ -1,31 +1,64 @@
 from utils import *
+from instrumentation import enable_reports
+from storage import read_frame, write_frame
+from asof import asof_merge
+from schema import apply_schema
+from features_crsp import CRSP_FEATURE_SCHEMA
+from features_compustat import COMPUSTAT_FEATURE_SCHEMA
+from security_master import build_security_master, write_security_master
 
 """
 Description: Merges the CRSP and compustat databases. Final database is "resampled"
 to the monthly CRSP frequency. The fundamental data on a given date is the most recent
-non-null fundamental data from Compustat. Therefore the data lag changes over the
-course of the year.
+Compustat report that was public by that month (see asof.py), so the data lag changes
+over the course of the year.
 
 Author: Lulu
 
 Last Updated: Jan 5, 2018
 """
 
-crsp = pd.read_hdf('../Output/crsp.h5')
-compustat = pd.read_hdf('../Output/compustat.h5')
+REPORT_LAG_MONTHS = 0 # Months between the month of the Report Date and the first month that uses it
+FALLBACK_LAG_MONTHS = 4 # Months after datadate when the Report Date is missing
+MAX_STALENESS_MONTHS = 12 # Fundamentals older than this (from datadate) are left missing
 
-compustat_variables = compustat.columns.tolist()
-print_message('Merging')
-merged = crsp.join(compustat, how = 'left', rsuffix = '.comp') # Use crsp data by default
+# Types of the output (see schema.py). Compustat variables that are also in CRSP get the suffix '.comp'
+MERGED_SCHEMA = dict(CRSP_FEATURE_SCHEMA, **{v + '.comp' if v in CRSP_FEATURE_SCHEMA else v: t
+                                             for v, t in COMPUSTAT_FEATURE_SCHEMA.items()})
 
-# Combine some variables
-# missing = lambda s: pd.isnull(merged[s])
-# merged.loc[missing('Company Name'), 'Company Name'] = merged['Company Name.crsp']
-# merged.safe_drop(['Company Name.crsp'], inplace = True)
 
-print('Final Variables')
-print(merged.columns.tolist())
+def merge_crsp_compustat(crsp, compustat, columns = None):
+    """
+    Adds to every CRSP month the latest public Compustat fundamentals of the same Permco
 
-print_message('Filling NAs')
-merged = merged.groupby(by = ['Permco']).fillna(method = 'ffill')
-merged.to_hdf('../Output/merged.h5', key = 'merged')
\ No newline at end of file
+    :param crsp: the output of features_crsp.py
+    :param compustat: the output of features_compustat.py
+    :param columns: the Compustat variables to add. If None, every variable is added
+    :return: the merged dataframe, indexed on Permco and datadate
+    """
+    print_message('Merging')
+    merged = asof_merge(crsp.sort_index(), compustat, columns = columns, lag_months = REPORT_LAG_MONTHS,
+                        fallback_lag_months = FALLBACK_LAG_MONTHS, max_staleness_months = MAX_STALENESS_MONTHS)
+
+    print('Final Variables')
+    print(merged.columns.tolist())
+    return apply_schema(merged, MERGED_SCHEMA, 'merged')
+
+
+def compustat_window_start(start):
+    """
+    :return: the first Compustat datadate that can still be merged onto the CRSP months from start
+    """
+    if MAX_STALENESS_MONTHS is None:
+        return None
+    return pd.Timestamp(start) + MonthEnd(0) - MonthEnd(MAX_STALENESS_MONTHS)
+
+
+if __name__ == '__main__':
+    enable_reports()
+    crsp = apply_schema(read_frame('crsp'), CRSP_FEATURE_SCHEMA, 'crsp', verbose = False)
+    compustat = apply_schema(read_frame('compustat'), COMPUSTAT_FEATURE_SCHEMA, 'compustat', verbose = False)
+
+    merged = merge_crsp_compustat(crsp, compustat)
+    write_frame(merged, 'merged')
+    write_security_master(build_security_master(merged))
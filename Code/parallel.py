@@ -0,0 +1,191 @@
+"""
+Description: A groupby-apply over several processes that does not pickle the dataframe.
+
+The rows are sorted by group once and every numeric column (and numeric index level) is
+copied into a block of shared memory. Workers attach to those blocks and only receive the
+row offsets of the groups they are responsible for, so the numeric data is never serialized.
+Columns that cannot live in shared memory (strings, categoricals) are sent to each worker for
+its own rows only. Work is split so that each worker gets roughly the same number of rows.
+
+The input dataframe is never modified.
+"""
+
+import time
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from multiprocess import Pool
+
+INDEX_PLACEHOLDER = '__index__'
+
+
+def is_shareable(values):
+    """
+    :return: True if the array can be placed in a block of shared memory
+    """
+    return isinstance(values, np.ndarray) and values.dtype.kind in 'biufcmM'
+
+
+def balanced_cuts(starts, num_rows, num_chunks):
+    """
+    Splits contiguous groups into at most num_chunks chunks with about the same number of rows
+
+    :param starts: a sorted numpy array with the first row of each group
+    :param num_rows: the total number of rows
+    :param num_chunks: the number of chunks wanted
+    :return: a numpy array of group numbers where each chunk starts, ending with the number of groups
+    """
+    targets = num_rows * np.arange(1, num_chunks) / num_chunks
+    cuts = np.searchsorted(starts, targets, side='left')
+    return np.unique(np.r_[0, cuts, len(starts)])
+
+
+def attach(name, dtype, shape):
+    """
+    Opens an existing block of shared memory as a read-only numpy array
+
+    :return: a tuple of the SharedMemory object (which must stay alive) and the array
+    """
+    block = shared_memory.SharedMemory(name=name)
+    array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    array.flags.writeable = False
+    return block, array
+
+
+def run_chunk(task):
+    """
+    Rebuilds the rows of one chunk from shared memory and applies the function to each of its groups.
+    Runs inside a worker process.
+
+    :param task: a dictionary built by shared_parallel_apply
+    :return: a tuple of the result and a dictionary of timings for this chunk
+    """
+    start_time = time.perf_counter()
+    row_start, row_end = task['rows']
+
+    blocks = []
+    columns = {}
+    for v in task['order']:
+        if v in task['shared']:
+            name, dtype, shape = task['shared'][v]
+            block, array = attach(name, dtype, shape)
+            blocks.append(block)
+            columns[v] = array[row_start:row_end]
+        else:
+            columns[v] = task['objects'][v]
+
+    frame = pd.DataFrame(columns, copy=False)
+    if len(task['index_names']) > 0:
+        frame = frame.set_index(task['index_names'])
+        if task['index_names'] == [INDEX_PLACEHOLDER]:
+            frame.index.name = None
+    setup_time = time.perf_counter() - start_time
+
+    f = task['f']
+    kwargs = task['kwargs']
+    print_every_n = task['print_every_n']
+    if print_every_n is not None:
+        counter = [task['groups'][0]]
+
+        def function(dataframe):
+            if counter[0] % print_every_n == 0:
+                print('Group: ' + str(counter[0]))
+            counter[0] += 1
+            return f(dataframe, **kwargs)
+    else:
+        def function(dataframe):
+            return f(dataframe, **kwargs)
+
+    ret = frame.groupby(by=task['group_list']).apply(function)
+    del frame, columns
+    for block in blocks:
+        block.close()
+
+    timing = {'Worker': task['worker'],
+              'Groups': task['groups'][1] - task['groups'][0],
+              'Rows': row_end - row_start,
+              'Setup (s)': setup_time,
+              'Apply (s)': time.perf_counter() - start_time - setup_time}
+    return ret, timing
+
+
+def shared_parallel_apply(df, group_list, f, num_cores, print_every_n=1000, report_timing=True, **kwargs):
+    """
+    Same as df.groupby(group_list).apply(f, **kwargs), spread over num_cores processes that read
+    the numeric data of df from shared memory.
+
+    :param df: the pandas dataframe that needs to be grouped. It is not modified
+    :param group_list: a list of variable names to group by. They can be columns or index levels
+    :param f: the function that operates on dataframes to apply to each grouped dataframe
+    :param num_cores: the number of processes to use
+    :param print_every_n: a message will be printed every print_every_n groups processed.
+    If print_every_n = None, then no messages will be printed
+    :param report_timing: if True, prints the number of groups, rows and seconds spent by each worker
+    :return: the combined result of the apply, in the order of the sorted groups
+    """
+    num_cores = int(num_cores)
+    if df.shape[0] == 0:
+        return df.groupby(by=group_list).apply(f, **kwargs)
+
+    group_numbers = df.groupby(by=group_list, sort=True, dropna=False).ngroup().values
+    order = np.argsort(group_numbers, kind='stable')
+    sorted_groups = group_numbers[order]
+    starts = np.flatnonzero(np.diff(sorted_groups, prepend=-1))
+    num_rows = len(order)
+
+    if print_every_n is not None:
+        print('Total of ' + str(len(starts)) + ' groups')
+
+    # Gather every column and index level in group order
+    index_names = [] if isinstance(df.index, pd.RangeIndex) else \
+        [INDEX_PLACEHOLDER if n is None else n for n in df.index.names]
+    sources = {}
+    for level, name in zip(range(len(index_names)), index_names):
+        sources[name] = df.index.get_level_values(level)
+    for v in df.columns:
+        sources[v] = df[v]
+
+    blocks = []
+    shared = {}
+    objects = {}
+    try:
+        for v, values in sources.items():
+            values = values.values if not isinstance(values, np.ndarray) else values
+            if is_shareable(values) and values.nbytes > 0:
+                block = shared_memory.SharedMemory(create=True, size=values.nbytes)
+                blocks.append(block)
+                np.take(values, order, out=np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf))
+                shared[v] = (block.name, values.dtype, values.shape)
+            else:
+                objects[v] = values[order] if isinstance(values, np.ndarray) else values.take(order)
+
+        cuts = balanced_cuts(starts, num_rows, num_cores)
+        tasks = []
+        for worker in range(len(cuts) - 1):
+            row_start = starts[cuts[worker]]
+            row_end = starts[cuts[worker + 1]] if cuts[worker + 1] < len(starts) else num_rows
+            tasks.append({'worker': worker,
+                          'rows': (row_start, row_end),
+                          'groups': (cuts[worker], cuts[worker + 1]),
+                          'order': list(sources.keys()),
+                          'shared': shared,
+                          'objects': {v: values[row_start:row_end] for v, values in objects.items()},
+                          'index_names': index_names,
+                          'group_list': group_list,
+                          'f': f,
+                          'kwargs': kwargs,
+                          'print_every_n': print_every_n})
+
+        if print_every_n is not None:
+            print('Mapping over: ' + str(len(tasks)) + ' cores')
+        with Pool(num_cores) as p:
+            parallel_results = p.map(run_chunk, tasks)
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    if report_timing:
+        print(pd.DataFrame([timing for _, timing in parallel_results]).set_index('Worker').round(3))
+
+    return pd.concat([result for result, _ in parallel_results])
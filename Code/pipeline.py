@@ -0,0 +1,400 @@
+"""
+Description: Runs the build (write_crsp -> features_crsp, write_compustat -> features_compustat, both
+-> merge_crsp_compustat) as a dependency graph of stages, skipping the stages whose inputs have not
+changed since they last ran.
+
+Each stage declares its upstream stages, the raw files it reads, its parameters and the outputs it
+produces. Its fingerprint is a hash of:
+
+- the content of its raw files (the hash of a file is cached by path, size and modification time)
+- the source of its function, of its module and of every module of this directory it imports
+- its parameters (including the storage format)
+- the fingerprints of its upstream stages
+
+Every output is written to a new versioned artifact, e.g. ../Output/crsp-3f2a9c01b7d4.parquet, and a
+marker in ../Output/pipeline records that the stage finished. A stage whose marker exists for its
+fingerprint is skipped. Stages never overwrite their inputs, so a rerun cannot apply a step twice.
+
+Stages whose upstream stages are done run at the same time in separate processes (the CRSP and
+Compustat branches), up to the number of workers. Outputs are passed between stages through their
+artifacts, not through the processes.
+
+Finally, the artifacts of the last run are published under the names the rest of the code reads
+(crsp, compustat, merged, and the states of incremental.py) by copying them. The artifacts and markers
+of earlier fingerprints are then deleted, unless --keep-artifacts is given.
+
+Usage:
+
+python pipeline.py                 # Builds merged, with up to 2 stages at a time
+python pipeline.py --workers 1     # One stage at a time, in this process
+python pipeline.py --force         # Reruns every stage
+python pipeline.py --keep-artifacts  # Keeps the artifacts of earlier runs
+NUM_WORKERS=4 python pipeline.py   # Sets the default number of workers
+
+To build the stages per group of firms in separate processes, see sharding.py.
+"""
+
+import os
+import re
+import ast
+import json
+import time
+import shutil
+import inspect
+import hashlib
+import argparse
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from utils import print_message
+from instrumentation import start_run, write_run_report, enable_reports
+from storage import OUTPUT_DIR, STORAGE_FORMAT, artifact_path, write_frame, read_frame
+from state import write_state, tail_rows, last_fiscal_year
+from schema import apply_schema
+from write_crsp import load_crsp, build_crsp, verify_crsp, CRSP_SCHEMA
+from write_compustat import load_compustat, deduplicate_compustat, quarterly_cash_flows, verify_compustat, \
+    yearly_variables, COMPUSTAT_SCHEMA
+from features_crsp import add_crsp_features, STATE_VARIABLES, ROLLING_WINDOW, CRSP_FEATURE_SCHEMA
+from features_compustat import add_compustat_features, COMPUSTAT_FEATURE_SCHEMA
+from merge_crsp_compustat import merge_crsp_compustat, REPORT_LAG_MONTHS, FALLBACK_LAG_MONTHS, MAX_STALENESS_MONTHS
+from security_master import build_security_master, MASTER_NAMES
+
+CODE_DIR = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_DIR = os.path.join(OUTPUT_DIR, 'pipeline') # Stage markers and the cache of file hashes
+FINGERPRINT_LENGTH = 12
+NUM_WORKERS = int(os.environ.get('NUM_WORKERS', 2)) # Processes run at the same time, here and in sharding.py
+
+
+################ Stages ################
+
+def run_write_crsp(path = '../Data/crsp.txt'):
+    crsp = build_crsp(load_crsp(path))
+    verify_crsp(crsp)
+    return crsp,
+
+
+def run_features_crsp(crsp):
+    crsp = add_crsp_features(apply_schema(crsp, CRSP_SCHEMA, 'crsp', verbose = False))
+    return crsp, tail_rows(crsp[STATE_VARIABLES], ROLLING_WINDOW - 1)
+
+
+def run_write_compustat(path = '../Data/compustat-merged.txt'):
+    compustat = deduplicate_compustat(load_compustat(path))
+    state = last_fiscal_year(compustat[['Fiscal Year', 'Fiscal Quarter'] + yearly_variables])
+    compustat = quarterly_cash_flows(compustat)
+    verify_compustat(compustat)
+    return compustat, state
+
+
+def run_features_compustat(compustat):
+    return add_compustat_features(apply_schema(compustat, COMPUSTAT_SCHEMA, 'compustat', verbose = False)),
+
+
+def run_merge(crsp, compustat):
+    crsp = apply_schema(crsp, CRSP_FEATURE_SCHEMA, 'crsp', verbose = False)
+    compustat = apply_schema(compustat, COMPUSTAT_FEATURE_SCHEMA, 'compustat', verbose = False)
+    merged = merge_crsp_compustat(crsp, compustat)
+    master = build_security_master(merged)
+    return (merged,) + tuple(master[table] for table in MASTER_NAMES)
+
+
+# 'inputs' are (stage, output) pairs passed to 'function' in order. 'module' is the script whose code the
+# stage runs, 'files' the raw files it reads (the default arguments of 'function', which sharding.py
+# passes before the inputs) and 'parameters' anything else its result depends on. Settings that only change
+# how the result is computed (e.g. the chunk size of the raw files) are left out
+STAGES = {'write_crsp': {'function': run_write_crsp,
+                         'inputs': [],
+                         'outputs': ['crsp_clean'],
+                         'module': 'write_crsp',
+                         'files': ['../Data/crsp.txt'],
+                         'parameters': {}},
+          'features_crsp': {'function': run_features_crsp,
+                            'inputs': [('write_crsp', 'crsp_clean')],
+                            'outputs': ['crsp', 'crsp_state'],
+                            'module': 'features_crsp',
+                            'files': [],
+                            'parameters': {'rolling_window': ROLLING_WINDOW}},
+          'write_compustat': {'function': run_write_compustat,
+                              'inputs': [],
+                              'outputs': ['compustat_clean', 'compustat_state'],
+                              'module': 'write_compustat',
+                              'files': ['../Data/compustat-merged.txt'],
+                              'parameters': {}},
+          'features_compustat': {'function': run_features_compustat,
+                                 'inputs': [('write_compustat', 'compustat_clean')],
+                                 'outputs': ['compustat'],
+                                 'module': 'features_compustat',
+                                 'files': [],
+                                 'parameters': {}},
+          'merge_crsp_compustat': {'function': run_merge,
+                                   'inputs': [('features_crsp', 'crsp'), ('features_compustat', 'compustat')],
+                                   'outputs': ['merged'] + list(MASTER_NAMES.values()),
+                                   'module': 'merge_crsp_compustat',
+                                   'files': [],
+                                   'parameters': {'report_lag_months': REPORT_LAG_MONTHS,
+                                                  'fallback_lag_months': FALLBACK_LAG_MONTHS,
+                                                  'max_staleness_months': MAX_STALENESS_MONTHS}}}
+
+# Outputs copied to the names read by incremental.py and the notebooks, and the states of incremental.py
+PUBLISHED = ['crsp', 'compustat', 'merged'] + list(MASTER_NAMES.values())
+PUBLISHED_STATES = {'crsp_state': 'crsp', 'compustat_state': 'compustat'}
+
+
+################ Fingerprints ################
+
+def file_hash(path, cache):
+    """
+    :param path: the path of a file
+    :param cache: a dictionary of earlier hashes, keyed by path, updated in place
+    :return: the sha256 of the content of the file, or 'missing' if it does not exist
+    """
+    if not os.path.exists(path):
+        return 'missing'
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    if key in cache and cache[key]['size'] == stat.st_size and cache[key]['mtime'] == stat.st_mtime_ns:
+        return cache[key]['hash']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(2 ** 24), b''):
+            digest.update(block)
+    cache[key] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+    return cache[key]['hash']
+
+
+def local_imports(module, code_dir = CODE_DIR, found = None):
+    """
+    :param module: the name of a module of code_dir
+    :return: the sorted names of module and of every module of code_dir it imports, directly or not
+    """
+    found = set() if found is None else found
+    path = os.path.join(code_dir, module + '.py')
+    if module in found or not os.path.exists(path):
+        return sorted(found)
+    found.add(module)
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module is not None:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            local_imports(name.split('.')[0], code_dir, found)
+    return sorted(found)
+
+
+def code_hash(module):
+    """
+    :return: the sha256 of the source of module and of the modules of this directory it imports
+    """
+    digest = hashlib.sha256()
+    for name in local_imports(module):
+        with open(os.path.join(CODE_DIR, name + '.py'), 'rb') as f:
+            digest.update(name.encode() + b'\0' + f.read())
+    return digest.hexdigest()
+
+
+def stage_fingerprints(stages, file_cache):
+    """
+    :param stages: a dictionary of stages (see STAGES)
+    :param file_cache: the cache of file hashes (see file_hash)
+    :return: a dictionary of stage name to its fingerprint
+    """
+    fingerprints = {}
+    for name in topological_order(stages):
+        stage = stages[name]
+        description = {'stage': name,
+                       'files': {path: file_hash(path, file_cache) for path in stage['files']},
+                       'code': code_hash(stage['module']),
+                       'function': hashlib.sha256(inspect.getsource(stage['function']).encode()).hexdigest(),
+                       'parameters': dict(stage['parameters'], storage_format = STORAGE_FORMAT),
+                       'inputs': sorted({upstream: fingerprints[upstream] for upstream, _ in stage['inputs']}.items())}
+        encoded = json.dumps(description, sort_keys = True, default = str).encode()
+        fingerprints[name] = hashlib.sha256(encoded).hexdigest()[:FINGERPRINT_LENGTH]
+    return fingerprints
+
+
+def topological_order(stages):
+    """
+    :return: the names of the stages, each after the stages it depends on
+    """
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in order:
+            return
+        assert name not in visiting, 'The stages have a cycle through ' + name
+        visiting.add(name)
+        for upstream, _ in stages[name]['inputs']:
+            visit(upstream)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+################ Running ################
+
+def versioned_name(output, fingerprint):
+    return output + '-' + fingerprint
+
+
+def marker_path(stage, fingerprint):
+    return os.path.join(PIPELINE_DIR, versioned_name(stage, fingerprint) + '.json')
+
+
+def is_cached(stage, fingerprint):
+    """
+    :return: True if the stage finished with this fingerprint and its artifacts are still there
+    """
+    if not os.path.exists(marker_path(stage, fingerprint)):
+        return False
+    return all(os.path.exists(artifact_path(versioned_name(output, fingerprint)))
+               for output in STAGES[stage]['outputs'])
+
+
+def run_stage(stage, fingerprint, input_artifacts):
+    """
+    Runs one stage: reads its inputs, calls its function and writes its outputs as versioned artifacts
+
+    :param stage: the name of the stage
+    :param fingerprint: the fingerprint of the stage
+    :param input_artifacts: the names of the artifacts of its inputs, in order
+    :return: the wall time of the stage in seconds
+    """
+    start = time.perf_counter()
+    start_run('pipeline-' + stage) # Forked workers do not write reports at exit, so each stage writes its own
+    print_message('Running ' + stage + ' (' + fingerprint + ')')
+    inputs = [read_frame(artifact) for artifact in input_artifacts]
+    outputs = STAGES[stage]['function'](*inputs)
+    for output, frame in zip(STAGES[stage]['outputs'], outputs):
+        write_frame(frame, versioned_name(output, fingerprint))
+
+    elapsed = time.perf_counter() - start
+    report = write_run_report(reset = True)
+    start_run('pipeline')
+    os.makedirs(PIPELINE_DIR, exist_ok = True)
+    with open(marker_path(stage, fingerprint), 'w') as f:
+        json.dump({'stage': stage, 'fingerprint': fingerprint, 'inputs': input_artifacts,
+                   'outputs': [versioned_name(o, fingerprint) for o in STAGES[stage]['outputs']],
+                   'seconds': elapsed, 'report': report, 'finished': str(datetime.now())}, f, indent = 2)
+    return elapsed
+
+
+def run_pipeline(num_workers = NUM_WORKERS, force = False):
+    """
+    Runs the stages that are not cached, each once its upstream stages are done
+
+    :param num_workers: the number of stages that can run at the same time. 1 runs them in this process
+    :param force: if True, reruns every stage
+    :return: a dictionary of stage name to fingerprint
+    """
+    cache_path = os.path.join(PIPELINE_DIR, 'file_hashes.json')
+    file_cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            file_cache = json.load(f)
+    fingerprints = stage_fingerprints(STAGES, file_cache)
+    os.makedirs(PIPELINE_DIR, exist_ok = True)
+    with open(cache_path, 'w') as f:
+        json.dump(file_cache, f, indent = 2)
+
+    pending = [s for s in topological_order(STAGES) if force or not is_cached(s, fingerprints[s])]
+    for s in STAGES:
+        if s not in pending:
+            print_message('Skipping ' + s + ' (cached as ' + fingerprints[s] + ')')
+
+    def ready(s, done):
+        return all(upstream in done for upstream, _ in STAGES[s]['inputs'])
+
+    def arguments(s):
+        return s, fingerprints[s], [versioned_name(o, fingerprints[u]) for u, o in STAGES[s]['inputs']]
+
+    done = set(STAGES) - set(pending)
+    if num_workers <= 1:
+        for s in pending:
+            run_stage(*arguments(s))
+        return fingerprints
+
+    running = {}
+    with ProcessPoolExecutor(max_workers = num_workers) as executor:
+        while pending or running:
+            for s in [s for s in pending if ready(s, done)][:num_workers - len(running)]:
+                running[executor.submit(run_stage, *arguments(s))] = s
+                pending.remove(s)
+            finished, _ = wait(running, return_when = FIRST_COMPLETED)
+            for future in finished:
+                future.result() # Raises the error of a failed stage
+                done.add(running.pop(future))
+    return fingerprints
+
+
+def publish(fingerprints):
+    """
+    Copies the artifacts of the last run to the names read by the rest of the code
+    """
+    producers = {output: stage for stage in STAGES for output in STAGES[stage]['outputs']}
+    for output in PUBLISHED:
+        source = artifact_path(versioned_name(output, fingerprints[producers[output]]))
+        target = artifact_path(output)
+        if os.path.isdir(target):
+            shutil.rmtree(target)
+        elif os.path.exists(target):
+            os.remove(target)
+        if os.path.isdir(source):
+            shutil.copytree(source, target)
+        else:
+            # HDF artifacts store the frame under their own name, so they are rewritten under the published one
+            write_frame(read_frame(versioned_name(output, fingerprints[producers[output]])), output)
+    for output, name in PUBLISHED_STATES.items():
+        write_state(read_frame(versioned_name(output, fingerprints[producers[output]])), name)
+    print_message('Published ' + ', '.join(PUBLISHED))
+
+
+def prune(fingerprints):
+    """
+    Deletes the versioned artifacts (in any storage format) and the markers of earlier fingerprints of the
+    stages. The published outputs and the cache of file hashes are kept
+
+    :param fingerprints: a dictionary of stage name to its current fingerprint
+    :return: the list of the deleted paths
+    """
+    producers = {output: stage for stage in STAGES for output in STAGES[stage]['outputs']}
+    current = {output: fingerprints[stage] for output, stage in producers.items()}
+    versioned = re.compile(r'^(.+)-([0-9a-f]{' + str(FINGERPRINT_LENGTH) + r'})\.[a-z0-9]+$')
+
+    deleted = []
+    for directory, names in [(OUTPUT_DIR, current), (PIPELINE_DIR, fingerprints)]:
+        if not os.path.isdir(directory):
+            continue
+        for entry in sorted(os.listdir(directory)):
+            match = versioned.match(entry)
+            if match is None or match.group(1) not in names or match.group(2) == names[match.group(1)]:
+                continue
+            path = os.path.join(directory, entry)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+            deleted.append(path)
+    print_message('Deleted ' + str(len(deleted)) + ' artifacts and markers of earlier runs')
+    return deleted
+
+
+if __name__ == '__main__':
+    enable_reports()
+    parser = argparse.ArgumentParser(description = 'Builds the outputs, skipping the stages that are up to date')
+    parser.add_argument('--workers', type = int, default = NUM_WORKERS, help = 'number of stages run at the same time')
+    parser.add_argument('--force', action = 'store_true', help = 'rerun every stage')
+    parser.add_argument('--keep-artifacts', action = 'store_true', help = 'keep the artifacts of earlier runs')
+    args = parser.parse_args()
+
+    fingerprints = run_pipeline(args.workers, args.force)
+    publish(fingerprints)
+    if not args.keep_artifacts:
+        prune(fingerprints)
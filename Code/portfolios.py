@@ -0,0 +1,158 @@
+"""
+Description: Portfolio sorts on the merged panel (e.g. momentum and size deciles).
+
+Stocks are assigned to quantile portfolios on every datadate from the breakpoints of
+quantiles.grouped_weighted_quantile, which computes the breakpoints of all dates at once
+(optionally from the stocks of some exchanges only, e.g. NYSE breakpoints). A dependent double
+sort computes the breakpoints of the second variable within each date and portfolio of the first.
+Portfolio returns are sums over integer portfolio codes (np.bincount), so no step loops over dates.
+
+The sorting variables must be known at the start of the month of the return they are used for,
+e.g. 'Return Momentum' and 'Lagged Market Cap' from add_sort_variables.
+
+Usage:
+
+merged = add_sort_variables(read_frame('merged'))
+merged[['Momentum Portfolio', 'Size Portfolio']] = double_sort(merged, 'Return Momentum', 'Lagged Market Cap',
+                                                               10, 10, exchange_codes = [1])
+returns = portfolio_returns(merged, ['Momentum Portfolio', 'Size Portfolio'])
+"""
+
+import numpy as np
+import pandas as pd
+from quantiles import grouped_weighted_quantile
+from integrity import variable_array
+from dedup import key_codes
+from features import build_features
+
+SIZE = 'Market Cap (Billions, CRSP)'
+
+# Lagged variables of the Sorting by Momentum notebook (see features.py)
+SORT_FEATURES = {'Lagged Market Cap': ('lag', SIZE, 1),
+                 'Cumulative Return at t - 3': ('lag', 'Cumulative Return', 3),
+                 'Cumulative Return at t - 13': ('lag', 'Cumulative Return', 13)}
+
+
+def add_sort_variables(merged):
+    """
+    Adds the sorting variables of the Sorting by Momentum notebook: 'Lagged Market Cap' (last month's market
+    cap) and 'Return Momentum' (the log return from 13 months ago to 3 months ago)
+
+    :param merged: the merged panel, indexed on Permco and datadate
+    :return: merged sorted on its index, with the new variables
+    """
+    merged = merged.sort_index()
+    features = build_features(merged, SORT_FEATURES)
+    merged['Lagged Market Cap'] = features['Lagged Market Cap']
+    merged['Return Momentum'] = features['Cumulative Return at t - 3'] - features['Cumulative Return at t - 13']
+    return merged
+
+
+def assign_portfolios(df, variable, num_portfolios, date_variable='datadate', exchange_codes=None,
+                      exchange_variable='Exchange Code', weight_variable=None, within=None):
+    """
+    Assigns every row to a quantile portfolio of variable among the rows of the same date
+
+    :param df: a pandas dataframe. date_variable can be a column or an index level
+    :param variable: the sorting variable
+    :param num_portfolios: the number of portfolios (10 for deciles)
+    :param date_variable: the variable that defines the cross sections
+    :param exchange_codes: a list of exchange codes whose stocks set the breakpoints (e.g. [1] for NYSE), or
+    None for every stock. Every stock is then assigned to a portfolio
+    :param exchange_variable: the variable with the exchange codes
+    :param weight_variable: if given, the breakpoints split this variable (e.g. 'Lagged Market Cap') equally
+    across portfolios instead of the number of stocks
+    :param within: the name of a portfolio variable to sort within (a dependent double sort), or None
+    :return: a float Series aligned with df with the portfolio of each row, from 1 (lowest) to num_portfolios.
+    A stock equal to a breakpoint goes to the lower portfolio. Missing if variable is missing or if there
+    are no breakpoints for the row's date
+    """
+    key_list = [date_variable] + ([] if within is None else [within])
+    groups, _ = key_codes(df, key_list)
+    values = df[variable].to_numpy(dtype=np.float64, na_value=np.nan)
+    mask = np.ones(len(values), dtype=bool)
+    if exchange_codes is not None:
+        mask &= np.asarray(df[exchange_variable].isin(exchange_codes))
+    if within is not None:
+        mask &= df[within].notnull().values
+    weights = None if weight_variable is None else df[weight_variable].values
+
+    quantiles = np.arange(1, num_portfolios) / num_portfolios
+    breaks = grouped_weighted_quantile(values, quantiles, groups, weights, mask)
+
+    # Count the breakpoints of the row's group that are below the row's value, one breakpoint at a time
+    portfolio = np.full(len(values), np.nan)
+    if breaks.shape[0] > 0:
+        group_values = breaks.index.values
+        rows = np.minimum(np.searchsorted(group_values, groups), len(group_values) - 1)
+        valid = (group_values[rows] == groups) & ~np.isnan(values)
+        below = np.zeros(len(values), dtype=np.int64)
+        for ind in range(len(quantiles)):
+            row_breaks = breaks.values[rows, ind]
+            valid &= ~np.isnan(row_breaks)
+            below += row_breaks < values
+        portfolio[valid] = 1 + below[valid]
+    return pd.Series(portfolio, index=df.index, name=variable + ' Portfolio')
+
+
+def double_sort(df, first, second, num_first, num_second, dependent=False, **kwargs):
+    """
+    Sorts every date on two variables
+
+    :param df: a pandas dataframe
+    :param first: the first sorting variable
+    :param second: the second sorting variable
+    :param num_first: the number of portfolios of first
+    :param num_second: the number of portfolios of second
+    :param dependent: if True, the breakpoints of second are computed within each portfolio of first.
+    Otherwise both sorts are independent
+    :param kwargs: the other arguments of assign_portfolios (date_variable, exchange_codes, ...)
+    :return: a dataframe aligned with df with the portfolios of first and second
+    """
+    ret = pd.DataFrame(index=df.index)
+    ret[first + ' Portfolio'] = assign_portfolios(df, first, num_first, **kwargs)
+    if dependent:
+        df = df.assign(**{first + ' Portfolio': ret[first + ' Portfolio']})
+        ret[second + ' Portfolio'] = assign_portfolios(df, second, num_second, within=first + ' Portfolio', **kwargs)
+    else:
+        ret[second + ' Portfolio'] = assign_portfolios(df, second, num_second, **kwargs)
+    return ret
+
+
+def portfolio_returns(df, portfolio_variables, return_variable='Return', weight_variable='Lagged Market Cap',
+                      date_variable='datadate'):
+    """
+    Equal and value weighted returns of every portfolio on every date
+
+    :param df: a pandas dataframe with the portfolio variables (see assign_portfolios)
+    :param portfolio_variables: a list of portfolio variables
+    :param return_variable: the variable with the returns
+    :param weight_variable: the variable with the weights of the value weighted returns
+    :param date_variable: the date of each return (column or index level)
+    :return: a dataframe indexed on date_variable and portfolio_variables with 'Equal Weighted Return',
+    'Value Weighted Return' and 'Count' (the number of stocks). Rows with a missing portfolio or return
+    are ignored, and rows with a missing weight are left out of the value weighted return
+    """
+    key_list = [date_variable] + list(portfolio_variables)
+    returns = df[return_variable].to_numpy(dtype=np.float64, na_value=np.nan)
+    valid = ~np.isnan(returns) & df[list(portfolio_variables)].notnull().all(axis=1).values
+    codes, _ = key_codes(df, key_list)
+    codes, uniques = pd.factorize(codes[valid])
+    returns = returns[valid]
+    weights = df[weight_variable].to_numpy(dtype=np.float64, na_value=np.nan)[valid]
+    weights = np.where(np.isnan(weights), 0, weights)
+
+    counts = np.bincount(codes, minlength=len(uniques))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ret = pd.DataFrame({'Equal Weighted Return': np.bincount(codes, returns, len(uniques)) / counts,
+                            'Value Weighted Return': np.bincount(codes, returns * weights, len(uniques)) /
+                                                     np.bincount(codes, weights, len(uniques)),
+                            'Count': counts})
+
+    # The keys of each portfolio, from its first row
+    first_rows = np.empty(len(uniques), dtype=np.int64)
+    first_rows[codes[::-1]] = np.arange(len(codes))[::-1]
+    first_rows = np.flatnonzero(valid)[first_rows]
+    ret.index = pd.MultiIndex.from_arrays([np.asarray(variable_array(df, v))[first_rows] for v in key_list],
+                                          names=key_list)
+    return ret.sort_index()
@@ -0,0 +1,112 @@
+"""
+Description: Weighted quantiles of a variable for many groups (usually dates) in one call, e.g.
+the market cap weighted size breakpoints of every month.
+
+The rows are sorted once by group and value. Cumulative weights are computed for every group
+at once, and each quantile is found by counting, in every group, the rows whose cumulative
+weight share is below it. The result is the same as utils.weighted_quantile applied to each
+group: the smallest value whose cumulative weight share reaches the quantile (the 'next'
+interpolation of scipy's interp1d).
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def group_value_order(values, codes):
+    """
+    Sorts values by group, then by value, like np.lexsort((values, codes)) up to the order of equal values.
+    The values are replaced by their rank, so that the group and the rank fit in a single integer key
+
+    :param values: a float numpy array without missing values
+    :param codes: an integer numpy array with the group of every value, from 0 to the number of groups - 1
+    :return: the integer numpy array of the positions of the sorted values
+    """
+    ranks = np.empty(len(values), dtype=np.int64)
+    ranks[np.argsort(values)] = np.arange(len(values))
+    return np.argsort(codes.astype(np.int64) * len(values) + ranks)
+
+
+def grouped_weighted_quantile(values, quantiles, groups, sample_weight=None, mask=None):
+    """
+    Computes weighted quantiles of values within each group
+
+    :param values: a numpy array-like of floats
+    :param quantiles: a list of quantiles in [0, 1]
+    :param groups: a numpy array-like of the group of each value (e.g. datadates)
+    :param sample_weight: a numpy array-like of non-negative weights. If None, every row weighs the same
+    :param mask: a boolean numpy array-like of the rows used to compute the quantiles (e.g. NYSE stocks).
+    If None, every row is used
+    :return: a dataframe indexed on the sorted groups with one column per quantile. Rows with a missing
+    value or weight are ignored, and groups without any row are left out. Groups whose weights add up
+    to zero are missing
+
+    Usage:
+
+    x = np.array([-5, 1, 2, 2, 10, 3, 4])
+    ret = grouped_weighted_quantile(x, [0, 0.5, 1], np.array([1, 1, 1, 1, 1, 2, 2]))
+    assert(np.all(ret.loc[1].values == weighted_quantile(x[:5], [0, 0.5, 1])))
+    """
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    assert np.all(quantiles >= 0) and np.all(quantiles <= 1), 'quantiles should be in [0, 1]'
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.ones(len(values)) if sample_weight is None else np.asarray(sample_weight, dtype=np.float64)
+    groups = np.asarray(groups)
+
+    keep = ~np.isnan(values) & ~np.isnan(weights)
+    if mask is not None:
+        keep &= np.asarray(mask, dtype=bool)
+    assert np.all(weights[keep] >= 0), 'weights should be non-negative'
+    codes, uniques = pd.factorize(groups[keep], sort=True)
+    if len(uniques) == 0:
+        return pd.DataFrame(columns=quantiles, index=uniques)
+
+    order = group_value_order(values[keep], codes)
+    sorted_values = values[keep][order]
+    sorted_weights = weights[keep][order]
+    sorted_codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    ends = np.r_[starts[1:], len(order)]
+
+    # Cumulative weight share of each row within its group
+    cumulative = np.cumsum(sorted_weights)
+    before_group = cumulative[starts] - sorted_weights[starts]
+    cumulative -= before_group[sorted_codes]
+    totals = cumulative[ends - 1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = cumulative / totals[sorted_codes]
+
+    ret = np.empty((len(starts), len(quantiles)))
+    for ind, q in enumerate(quantiles):
+        below = np.add.reduceat((share < q).astype(np.int64), starts)
+        ret[:, ind] = sorted_values[np.minimum(starts + below, ends - 1)]
+    ret[totals <= 0] = np.nan
+
+    return pd.DataFrame(ret, index=uniques, columns=quantiles)
+
+
+def breakpoints(df, variable, quantiles, weight_variable=None, date_variable='datadate', exchange_codes=None,
+                exchange_variable='Exchange Code'):
+    """
+    Weighted quantiles of variable on every date, optionally from the stocks of some exchanges only
+
+    :param df: a pandas dataframe, e.g. merged. date_variable can be a column or an index level
+    :param variable: the variable whose quantiles are computed
+    :param quantiles: a list of quantiles in [0, 1]
+    :param weight_variable: the variable used as weights, or None for equal weights
+    :param date_variable: the variable that defines the cross sections
+    :param exchange_codes: a list of exchange codes whose stocks set the breakpoints (e.g. [1] for NYSE),
+    or None for every stock
+    :param exchange_variable: the variable with the exchange codes
+    :return: a dataframe indexed on date_variable with one column per quantile
+
+    Usage:
+
+    nyse_size = breakpoints(merged, 'Market Cap (Billions, CRSP)', [0.1, 0.5, 0.9], exchange_codes=[1])
+    """
+    dates = df[date_variable].values if date_variable in df.columns else df.index.get_level_values(date_variable)
+    mask = None if exchange_codes is None else df[exchange_variable].isin(exchange_codes).values
+    weights = None if weight_variable is None else df[weight_variable].values
+    ret = grouped_weighted_quantile(df[variable].values, quantiles, dates, weights, mask)
+    ret.index.name = date_variable
+    return ret
@@ -0,0 +1,140 @@
+"""
+Description: Compact dtypes for the CRSP and Compustat panels.
+
+The type dictionaries of the build scripts (crsp_datatypes, compustat_datatypes) declare the
+type of every raw variable. On top of the original keys, they can use:
+
+'float32_vars' - floats stored in single precision (prices, fundamentals). Returns and
+adjustment factors stay in 'float_vars' (double precision) because they are compounded.
+'nullable_int_vars' - identifiers stored as nullable Int32 (Permno, Gvkey, NAICS), so that a
+missing value does not turn the whole column into floats.
+'category_vars' - labels with few distinct values (names, tickers, currencies). Codes that
+are compared with numbers, such as exchange codes, stay in 'int_vars', where they are
+downcast to the smallest integer type.
+
+clean_data applies these types at ingest. Each stage then declares the schema of its output
+(a dictionary of variable name to dtype) and passes its output through apply_schema before
+writing it and after reading it, which casts the declared variables and raises if a variable
+does not match its declared type.
+"""
+
+import numpy as np
+import pandas as pd
+
+# The dtype of the variables of each key of a type dictionary. None means any numeric type
+TYPE_KEYS = {'date_vars': 'datetime',
+             'exact_date_vars': 'datetime',
+             'float_vars': 'float64',
+             'float32_vars': 'float32',
+             'nullable_int_vars': 'Int32',
+             'category_vars': 'category',
+             'int_vars': None}
+
+
+def schema_from_types(type_dict, names=None):
+    """
+    Builds a schema from a type dictionary in the format used by clean_data
+
+    :param type_dict: a dictionary with some of the keys of TYPE_KEYS
+    :param names: a dictionary to rename the raw variables (e.g. crsp_names). Variables that are not
+    in names are dropped. If None, the raw names are kept
+    :return: a dictionary of variable name to dtype
+    """
+    schema = {}
+    for key, variables in type_dict.items():
+        for v in variables:
+            if names is None:
+                schema[v] = TYPE_KEYS[key]
+            elif v in names:
+                schema[names[v]] = TYPE_KEYS[key]
+    return schema
+
+
+def matches(values, dtype):
+    """
+    :return: True if the Series values has the declared dtype
+    """
+    if dtype is None:
+        return pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values)
+    if dtype == 'datetime':
+        return pd.api.types.is_datetime64_any_dtype(values)
+    if dtype == 'category':
+        return isinstance(values.dtype, pd.CategoricalDtype)
+    return values.dtype == pd.api.types.pandas_dtype(dtype)
+
+
+def cast(values, dtype):
+    """
+    :return: the Series values converted to the declared dtype
+    """
+    if dtype is None or matches(values, dtype):
+        return values
+    if dtype == 'datetime':
+        return pd.to_datetime(values)
+    if dtype == 'Int32' and pd.api.types.is_float_dtype(values):
+        # Floats can only become integers if they hold whole numbers
+        return pd.array(values.to_numpy(dtype=np.float64), dtype='Float64').astype('Int32')
+    return values.astype(dtype)
+
+
+def validate_schema(df, schema, name=''):
+    """
+    Checks that every variable of df that is declared in schema has its declared type
+
+    :param df: a pandas dataframe
+    :param schema: a dictionary of variable name to dtype
+    :param name: the name of the stage, used in the error message
+    :return: df, unchanged
+    """
+    wrong = ['{} ({}, declared {})'.format(v, df[v].dtype, schema[v]) for v in df.columns
+             if v in schema and not matches(df[v], schema[v])]
+    if len(wrong) > 0:
+        raise TypeError('Variables of ' + name + ' that do not match the schema: ' + ', '.join(wrong))
+    return df
+
+
+def column_memory(df):
+    """
+    :return: a Series with the memory in bytes of every column of df
+    """
+    return df.memory_usage(deep=True, index=False)
+
+
+def memory_report(before, after):
+    """
+    Compares the memory used by each column before and after a change of types
+
+    :param before: a Series of bytes per column (see column_memory)
+    :param after: a Series of bytes per column
+    :return: a dataframe with the megabytes before and after for every column and the total
+    """
+    report = pd.DataFrame({'Before (MB)': before, 'After (MB)': after}) / 2 ** 20
+    report.loc['Total'] = report.sum()
+    report['Ratio'] = report['After (MB)'] / report['Before (MB)']
+    return report.round(3)
+
+
+def apply_schema(df, schema, name='', verbose=True):
+    """
+    Casts the variables of df that are declared in schema to their declared types, then validates them
+
+    :param df: a pandas dataframe. It is not modified
+    :param schema: a dictionary of variable name to dtype
+    :param name: the name of the stage, used in messages
+    :param verbose: if True, prints the memory of every column before and after
+    :return: a dataframe with the declared types
+
+    Usage:
+
+    crsp = apply_schema(crsp, CRSP_SCHEMA, 'crsp')
+    """
+    before = column_memory(df) if verbose else None
+    ret = df.copy(deep=False)
+    for v in ret.columns:
+        if v in schema:
+            ret[v] = cast(ret[v], schema[v])
+
+    if verbose:
+        print('Memory of ' + name + ' by variable')
+        print(memory_report(before, column_memory(ret)).to_string())
+    return validate_schema(ret, schema, name)
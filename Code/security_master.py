@@ -0,0 +1,257 @@
+"""
+Description: Security master of the merged panel, so that a firm can be found from its ticker or
+Gvkey and read on its own, without scanning or loading the whole panel.
+
+It is built from merged when it is written (merge_crsp_compustat.py, incremental.py, pipeline.py) and
+stored next to it as three small outputs:
+
+'tickers' (security_master_tickers) - one row per run of months in which a Permco traded under a
+Ticker: Ticker, Permco, Company Name, Start and End (first and last datadate). Sorted by Ticker and Start.
+'permcos' (security_master_permcos) - one row per Permco: the positions of its first and last rows in
+merged sorted on Permco and datadate (First Row, Last Row), Start and End. Sorted by Permco.
+'links' (security_master_links) - one row per run of months in which a Permco was matched to a
+Compustat Gvkey: Gvkey, Permco, Start and End. Sorted by Gvkey and Start.
+
+Every lookup is a binary search (np.searchsorted) on the sorted keys of a table. A firm is then a
+slice of rows of the panel in memory (firm_frame), or a read of only its rows (read_firm): a
+start/stop read of the HDF file, or the Parquet year partitions of its dates filtered on its Permco.
+
+Usage:
+
+master = load_security_master()
+find_permcos(master, 'AAPL')
+permco = lookup_ticker(master, 'FB', '2015-06-30')
+firm = read_firm(master, permco, columns = ['Cumulative Return', 'Market Cap (Billions, CRSP)'])
+"""
+
+import numpy as np
+import pandas as pd
+from storage import OUTPUT_DIR, STORAGE_FORMAT, DATE_VARIABLE, PARTITION_VARIABLE, artifact_path, write_frame, \
+    read_frame
+from integrity import variable_array
+
+MASTER_NAMES = {'tickers': 'security_master_tickers',
+                'permcos': 'security_master_permcos',
+                'links': 'security_master_links'}
+MASTER_VARIABLES = ['Ticker', 'Company Name', 'Gvkey'] # Variables of merged the tables are built from
+
+# Sort keys of each table. Lookups search the first one
+MASTER_KEYS = {'tickers': ['Ticker', 'Start'],
+               'permcos': ['Permco'],
+               'links': ['Gvkey', 'Start']}
+
+
+def group_starts(values):
+    """
+    :return: the positions of the first rows of the runs of equal consecutive values
+    """
+    return np.flatnonzero(np.r_[True, values[1:] != values[:-1]]) if len(values) > 0 else np.zeros(0, dtype=np.int64)
+
+
+def group_ends(starts, num_rows):
+    """
+    :return: the positions of the last rows of the runs that start at starts
+    """
+    return np.r_[starts[1:], num_rows][:len(starts)] - 1
+
+
+def runs(panel, variable):
+    """
+    Finds the runs of consecutive rows of each Permco with the same value of variable
+
+    :param panel: a dataframe sorted on Permco and datadate
+    :param variable: the variable, e.g. 'Ticker'. Rows where it is missing are not part of any run
+    :return: a dataframe with variable (as Python objects), 'Permco', 'Start' and 'End' (the first and
+    last datadate of each run) and 'First Row' (the position of the first row of the run)
+    """
+    permcos = np.asarray(variable_array(panel, 'Permco'))
+    dates = np.asarray(variable_array(panel, DATE_VARIABLE))
+    codes, _ = pd.factorize(panel[variable])
+
+    # A run starts at a new Permco or a new value; missing values (code -1) are dropped afterwards
+    starts = group_starts(permcos.astype(np.int64) * (codes.max(initial=0) + 2) + codes)
+    ends = group_ends(starts, len(codes))
+    keep = codes[starts] >= 0
+    starts, ends = starts[keep], ends[keep]
+    return pd.DataFrame({variable: pd.Series(panel[variable].to_numpy(dtype=object)[starts], dtype=object),
+                         'Permco': permcos[starts],
+                         'Start': dates[starts],
+                         'End': dates[ends],
+                         'First Row': starts})
+
+
+def build_security_master(merged):
+    """
+    :param merged: the merged panel (or its variables in MASTER_VARIABLES), indexed on Permco and datadate
+    and sorted on its index
+    :return: a dictionary of table name ('tickers', 'permcos', 'links') to dataframe (see the description)
+    """
+    assert merged.index.is_monotonic_increasing, 'merged should be sorted on its index'
+
+    tickers = runs(merged, 'Ticker')
+    tickers['Company Name'] = pd.Series(merged['Company Name'].to_numpy(dtype=object)[tickers['First Row'].values],
+                                        dtype=object)
+    tickers = tickers[['Ticker', 'Permco', 'Company Name', 'Start', 'End']]
+
+    permcos = np.asarray(variable_array(merged, 'Permco'))
+    dates = np.asarray(variable_array(merged, DATE_VARIABLE))
+    starts = group_starts(permcos)
+    ends = group_ends(starts, len(permcos))
+    permcos = pd.DataFrame({'Permco': permcos[starts],
+                            'First Row': starts,
+                            'Last Row': ends,
+                            'Start': dates[starts],
+                            'End': dates[ends]})
+
+    links = runs(merged, 'Gvkey')[['Gvkey', 'Permco', 'Start', 'End']]
+    links['Gvkey'] = links['Gvkey'].astype(np.int64)
+
+    ret = {'tickers': tickers, 'permcos': permcos, 'links': links}
+    return {table: df.sort_values(MASTER_KEYS[table], kind='stable').reset_index(drop=True)
+            for table, df in ret.items()}
+
+
+def write_security_master(master, fmt=None, output_dir=OUTPUT_DIR):
+    """
+    Writes the tables of build_security_master next to merged
+
+    :return: the list of paths written
+    """
+    return [write_frame(master[table], name, fmt=fmt, output_dir=output_dir, partition_by_year=False)
+            for table, name in MASTER_NAMES.items()]
+
+
+def update_security_master(name='merged', fmt=None, output_dir=OUTPUT_DIR):
+    """
+    Rebuilds the security master from the stored merged output, reading only MASTER_VARIABLES. Called
+    after merged is written or appended to
+
+    :return: the security master (see build_security_master)
+    """
+    merged = read_frame(name, columns=MASTER_VARIABLES, fmt=fmt, output_dir=output_dir)
+    master = build_security_master(merged)
+    write_security_master(master, fmt=fmt, output_dir=output_dir)
+    return master
+
+
+def load_security_master(fmt=None, output_dir=OUTPUT_DIR):
+    """
+    :return: the security master written by write_security_master, with the tickers as plain Python strings
+    so that they can be searched without conversion
+    """
+    ret = {table: read_frame(name, fmt=fmt, output_dir=output_dir).reset_index(drop=True)
+           for table, name in MASTER_NAMES.items()}
+    for variable in ['Ticker', 'Company Name']:
+        ret['tickers'][variable] = ret['tickers'][variable].astype(object)
+    return ret
+
+
+def key_range(master, table, value):
+    """
+    :return: the positions (first, last + 1) of the rows of a table whose first key is value
+    """
+    keys = master[table][MASTER_KEYS[table][0]].values
+    return np.searchsorted(keys, value, side='left'), np.searchsorted(keys, value, side='right')
+
+
+def covering(rows, date):
+    """
+    :return: the rows of a table of runs that cover date, or the latest run if date is None
+    """
+    if date is None:
+        return rows.sort_values('End', ascending=False, kind='stable').iloc[:1]
+    date = pd.Timestamp(date)
+    return rows.loc[(rows['Start'] <= date).values & (rows['End'] >= date).values]
+
+
+def find_permcos(master, ticker):
+    """
+    Same as find_permcos of the Data Explorer notebook
+
+    :return: the runs of every Permco that traded under ticker, the most recent first
+    """
+    first, last = key_range(master, 'tickers', ticker)
+    return master['tickers'].iloc[first:last].sort_values('End', ascending=False, kind='stable')
+
+
+def lookup_ticker(master, ticker, date=None):
+    """
+    :param ticker: a CRSP ticker
+    :param date: the date on which the ticker was used. If None, the latest Permco to use the ticker
+    :return: the Permco that traded under ticker on date
+    """
+    matches = covering(find_permcos(master, ticker), date)
+    if matches.shape[0] == 0:
+        raise KeyError('No Permco traded under ' + str(ticker) + ('' if date is None else ' on ' + str(date)))
+    return matches['Permco'].values[0]
+
+
+def gvkey_permcos(master, gvkey, date=None):
+    """
+    :return: the links of a Gvkey to Permcos, only those that cover date if it is given
+    """
+    first, last = key_range(master, 'links', gvkey)
+    rows = master['links'].iloc[first:last]
+    return rows if date is None else covering(rows, date)
+
+
+def permco_gvkeys(master, permco):
+    """
+    :return: the links of a Permco to Gvkeys. The links table is small enough to be filtered
+    """
+    links = master['links']
+    return links.loc[links['Permco'].values == permco]
+
+
+def permco_rows(master, permco):
+    """
+    :return: the positions (first, last + 1) of the rows of permco in merged sorted on Permco and datadate
+    """
+    first, last = key_range(master, 'permcos', permco)
+    if first == last:
+        raise KeyError('Permco ' + str(permco) + ' is not in the security master')
+    row = master['permcos'].iloc[first]
+    return int(row['First Row']), int(row['Last Row']) + 1
+
+
+def firm_frame(merged, master, permco):
+    """
+    Same as merged.xs(permco, level = 'Permco', drop_level = False) for the merged panel the security
+    master was built from
+
+    :param merged: the merged panel, sorted on Permco and datadate
+    """
+    start, stop = permco_rows(master, permco)
+    return merged.iloc[start:stop]
+
+
+def read_firm(master, permco, columns=None, name='merged', fmt=None, output_dir=OUTPUT_DIR):
+    """
+    Reads the rows of a single Permco of a stored output
+
+    :param master: the security master of the output
+    :param permco: the Permco
+    :param columns: a list of columns to read. If None, every column is read
+    :return: a dataframe indexed on Permco and datadate
+    """
+    fmt = STORAGE_FORMAT if fmt is None else fmt
+    path = artifact_path(name, fmt, output_dir)
+    start, stop = permco_rows(master, permco)
+
+    if fmt == 'hdf':
+        ret = pd.read_hdf(path, key=name, start=start, stop=stop)
+        ret = ret if columns is None else ret[list(columns)]
+    else:
+        # Only the year partitions of the Permco are opened, and their row groups are filtered on the Permco
+        first, last = key_range(master, 'permcos', permco)
+        row = master['permcos'].iloc[first]
+        filters = [(PARTITION_VARIABLE, '>=', pd.Timestamp(row['Start']).year),
+                   (PARTITION_VARIABLE, '<=', pd.Timestamp(row['End']).year),
+                   ('Permco', '=', permco)]
+        ret = pd.read_parquet(path, engine='pyarrow', columns=None if columns is None else list(columns),
+                              filters=filters)
+        ret = ret.drop(columns=[PARTITION_VARIABLE], errors='ignore').sort_index()
+
+    assert ret.shape[0] == stop - start and (ret.index.get_level_values('Permco') == permco).all(), \
+        'The security master of ' + name + ' is out of date (see update_security_master)'
+    return ret
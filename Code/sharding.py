@@ -0,0 +1,264 @@
+"""
+Description: Sharded build of the outputs. Firms are split by Permco into a number of shards, and
+every shard goes through the whole build (write_crsp -> features_crsp, write_compustat ->
+features_compustat, both -> merge_crsp_compustat) in its own process. Each process only holds the
+firms of its shard, so the memory of a process shrinks with the number of shards.
+
+Every step of the build is done within a Permco (share classes, deduplication, year to date
+differences, rolling features, the as-of merge), so a shard gives the same rows as the full build:
+
+1. The raw files are split in one pass into one raw file per shard (../Output/shards/raw). A row goes
+to the shard of the hash of its Permco (PERMCO in CRSP, LPERMCO in Compustat), so both files of a
+shard have the same firms. Rows without a Permco go to the first shard.
+2. Up to the number of workers, a process runs the stages of pipeline.STAGES on the raw files of a
+shard and writes their outputs to ../Output/shards/<shard>.
+3. The outputs of the shards are concatenated and sorted on Permco and datadate, then written under
+the usual names (crsp_clean, crsp, compustat_clean, compustat, merged, the states of incremental.py)
+along with the security master of merged.
+
+`python sharding.py verify` rebuilds every output in a single process in memory and checks that the
+sharded outputs are the same.
+
+Usage:
+
+python sharding.py build                          # NUM_SHARDS shards, NUM_WORKERS at a time
+python sharding.py build --shards 8 --workers 4
+python sharding.py verify
+"""
+
+import os
+import csv
+import shutil
+import argparse
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from utils import print_message
+from instrumentation import start_run, write_run_report, enable_reports
+from storage import OUTPUT_DIR, write_frame, read_frame
+from state import write_state, read_state
+from schema import apply_schema
+from pipeline import STAGES, PUBLISHED_STATES, NUM_WORKERS, topological_order
+from write_crsp import CRSP_SCHEMA
+from write_compustat import COMPUSTAT_SCHEMA
+from features_crsp import CRSP_FEATURE_SCHEMA
+from features_compustat import COMPUSTAT_FEATURE_SCHEMA
+from merge_crsp_compustat import MERGED_SCHEMA
+from security_master import build_security_master, write_security_master
+
+SHARD_DIR = os.path.join(OUTPUT_DIR, 'shards')
+NUM_SHARDS = int(os.environ.get('NUM_SHARDS', 4))
+
+# Raw files of the stages and the variable of their Permco
+SHARD_VARIABLES = {'../Data/crsp.txt': 'PERMCO',
+                   '../Data/compustat-merged.txt': 'LPERMCO'}
+
+# Outputs of the stages that are concatenated, and their types. The security master is rebuilt from merged
+SHARDED_OUTPUTS = {'crsp_clean': CRSP_SCHEMA,
+                   'crsp': CRSP_FEATURE_SCHEMA,
+                   'crsp_state': CRSP_FEATURE_SCHEMA,
+                   'compustat_clean': COMPUSTAT_SCHEMA,
+                   'compustat_state': COMPUSTAT_SCHEMA,
+                   'compustat': COMPUSTAT_FEATURE_SCHEMA,
+                   'merged': MERGED_SCHEMA}
+
+
+def shard_of(permcos, num_shards):
+    """
+    :param permcos: an array of Permcos (raw strings or numbers). Missing or invalid Permcos are in shard 0
+    :param num_shards: the number of shards
+    :return: an integer array with the shard of every Permco
+    """
+    values = pd.to_numeric(pd.Series(permcos), errors='coerce').fillna(0).to_numpy(dtype=np.int64)
+    # The splitmix64 finalizer, so that every bit of the Permco moves the low bits the shard is taken from.
+    # Neighbouring Permcos (often listed at the same time) are spread out whatever the number of shards
+    hashed = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    with np.errstate(over='ignore'):
+        hashed = (hashed ^ (hashed >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        hashed = (hashed ^ (hashed >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    hashed ^= hashed >> np.uint64(31)
+    return (hashed % np.uint64(num_shards)).astype(np.int64)
+
+
+def shard_dir(shard, shard_root=SHARD_DIR):
+    return os.path.join(shard_root, str(shard))
+
+
+def shard_file(path, shard, shard_root=SHARD_DIR):
+    """
+    :return: the path of the part of the raw file at path that belongs to shard
+    """
+    name, extension = os.path.splitext(os.path.basename(path))
+    return os.path.join(shard_root, 'raw', name + '-' + str(shard) + extension)
+
+
+def split_raw_file(path, variable, num_shards, shard_root=SHARD_DIR, sep='\t'):
+    """
+    Splits a raw file into one file per shard, by the hash of its Permco. Records are parsed with the csv
+    module, as pd.read_csv does, so a quoted field that holds the separator or a line break does not move
+    the Permco column. The lines of every record are copied as they are, so each shard file is read exactly
+    like the raw file
+
+    :param path: the path of the raw tab-separated file
+    :param variable: the variable of the Permco, e.g. 'PERMCO'
+    :param num_shards: the number of shards
+    :return: the list of the paths of the shard files
+    """
+    paths = [shard_file(path, shard, shard_root) for shard in range(num_shards)]
+    os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+    # latin-1 with newline='' reads and writes back every byte unchanged
+    files = [open(p, 'w', encoding='latin-1', newline='') for p in paths]
+    try:
+        with open(path, 'r', encoding='latin-1', newline='') as raw:
+            lines = [] # Lines of the record being parsed
+
+            def read_lines():
+                for line in raw:
+                    lines.append(line)
+                    yield line
+
+            records = csv.reader(read_lines(), delimiter=sep)
+            column = next(records).index(variable)
+            for f in files:
+                f.write(''.join(lines))
+            del lines[:]
+            shards = {} # Shard of every raw Permco value seen so far
+            for record in records:
+                value = record[column] if len(record) > column else ''
+                if value not in shards:
+                    shards[value] = shard_of([value], num_shards)[0]
+                files[shards[value]].write(''.join(lines))
+                del lines[:]
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+
+def run_stages(raw_files=None, output_dir=None):
+    """
+    Runs the stages of pipeline.STAGES in this process
+
+    :param raw_files: a dictionary from the raw files of the stages to the files read instead, or None
+    :param output_dir: if given, the outputs in SHARDED_OUTPUTS are written there as they are built and
+    dropped once no later stage needs them. If None, they are kept
+    :return: a dictionary of the outputs in SHARDED_OUTPUTS that are kept
+    """
+    raw_files = {} if raw_files is None else raw_files
+    order = topological_order(STAGES)
+    frames = {}
+    for ind, stage in enumerate(order):
+        spec = STAGES[stage]
+        files = [raw_files.get(path, path) for path in spec['files']]
+        outputs = spec['function'](*(files + [frames[output] for _, output in spec['inputs']]))
+        needed = set(output for later in order[ind + 1:] for _, output in STAGES[later]['inputs'])
+        for output, frame in zip(spec['outputs'], outputs):
+            if output not in SHARDED_OUTPUTS:
+                continue
+            if output_dir is not None:
+                write_frame(frame, output, output_dir=output_dir)
+            if output_dir is None or output in needed:
+                frames[output] = frame
+        for output in [o for o in frames if output_dir is not None and o not in needed]:
+            del frames[output]
+    return frames
+
+
+def build_shard(shard, shard_root=SHARD_DIR):
+    """
+    Builds the outputs of one shard from its raw files (see split_raw_file)
+
+    :return: the directory of its outputs
+    """
+    start_run('shard-' + str(shard)) # Each shard writes its own run report
+    print_message('Building shard ' + str(shard))
+    output_dir = shard_dir(shard, shard_root)
+    run_stages({path: shard_file(path, shard, shard_root) for path in SHARD_VARIABLES}, output_dir)
+    write_run_report(reset=True)
+    return output_dir
+
+
+def concat_shards(frames):
+    """
+    Same as pd.concat(frames).sort_index(), except that categoricals are given the sorted union of the
+    categories of the shards (as in ingest.read_chunked), so that they stay categoricals. Empty shards
+    are left out
+    """
+    frames = list(frames)
+    frames = [f for f in frames if f.shape[0] > 0] or frames[:1]
+    for v in frames[0].columns:
+        if isinstance(frames[0][v].dtype, pd.CategoricalDtype):
+            categories = pd.Index(np.concatenate([f[v].cat.categories.values for f in frames])).unique().sort_values()
+            frames = [f.assign(**{v: f[v].cat.set_categories(categories)}) for f in frames]
+    return pd.concat(frames).sort_index()
+
+
+def combine_shards(num_shards, shard_root=SHARD_DIR):
+    """
+    Concatenates the outputs of the shards and writes them under their usual names, with the security
+    master of merged and the states of incremental.py
+    """
+    for output, schema in SHARDED_OUTPUTS.items():
+        print_message('Combining ' + output)
+        df = concat_shards(apply_schema(read_frame(output, output_dir=shard_dir(shard, shard_root)), schema,
+                                        output, verbose=False) for shard in range(num_shards))
+        if output in PUBLISHED_STATES:
+            write_state(df, PUBLISHED_STATES[output])
+        else:
+            write_frame(df, output)
+        if output == 'merged':
+            write_security_master(build_security_master(df))
+
+
+def build(num_shards=NUM_SHARDS, num_workers=NUM_WORKERS, keep_shards=False):
+    """
+    Builds every output with the firms split into num_shards shards
+
+    :param num_shards: the number of shards
+    :param num_workers: the number of shards built at the same time. 1 builds them in this process
+    :param keep_shards: if False, the raw files and outputs of the shards are deleted at the end
+    """
+    print_message('Splitting the raw files into ' + str(num_shards) + ' shards')
+    for path, variable in SHARD_VARIABLES.items():
+        split_raw_file(path, variable, num_shards)
+
+    if num_workers <= 1:
+        for shard in range(num_shards):
+            build_shard(shard)
+    else:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            list(executor.map(build_shard, range(num_shards))) # Raises the error of a failed shard
+
+    combine_shards(num_shards)
+    if not keep_shards:
+        shutil.rmtree(SHARD_DIR)
+    print_message('Sharded build finished')
+
+
+def verify():
+    """
+    Rebuilds every output in a single process in memory and compares it with the stored output
+    """
+    rebuilt = run_stages()
+    for output, schema in SHARDED_OUTPUTS.items():
+        print_message('Comparing ' + output)
+        stored = read_state(PUBLISHED_STATES[output]) if output in PUBLISHED_STATES else read_frame(output)
+        stored = apply_schema(stored, schema, output, verbose=False)
+        expected = apply_schema(rebuilt[output], schema, output, verbose=False).sort_index()[stored.columns]
+        pd.testing.assert_frame_equal(stored, expected, check_index_type=False, check_categorical=False)
+        print(str(stored.shape[0]) + ' rows match')
+
+
+if __name__ == '__main__':
+    enable_reports()
+    parser = argparse.ArgumentParser(description='Builds the outputs with the firms split into shards')
+    parser.add_argument('command', nargs='?', default='build', choices=['build', 'verify'])
+    parser.add_argument('--shards', type=int, default=NUM_SHARDS, help='number of shards')
+    parser.add_argument('--workers', type=int, default=NUM_WORKERS, help='number of shards built at the same time')
+    parser.add_argument('--keep-shards', action='store_true', help='keep the raw files and outputs of the shards')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.shards, args.workers, args.keep_shards)
+    else:
+        verify()
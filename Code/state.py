@@ -0,0 +1,45 @@
+"""
+Description: Per-Permco state carried between incremental updates (see incremental.py).
+
+Each build stage stores the few most recent rows of every Permco that the next update needs:
+the tail of the rolling windows and the last cumulative return for CRSP, the year to date
+values of the current fiscal year for Compustat. They are small frames kept next to the
+outputs. The merged panel needs no state: it is rebuilt from the stored crsp and compustat
+outputs for the months that changed.
+"""
+
+import pandas as pd
+from storage import OUTPUT_DIR, write_frame, read_frame
+import os
+
+STATE_DIR = os.path.join(OUTPUT_DIR, 'state')
+
+
+def write_state(df, name, fmt=None, state_dir=STATE_DIR):
+    """
+    Stores the state of the stage called name, replacing the previous one
+    """
+    return write_frame(df, name, fmt=fmt, output_dir=state_dir, partition_by_year=False)
+
+
+def read_state(name, fmt=None, state_dir=STATE_DIR):
+    """
+    :return: the state of the stage called name, indexed on Permco and datadate
+    """
+    return read_frame(name, fmt=fmt, output_dir=state_dir)
+
+
+def tail_rows(df, num_rows, group='Permco'):
+    """
+    :return: the last num_rows rows (by datadate) of each group of df
+    """
+    return df.sort_index().groupby(level=group).tail(num_rows)
+
+
+def last_fiscal_year(df, group='Permco', fiscal_year='Fiscal Year'):
+    """
+    :return: the rows of df that belong to the latest fiscal year of each group
+    """
+    latest = df.groupby(level=group)[fiscal_year].transform('max')
+    return df.loc[(df[fiscal_year] == latest).fillna(False).astype(bool).values].sort_index()
+
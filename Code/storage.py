@@ -0,0 +1,214 @@
+"""
+Description: Storage layer for the intermediate outputs of the pipeline (crsp, compustat,
+merged).
+
+Two formats are supported:
+
+'parquet' - a directory of Parquet files partitioned by the year of datadate. Reading back
+only some columns or a date range only touches those columns and the relevant years.
+
+'hdf' - the original single HDF5 file per output, written with to_hdf. Subsets are taken
+after the whole frame has been read. Nullable integers come back as floats; the readers restore
+them with schema.apply_schema.
+
+New months are added with append_frame, which only rewrites the Parquet year partitions that
+they touch (see incremental.py).
+
+The default format is taken from the STORAGE_FORMAT environment variable (see the Makefile)
+and falls back to 'parquet'.
+"""
+
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from instrumentation import instrumented
+
+OUTPUT_DIR = '../Output'
+STORAGE_FORMAT = os.environ.get('STORAGE_FORMAT', 'parquet')
+EXTENSIONS = {'parquet': '.parquet', 'hdf': '.h5'}
+DATE_VARIABLE = 'datadate'
+PARTITION_VARIABLE = 'Year'
+
+
+def artifact_path(name, fmt=None, output_dir=OUTPUT_DIR):
+    """
+    :param name: the name of the output, e.g. 'crsp'
+    :param fmt: 'parquet' or 'hdf'. Defaults to STORAGE_FORMAT
+    :param output_dir: the directory that holds the outputs
+    :return: the path of the file (hdf) or directory (parquet) that holds the output
+    """
+    fmt = STORAGE_FORMAT if fmt is None else fmt
+    assert fmt in EXTENSIONS, 'Unknown storage format: ' + str(fmt)
+    return os.path.join(output_dir, name + EXTENSIONS[fmt])
+
+
+def date_values(df, date_variable=DATE_VARIABLE):
+    """
+    :return: the values of date_variable, whether it is a column or a level of the index of df
+    """
+    if date_variable in df.columns:
+        return df[date_variable]
+    return pd.Series(df.index.get_level_values(date_variable), index=df.index)
+
+
+def hdf_compatible(df):
+    """
+    HDF5 cannot store nullable numbers, and stores categoricals only in the slower 'table' format
+
+    :return: a tuple of df with its nullable numeric variables as floats, and the HDF5 format to use
+    """
+    nullable = [v for v in df.columns if isinstance(df[v].dtype, pd.api.extensions.ExtensionDtype)
+                and pd.api.types.is_numeric_dtype(df[v].dtype)]
+    if len(nullable) > 0:
+        df = df.assign(**{v: df[v].astype(np.float64) for v in nullable})
+    has_categories = any(isinstance(t, pd.CategoricalDtype) for t in df.dtypes)
+    return df, 'table' if has_categories else 'fixed'
+
+
+@instrumented('write', writes_path=True)
+def write_frame(df, name, fmt=None, output_dir=OUTPUT_DIR, partition_by_year=True):
+    """
+    Writes df as the output called name, replacing any previous version
+
+    :param df: a pandas dataframe. For partitioning, datadate must be a column or an index level
+    :param name: the name of the output, e.g. 'crsp'
+    :param fmt: 'parquet' or 'hdf'. Defaults to STORAGE_FORMAT
+    :param output_dir: the directory that holds the outputs
+    :param partition_by_year: if True, Parquet outputs are split into one directory per year
+    :return: the path that was written
+    """
+    fmt = STORAGE_FORMAT if fmt is None else fmt
+    path = artifact_path(name, fmt, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    if fmt == 'hdf':
+        df, hdf_format = hdf_compatible(df)
+        df.to_hdf(path, key=name, format=hdf_format)
+        return path
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+    # pyarrow writes no partition for an empty frame, so it is written as a single file
+    if partition_by_year and df.shape[0] > 0 and (DATE_VARIABLE in df.columns or DATE_VARIABLE in df.index.names):
+        partitioned = df.assign(**{PARTITION_VARIABLE: date_values(df).dt.year.values})
+        partitioned.to_parquet(path, engine='pyarrow', partition_cols=[PARTITION_VARIABLE])
+    else:
+        os.makedirs(path)
+        df.to_parquet(os.path.join(path, 'part-0.parquet'), engine='pyarrow')
+
+    return path
+
+
+def append_frame(df, name, fmt=None, output_dir=OUTPUT_DIR, replace_rows=False):
+    """
+    Adds the rows of df to the output called name. Stored rows dated on or after the first datadate
+    of df are replaced, so a period can be appended again after a correction. Only the year
+    partitions that df touches are rewritten for Parquet outputs.
+
+    :param df: a pandas dataframe with the same variables as the stored output
+    :param name: the name of the output, e.g. 'crsp'
+    :param fmt: 'parquet' or 'hdf'. Defaults to STORAGE_FORMAT
+    :param output_dir: the directory that holds the outputs
+    :param replace_rows: if True, only the stored rows with the same index as a row of df are replaced,
+    and the other stored rows are kept whatever their date (e.g. when df has the late rows of a few firms)
+    :return: the path that was written
+    """
+    fmt = STORAGE_FORMAT if fmt is None else fmt
+    path = artifact_path(name, fmt, output_dir)
+    if df.shape[0] == 0:
+        return path
+    if not os.path.exists(path):
+        return write_frame(df, name, fmt=fmt, output_dir=output_dir)
+
+    first_date = date_values(df).min()
+    if fmt == 'hdf':
+        stored = pd.read_hdf(path, key=name)
+        if replace_rows:
+            stored = stored.loc[~stored.index.isin(df.index)]
+        else:
+            stored = stored.loc[(date_values(stored) < first_date).values]
+        new_rows = hdf_compatible(df)[0][stored.columns]
+        return write_frame(pd.concat([stored, new_rows]).sort_index(), name, fmt=fmt, output_dir=output_dir)
+
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    # Keep the rows of the rewritten years that come before df, or that df does not replace
+    first_year = first_date.year
+    if replace_rows:
+        kept = pd.read_parquet(path, engine='pyarrow', filters=[(PARTITION_VARIABLE, '>=', first_year)])
+        kept = kept.loc[~kept.index.isin(df.index)]
+    else:
+        kept = pd.read_parquet(path, engine='pyarrow', filters=[(PARTITION_VARIABLE, '=', first_year),
+                                                                (DATE_VARIABLE, '<', first_date)])
+    kept = kept.drop(columns=[PARTITION_VARIABLE], errors='ignore')
+    combined = pd.concat([kept, df[kept.columns]]).sort_index() if kept.shape[0] > 0 else df.sort_index()
+    combined = combined.assign(**{PARTITION_VARIABLE: date_values(combined).dt.year.values})
+
+    # Cast the new rows to the stored schema so that every partition can be read back together.
+    # If they do not fit (e.g. missing values in an integer variable), the whole output is rewritten
+    schema = ds.dataset(path, format='parquet', partitioning='hive').schema
+    schema = schema.set(schema.get_field_index(PARTITION_VARIABLE), pa.field(PARTITION_VARIABLE, pa.int32()))
+    try:
+        table = pa.Table.from_pandas(combined.reset_index()[schema.names], schema=schema, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, KeyError):
+        if replace_rows:
+            stored = read_frame(name, fmt=fmt, output_dir=output_dir)
+            stored = stored.loc[~stored.index.isin(df.index)]
+        else:
+            stored = read_frame(name, end=first_date - pd.Timedelta(days=1), fmt=fmt, output_dir=output_dir)
+        return write_frame(pd.concat([stored, df]).sort_index(), name, fmt=fmt, output_dir=output_dir)
+
+    for directory in os.listdir(path):
+        if directory.startswith(PARTITION_VARIABLE + '=') and int(directory.split('=')[1]) >= first_year:
+            shutil.rmtree(os.path.join(path, directory))
+    pq.write_to_dataset(table.replace_schema_metadata(schema.metadata), path, partition_cols=[PARTITION_VARIABLE])
+    return path
+
+
+def read_frame(name, columns=None, start=None, end=None, fmt=None, output_dir=OUTPUT_DIR):
+    """
+    Reads the output called name, keeping only the requested columns and dates
+
+    :param name: the name of the output, e.g. 'merged'
+    :param columns: a list of columns to read. Index levels are always read. If None, every column is read
+    :param start: the first datadate to keep (inclusive), or None
+    :param end: the last datadate to keep (inclusive), or None
+    :param fmt: 'parquet' or 'hdf'. Defaults to STORAGE_FORMAT
+    :param output_dir: the directory that holds the outputs
+    :return: a pandas dataframe, sorted on its index
+
+    Usage:
+
+    merged = read_frame('merged', columns=['Market Cap (Billions, CRSP)', 'Exchange Code'], start='1990-01-31')
+    """
+    fmt = STORAGE_FORMAT if fmt is None else fmt
+    path = artifact_path(name, fmt, output_dir)
+    start = None if start is None else pd.Timestamp(start)
+    end = None if end is None else pd.Timestamp(end)
+
+    if fmt == 'hdf':
+        ret = pd.read_hdf(path, key=name)
+        keep = np.ones(ret.shape[0], dtype=bool)
+        if start is not None:
+            keep &= (date_values(ret) >= start).values
+        if end is not None:
+            keep &= (date_values(ret) <= end).values
+        ret = ret.loc[keep] if columns is None else ret.loc[keep, list(columns)]
+    else:
+        # The year partitions are pruned first, then row groups using the datadate statistics
+        filters = []
+        if start is not None:
+            filters += [(PARTITION_VARIABLE, '>=', start.year), (DATE_VARIABLE, '>=', start)]
+        if end is not None:
+            filters += [(PARTITION_VARIABLE, '<=', end.year), (DATE_VARIABLE, '<=', end)]
+        ret = pd.read_parquet(path, engine='pyarrow', columns=None if columns is None else list(columns),
+                              filters=filters if len(filters) > 0 else None)
+        ret = ret.drop(columns=[PARTITION_VARIABLE], errors='ignore')
+
+    return ret.sort_index()
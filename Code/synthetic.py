@@ -0,0 +1,321 @@
+"""
+Description: Generators of synthetic panels that look like the cleaned CRSP and Compustat
+data, and of raw files with the layout of crsp.txt and compustat-merged.txt. They are used by
+benchmarks.py to time the pipeline, and by the tests in ../tests to check that faster code paths
+give the same answers as the original ones.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+
+
+def month_ends(num_months, start='1970-01-31'):
+    """
+    :return: a DatetimeIndex of num_months consecutive month ends
+    """
+    return pd.date_range(start=start, periods=num_months, freq=pd.offsets.MonthEnd())
+
+
+def make_crsp_share_classes(num_firms=1000, num_months=120, max_share_classes=3, missing_share=0.02, seed=0):
+    """
+    Makes a CRSP-like panel with several share classes for some Permco-datadates, after the
+    variables have been renamed and the basic features built in write_crsp.py.
+
+    :param num_firms: the number of Permcos
+    :param num_months: the number of months every Permco is observed
+    :param max_share_classes: the maximum number of share classes of a Permco
+    :param missing_share: the share of numeric values that are set to NaN
+    :param seed: the random seed
+    :return: a dataframe indexed on Permco and datadate that is NOT uniquely identified
+    """
+    rng = np.random.RandomState(seed)
+    num_classes = rng.randint(1, max_share_classes + 1, size=num_firms)
+    num_classes[rng.random_sample(num_firms) < 0.8] = 1  # Most firms have a single share class
+
+    permcos = np.repeat(np.arange(10000, 10000 + num_firms), num_classes)
+    permnos = np.arange(len(permcos)) + 50000
+    dates = month_ends(num_months)
+
+    n = len(permcos) * num_months
+    ret = pd.DataFrame({'Permco': np.repeat(permcos, num_months),
+                        'datadate': np.tile(dates, len(permcos)),
+                        'Company Name': np.repeat(['FIRM ' + str(p) for p in permcos], num_months),
+                        'Permno': np.repeat(permnos, num_months),
+                        'Ticker': np.repeat(['T' + str(p) for p in permnos], num_months),
+                        'Price': np.exp(rng.normal(3, 1, size=n)),
+                        'Bid': np.exp(rng.normal(3, 1, size=n)),
+                        'Ask': np.exp(rng.normal(3, 1, size=n)),
+                        'Exchange Code': rng.choice([1, 2, 3], size=n),
+                        'Market Cap (Billions, CRSP)': np.exp(rng.normal(-1, 2, size=n)),
+                        'Return': rng.normal(0.01, 0.1, size=n),
+                        'Volume': np.exp(rng.normal(10, 2, size=n))})
+
+    for v in ['Price', 'Market Cap (Billions, CRSP)', 'Return', 'Volume']:
+        ret.loc[rng.random_sample(n) < missing_share, v] = np.nan
+
+    # Shuffle the rows so that share classes are not already next to each other
+    ret = ret.iloc[rng.permutation(n)]
+    return ret.set_index(['Permco', 'datadate'])
+
+
+def make_merged_panel(num_firms=2000, num_months=240, num_float_variables=40, seed=0):
+    """
+    Makes a balanced panel shaped like merged.h5: indexed on Permco and datadate with a few
+    named variables used by the notebooks and num_float_variables other numeric variables.
+
+    :param num_firms: the number of Permcos
+    :param num_months: the number of months every Permco is observed
+    :param num_float_variables: the number of additional numeric variables
+    :param seed: the random seed
+    :return: a dataframe indexed on Permco and datadate, sorted on the index
+    """
+    rng = np.random.RandomState(seed)
+    n = num_firms * num_months
+    index = pd.MultiIndex.from_product([np.arange(10000, 10000 + num_firms), month_ends(num_months)],
+                                       names=['Permco', 'datadate'])
+
+    returns = rng.normal(0.01, 0.1, size=(num_firms, num_months))
+    ret = pd.DataFrame({'Company Name': np.repeat(['FIRM ' + str(p) for p in range(num_firms)], num_months),
+                        'Ticker': np.repeat(['T' + str(p) for p in range(num_firms)], num_months),
+                        'Exchange Code': np.repeat(rng.choice([1, 2, 3], size=num_firms), num_months),
+                        'Return': returns.ravel(),
+                        'Cumulative Return': np.cumsum(np.log(1 + returns), axis=1).ravel(),
+                        'Market Cap (Billions, CRSP)': np.exp(rng.normal(-1, 2, size=n))},
+                       index=index)
+
+    for ind in range(num_float_variables):
+        ret['Variable ' + str(ind)] = rng.normal(size=n)
+
+    return ret
+
+
+COMPUSTAT_FLOW_VARIABLES = ['Sales', 'COGS', 'SG&A', 'EBITDA', 'EBIT', 'Net Income', 'Interest Expense']
+COMPUSTAT_STOCK_VARIABLES = ['Assets, Total', 'Liabilities, Total', 'Common Equity, Total', 'Shareholder Equity, Total',
+                             'Preferred Equity, Total', 'Deferred Tax Assets', 'Cash',
+                             'Shares Outstanding (Compustat)', 'Price (Compustat)']
+COMPUSTAT_YTD_VARIABLES = ['Operating Cash Flow', 'Financing Activities', 'Long Term Debt, Gross Issuance',
+                           'Long Term Debt, Retired', 'Cash Dividends', 'Capex', 'M&A']
+
+
+def make_compustat_panel(num_firms=1000, num_years=20, duplicate_share=0.02, missing_share=0.05, seed=0):
+    """
+    Makes a Compustat-like quarterly panel after the variables have been renamed in
+    write_compustat.py. Cash flow variables are reported fiscal year to date, and a share
+    of the Permco-datadates appear twice (a second Gvkey with more missing values).
+
+    :param num_firms: the number of Permcos
+    :param num_years: the number of fiscal years every Permco is observed
+    :param duplicate_share: the share of Permco-datadates that are duplicated
+    :param missing_share: the share of numeric values that are set to NaN
+    :param seed: the random seed
+    :return: a dataframe indexed on Permco and datadate that is NOT uniquely identified
+    """
+    rng = np.random.RandomState(seed)
+    num_quarters = 4 * num_years
+    n = num_firms * num_quarters
+    permcos = np.repeat(np.arange(10000, 10000 + num_firms), num_quarters)
+    quarter_ends = month_ends(3 * num_quarters)[2::3]
+    fiscal_quarter = np.tile(np.arange(1, 5), num_firms * num_years)
+
+    ret = pd.DataFrame({'Permco': permcos,
+                        'datadate': np.tile(quarter_ends, num_firms),
+                        'Gvkey': permcos + 1000,
+                        'Permno': permcos + 50000,
+                        'Fiscal Year': np.tile(np.repeat(np.arange(1970, 1970 + num_years), 4), num_firms),
+                        'Fiscal Quarter': fiscal_quarter,
+                        'Company Name': np.repeat(['FIRM ' + str(p) for p in range(num_firms)], num_quarters),
+                        'Currency': 'USD',
+                        'NAICS Sector Code': np.repeat(rng.randint(11, 93, size=num_firms), num_quarters),
+                        'Exchange Code': np.repeat(rng.choice([11, 12, 14], size=num_firms), num_quarters)})
+    ret['Report Date'] = (ret['datadate'] + pd.Timedelta(days=45)).dt.strftime('%Y/%m/%d')
+
+    for v in COMPUSTAT_FLOW_VARIABLES + COMPUSTAT_STOCK_VARIABLES:
+        ret[v] = np.exp(rng.normal(3, 2, size=n))
+
+    # Cash flow variables accumulate over the fiscal year
+    for v in COMPUSTAT_YTD_VARIABLES:
+        quarterly = pd.Series(rng.normal(10, 5, size=n))
+        ret[v] = quarterly.groupby([ret['Permco'], ret['Fiscal Year']]).cumsum().values
+
+    numeric = COMPUSTAT_FLOW_VARIABLES + COMPUSTAT_STOCK_VARIABLES + COMPUSTAT_YTD_VARIABLES
+    values = ret[numeric].to_numpy(copy=True)
+    values[rng.random_sample(values.shape) < missing_share] = np.nan
+    ret[numeric] = values
+
+    duplicates = ret.loc[rng.random_sample(n) < duplicate_share].copy()
+    duplicates['Gvkey'] = duplicates['Gvkey'] + 100000
+    values = duplicates[numeric].to_numpy(copy=True)
+    values[rng.random_sample(values.shape) < 0.3] = np.nan
+    duplicates[numeric] = values
+
+    ret = pd.concat([ret, duplicates])
+    ret = ret.iloc[rng.permutation(ret.shape[0])]
+    return ret.set_index(['Permco', 'datadate'])
+
+
+################ Raw files ################
+# Columns of the raw WRDS extracts, in the order of the files. The scripts only read some of them
+RAW_CRSP_COLUMNS = ['PERMNO', 'date', 'SHRCD', 'EXCHCD', 'HSICCD', 'TICKER', 'COMNAM', 'SHRCLS', 'PERMCO', 'BIDLO',
+                    'ASKHI', 'PRC', 'VOL', 'RET', 'BID', 'ASK', 'SHROUT', 'CFACPR', 'CFACSHR', 'RETX', 'DLRET']
+RAW_COMPUSTAT_ID_COLUMNS = ['GVKEY', 'LPERMNO', 'LPERMCO', 'datadate', 'fyearq', 'fqtr', 'conm', 'curcdq', 'rdq',
+                            'naics', 'exchg', 'cik']
+RAW_COMPUSTAT_YTD_COLUMNS = ['oancfy', 'fincfy', 'dltisy', 'dltry', 'dvy', 'capxy', 'aqcy']
+RAW_COMPUSTAT_QUARTERLY_COLUMNS = ['atq', 'ceqq', 'seqq', 'pstkrq', 'ltq', 'txditcq', 'dlttq', 'dlcq', 'cheq', 'saleq',
+                                   'cogsq', 'xsgaq', 'dpq', 'oibdpq', 'oiadpq', 'xintq', 'txpq', 'niq', 'epsfiq',
+                                   'epsfxq', 'cshopq', 'prcraq', 'cshoq', 'prccq', 'cshfdq']
+
+
+def raw_dates(dates):
+    """
+    :return: a numpy array of the dates formatted as in the raw files, e.g. '2000/01/31'
+    """
+    return np.asarray(pd.DatetimeIndex(dates).strftime('%Y/%m/%d'), dtype=object)
+
+
+def firm_months(num_firms, num_months, gap_share, rng):
+    """
+    Draws the months in which each firm is listed: firms list at different dates, and a share of
+    them have a gap of a few months in the middle of their history
+
+    :return: a tuple of numpy arrays of the firm and the month of every firm-month
+    """
+    first = rng.randint(0, max(num_months // 2, 1), size=num_firms)
+    firms = np.repeat(np.arange(num_firms), num_months - first)
+    months = np.concatenate([np.arange(f, num_months) for f in first])
+
+    gap_start = rng.randint(0, num_months, size=num_firms)[firms]
+    gap_length = np.where(rng.random_sample(num_firms) < gap_share, rng.randint(1, 7, size=num_firms), 0)[firms]
+    keep = (months < gap_start) | (months >= gap_start + gap_length)
+    return firms[keep], months[keep]
+
+
+def make_raw_crsp(num_firms=1000, num_months=240, max_share_classes=3, gap_share=0.05, missing_share=0.02,
+                  other_share_code_share=0.05, seed=0):
+    """
+    Makes a monthly stock file with the columns of the raw crsp.txt (see RAW_CRSP_COLUMNS). Some Permcos
+    have several share classes (Permnos), some are not common shares (SHRCD other than 10 and 11), some
+    have gaps in their history, prices are sometimes bid/ask averages (negative) and returns are
+    sometimes missing.
+
+    :param num_firms: the number of Permcos
+    :param num_months: the number of months of the sample
+    :param max_share_classes: the maximum number of share classes of a Permco
+    :param gap_share: the share of Permcos with a gap of one to six months
+    :param missing_share: the share of returns and prices that are missing
+    :param other_share_code_share: the share of Permcos that are not common shares
+    :param seed: the random seed
+    :return: a dataframe with the raw columns, dates formatted as in the file
+    """
+    rng = np.random.RandomState(seed)
+    firms, months = firm_months(num_firms, num_months, gap_share, rng)
+
+    # Every listed month of a firm has a row for each of its share classes
+    num_classes = np.where(rng.random_sample(num_firms) < 0.8, 1, rng.randint(1, max_share_classes + 1, size=num_firms))
+    share_class = np.concatenate([np.arange(k) for k in num_classes[firms]])
+    months = np.repeat(months, num_classes[firms])
+    firms = np.repeat(firms, num_classes[firms])
+    permcos = 10000 + firms
+    permnos = 50000 + 10 * firms + share_class
+    n = len(firms)
+
+    share_code = np.where(rng.random_sample(num_firms) < other_share_code_share, 31, rng.choice([10, 11], size=num_firms))
+    exchange = rng.choice([1, 2, 3], size=num_firms)
+    price = np.exp(rng.normal(3, 1, size=n))
+    ret = pd.DataFrame({'PERMNO': permnos,
+                        'date': raw_dates(month_ends(num_months))[months],
+                        'SHRCD': share_code[firms],
+                        'EXCHCD': exchange[firms],
+                        'HSICCD': rng.randint(1000, 9999, size=num_firms)[firms],
+                        'TICKER': np.asarray(['T' + str(p) for p in range(num_firms)], dtype=object)[firms],
+                        'COMNAM': np.asarray(['FIRM ' + str(p) for p in range(num_firms)], dtype=object)[firms],
+                        'SHRCLS': np.asarray(['', 'A', 'B', 'C'], dtype=object)[np.where(num_classes[firms] > 1, share_class + 1, 0)],
+                        'PERMCO': permcos,
+                        'BIDLO': price * 0.95,
+                        'ASKHI': price * 1.05,
+                        'PRC': np.where(rng.random_sample(n) < 0.05, -price, price),
+                        'VOL': rng.randint(100, 100000, size=n),
+                        'RET': rng.normal(0.01, 0.1, size=n),
+                        'BID': price * 0.99,
+                        'ASK': price * 1.01,
+                        'SHROUT': rng.randint(1000, 1000000, size=n),
+                        'CFACPR': 1.0,
+                        'CFACSHR': 1.0,
+                        'RETX': rng.normal(0.01, 0.1, size=n),
+                        'DLRET': np.nan})
+    for v in ['RET', 'PRC']:
+        ret.loc[rng.random_sample(n) < missing_share, v] = np.nan
+    return ret[RAW_CRSP_COLUMNS]
+
+
+def make_raw_compustat(num_firms=1000, num_months=240, gap_share=0.05, duplicate_share=0.02, missing_share=0.05,
+                       seed=0):
+    """
+    Makes a quarterly fundamentals file with the columns of the raw compustat-merged.txt. Cash flow
+    variables (RAW_COMPUSTAT_YTD_COLUMNS) are reported fiscal year to date, a share of the Permco-datadates
+    appear twice (a second GVKEY with more missing values) and some Permcos skip quarters.
+
+    :param num_firms: the number of Permcos, the same as those of make_raw_crsp
+    :param num_months: the number of months of the sample (one report every three months)
+    :param gap_share: the share of Permcos with a gap of a few quarters
+    :param duplicate_share: the share of Permco-datadates that are duplicated
+    :param missing_share: the share of numeric values that are missing
+    :param seed: the random seed
+    :return: a dataframe with the raw columns, dates formatted as in the file
+    """
+    rng = np.random.RandomState(seed + 1)
+    firms, quarters = firm_months(num_firms, num_months // 3, gap_share, rng)
+    n = len(firms)
+    quarter_ends = month_ends(num_months)[2::3]
+    fiscal_year = quarter_ends.year.values[quarters]
+    fiscal_quarter = quarter_ends.quarter.values[quarters]
+
+    ret = pd.DataFrame({'GVKEY': 1000 + firms,
+                        'LPERMNO': 50000 + 10 * firms,
+                        'LPERMCO': 10000 + firms,
+                        'datadate': raw_dates(quarter_ends)[quarters],
+                        'fyearq': fiscal_year,
+                        'fqtr': fiscal_quarter,
+                        'conm': np.asarray(['FIRM ' + str(p) for p in range(num_firms)], dtype=object)[firms],
+                        'curcdq': 'USD',
+                        'rdq': raw_dates(quarter_ends + pd.Timedelta(days=45))[quarters],
+                        'naics': rng.randint(11, 93, size=num_firms)[firms],
+                        'exchg': rng.choice([11, 12, 14], size=num_firms)[firms],
+                        'cik': 100000 + firms})
+    values = np.exp(rng.normal(3, 2, size=(n, len(RAW_COMPUSTAT_QUARTERLY_COLUMNS))))
+
+    # Cash flows accumulate over the fiscal year: add up the quarters since the start of the year
+    quarterly = rng.normal(10, 5, size=(n, len(RAW_COMPUSTAT_YTD_COLUMNS)))
+    ytd = np.cumsum(quarterly, axis=0)
+    year_start = np.r_[True, (firms[1:] != firms[:-1]) | (fiscal_year[1:] != fiscal_year[:-1])]
+    ytd -= (ytd - quarterly)[np.maximum.accumulate(np.where(year_start, np.arange(n), 0))]
+
+    numeric = np.hstack([values, ytd])
+    numeric[rng.random_sample(numeric.shape) < missing_share] = np.nan
+    ret[RAW_COMPUSTAT_QUARTERLY_COLUMNS + RAW_COMPUSTAT_YTD_COLUMNS] = numeric
+
+    duplicates = ret.loc[rng.random_sample(n) < duplicate_share].copy()
+    duplicates['GVKEY'] = duplicates['GVKEY'] + 100000
+    numeric = duplicates[RAW_COMPUSTAT_QUARTERLY_COLUMNS].to_numpy(copy=True)
+    numeric[rng.random_sample(numeric.shape) < 0.3] = np.nan
+    duplicates[RAW_COMPUSTAT_QUARTERLY_COLUMNS] = numeric
+    return pd.concat([ret, duplicates]).sort_values(['GVKEY', 'datadate'], kind='stable')
+
+
+def write_raw_files(data_dir, num_firms=1000, num_months=240, seed=0):
+    """
+    Writes synthetic crsp.txt and compustat-merged.txt, tab separated like the WRDS extracts, so that
+    write_crsp.py and write_compustat.py can run on them
+
+    :param data_dir: the directory of the raw files (e.g. '../Data' of a scratch directory)
+    :param num_firms: the number of Permcos
+    :param num_months: the number of months of the sample
+    :param seed: the random seed
+    :return: a tuple of the number of rows of both files
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    crsp = make_raw_crsp(num_firms, num_months, seed=seed)
+    crsp.to_csv(os.path.join(data_dir, 'crsp.txt'), sep='\t', index=False)
+    compustat = make_raw_compustat(num_firms, num_months, seed=seed)
+    compustat.to_csv(os.path.join(data_dir, 'compustat-merged.txt'), sep='\t', index=False)
+    return crsp.shape[0], compustat.shape[0]
@@ -0,0 +1,198 @@
+"""
+Description: The Three-Pass Regression Filter (3PRF) of the Replicating 3PRF notebook: the return factor
+implied by the price moving averages of the largest firms, for every forecast date. Writes
+forecasts_3prf.h5, which the Visualizing the replication notebook reads.
+
+On each forecast date, over the dates after the forecast date minus ESTIMATION_WINDOW years (of
+DAYS_PER_YEAR days, as in the notebook) and up to the forecast date:
+
+1. The COMPANY_PER_DATE firms with the largest market caps are kept. The notebook's filter on missing
+values was a left join that removed no firm, so by default no firm is dropped for missing months.
+2. Time series pass: each firm's 'Price Diff to Moving Average' is regressed on the S&P 500 'Next Month
+Return' (with an intercept), up to two months before the forecast date. The slope is the firm's loading.
+3. Cross sectional pass: on the forecast date, the firms' 'Price Diff to Moving Average' is regressed on
+their loadings. The slope is the Factor.
+
+Both passes are closed form regressions on per-firm sums of x, y, xy and x^2 (np.bincount over firm
+codes, on demeaned values), instead of one statsmodels OLS per firm and per date. The notebook's
+regressions of the Next Month Return on the factors of past dates are not used by the Factor and
+are left out.
+
+A window of exactly ESTIMATION_WINDOW * 12 month ends and a minimum share of observed months
+(min_non_missing) can be turned on with the parameters of three_pass_forecasts; both depart from the
+notebook.
+"""
+
+from utils import *
+from instrumentation import enable_reports
+from storage import read_frame, write_frame
+from features import build_features
+from dates import month_codes
+
+MIN_NON_MISSING = None # Share of the months of the window a firm needs to be observed. None keeps every firm
+PMA_NUM_YEARS = 3 # Moving average window over which to compute the PMA
+ESTIMATION_WINDOW = 5 # Number of years of the time series pass
+DAYS_PER_YEAR = 365.2425 # Length of a year in the notebook (pandas' former 'Y' Timedelta unit)
+COMPANY_PER_DATE = 1000 # Number of firms used on each date, by market cap
+SKIPPED_MONTHS = 2 # The time series pass stops this many months before the forecast date
+START_DATE = '1930-01-31'
+
+# Features computed within each Permco (see features.py)
+PMA_FEATURES = {'Price Moving Average': ('rolling_mean', 'Cumulative Return', PMA_NUM_YEARS * 12),
+                'Lagged Cumulative Return': ('lag', 'Cumulative Return', 1)}
+
+sp500_datatypes = {'date_vars': ['caldt'],
+                   'float_vars': ['vwretd'],
+                   'int_vars': []}
+
+
+def load_sp500():
+    """
+    :return: a dataframe indexed on datadate with 'S&P 500 Return' and the return of the following month,
+    'Next Month Return'
+    """
+    sp500 = pd.read_csv('../Data/sp500_returns.txt', sep = r'\s+')
+    sp500 = clean_data(sp500, sp500_datatypes)
+    sp500 = sp500.rename(columns = {'vwretd': 'S&P 500 Return', 'caldt': 'datadate'})
+    sp500['Next Month Return'] = sp500['S&P 500 Return'].shift(-1)
+    sp500 = sp500.loc[sp500['Next Month Return'].notnull() & sp500['datadate'].notnull(),
+                      ['datadate', 'S&P 500 Return', 'Next Month Return']]
+    return sp500.safe_index('datadate')
+
+
+def pma_panel(crsp, sp500):
+    """
+    Builds the inputs of the 3PRF: the difference between last month's cumulative return and its moving
+    average over PMA_NUM_YEARS, next to the S&P 500 returns
+
+    :param crsp: a panel indexed on Permco and datadate with 'Cumulative Return' and 'Market Cap (Billions, CRSP)'
+    :param sp500: the output of load_sp500
+    :return: a dataframe indexed on Permco and datadate, with only the rows where 'Price Diff to Moving Average'
+    and 'Next Month Return' are available
+    """
+    panel = crsp[['Cumulative Return', 'Market Cap (Billions, CRSP)']].sort_index()
+    panel[list(PMA_FEATURES.keys())] = build_features(panel, PMA_FEATURES)
+    panel['Price Diff to Moving Average'] = panel['Lagged Cumulative Return'] - panel['Price Moving Average']
+    panel = panel.join(sp500, on = 'datadate', how = 'inner')
+    return panel.loc[panel['Price Diff to Moving Average'].notnull()].sort_index()
+
+
+def grouped_slopes(codes, x, y, num_groups):
+    """
+    :return: the slope of the regression of y on x with an intercept within each group of codes, missing for
+    groups without values. Like statsmodels' OLS, which uses a pseudo-inverse, a group where x does not vary
+    (e.g. a single row) gets the minimum norm solution, mean(x) * mean(y) / (1 + mean(x) ** 2)
+    """
+    n = np.bincount(codes, minlength = num_groups).astype(np.float64)
+    mean_x = np.bincount(codes, x, num_groups) / np.maximum(n, 1)
+    mean_y = np.bincount(codes, y, num_groups) / np.maximum(n, 1)
+    # Demeaning first keeps the precision of the sums of squares
+    dx = x - mean_x[codes]
+    dy = y - mean_y[codes]
+    sum_xx = np.bincount(codes, dx * dx, num_groups)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        slopes = np.bincount(codes, dx * dy, num_groups) / sum_xx
+    constant = (n > 0) & (sum_xx == 0)
+    slopes[constant] = (mean_x * mean_y / (1 + mean_x ** 2))[constant]
+    return slopes
+
+
+def three_pass_forecasts(panel, forecast_dates, estimation_window = ESTIMATION_WINDOW,
+                         company_per_date = COMPANY_PER_DATE, min_non_missing = MIN_NON_MISSING,
+                         window_in_months = False):
+    """
+    Computes the 3PRF Factor on every forecast date. The defaults give the forecasts of the notebook
+
+    :param panel: the output of pma_panel
+    :param forecast_dates: a list of month ends
+    :param estimation_window: the number of years before each forecast date used by the passes
+    :param company_per_date: the number of firms used on each date, by their last market cap in the window
+    (ties go to the lowest Permco)
+    :param min_non_missing: the share of the months of the window a firm needs to be observed, or None to keep
+    every firm, as in the notebook
+    :param window_in_months: if False, as in the notebook, the window holds the dates after the forecast date
+    minus estimation_window years of DAYS_PER_YEAR days, which is estimation_window * 12 + 1 month ends. If
+    True, it holds the estimation_window * 12 month ends up to the forecast date
+    :return: a dataframe with one row per forecast date: 'datadate', 'Factor', 'Next Month Return',
+    'sorting_loading_correl' (the correlation of the loadings and the PMAs on the forecast date) and 'Intercept'
+    """
+    panel = panel.sort_index(level = ['datadate', 'Permco'])
+    firms, firm_values = pd.factorize(panel.index.get_level_values('Permco'), sort = True)
+    num_firms = len(firm_values)
+    dates = panel.index.get_level_values('datadate').as_unit('ns') # The window start has a time of day
+    months = month_codes(dates)
+    pma = panel['Price Diff to Moving Average'].to_numpy(dtype = np.float64)
+    next_return = panel['Next Month Return'].to_numpy(dtype = np.float64)
+    market_cap = panel['Market Cap (Billions, CRSP)'].to_numpy(dtype = np.float64, na_value = np.nan)
+    rows = np.arange(len(months))
+
+    forecasts = []
+    for forecast_date in pd.DatetimeIndex(forecast_dates):
+        target = month_codes([forecast_date])[0]
+        today_start, end = np.searchsorted(months, [target, target + 1])
+        if window_in_months:
+            start = np.searchsorted(months, target - estimation_window * 12 + 1)
+        else:
+            start = dates.searchsorted(forecast_date - pd.Timedelta(days = DAYS_PER_YEAR * estimation_window),
+                                       side = 'right')
+        window = slice(start, end)
+
+        # The largest firms by their last market cap in the window
+        has_cap = window.start + np.flatnonzero(~np.isnan(market_cap[window]))
+        last_row = np.full(num_firms, -1)
+        np.maximum.at(last_row, firms[has_cap], has_cap)
+        candidates = np.flatnonzero(last_row >= 0)
+        caps = market_cap[last_row[candidates]]
+        largest = candidates[np.argsort(-caps, kind = 'stable')[:company_per_date]]
+
+        selected = np.zeros(num_firms, dtype = bool)
+        selected[largest] = True
+        if min_non_missing is not None:
+            # Firms observed in enough months of the window
+            num_months = len(np.unique(months[window]))
+            coverage = np.bincount(firms[window], minlength = num_firms) / max(num_months, 1)
+            selected &= coverage >= min_non_missing
+
+        # Time series pass on the months up to SKIPPED_MONTHS before the forecast date
+        yesterday = rows[window][(months[window] <= target - SKIPPED_MONTHS) & selected[firms[window]]]
+        loadings = grouped_slopes(firms[yesterday], next_return[yesterday], pma[yesterday], num_firms)
+
+        # Cross sectional pass on the forecast date
+        today = rows[today_start:end][selected[firms[today_start:end]]]
+        today = today[~np.isnan(loadings[firms[today]])]
+        factor, correl = np.nan, np.nan
+        if len(today) > 0:
+            today_codes = np.zeros(len(today), dtype = np.int64)
+            factor = grouped_slopes(today_codes, loadings[firms[today]], pma[today], 1)[0]
+        if len(today) > 1:
+            correl = np.corrcoef(loadings[firms[today]], pma[today])[0, 1]
+        forecasts.append({'Factor': factor,
+                          'Next Month Return': next_return[today_start] if end > today_start else np.nan,
+                          'datadate': forecast_date,
+                          'sorting_loading_correl': correl})
+
+    ret = pd.DataFrame(forecasts, columns = ['Factor', 'Next Month Return', 'datadate', 'sorting_loading_correl'])
+    ret['Intercept'] = 1
+    return ret
+
+
+def forecast_dates(panel, start = START_DATE):
+    """
+    :return: the sorted dates of panel after start
+    """
+    dates = panel.index.get_level_values('datadate').unique().sort_values()
+    return dates[dates > start]
+
+
+if __name__ == '__main__':
+    enable_reports()
+    print_message('Loading Data')
+    crsp = read_frame('merged', columns = ['Cumulative Return', 'Market Cap (Billions, CRSP)'])
+    panel = pma_panel(crsp, load_sp500())
+
+    print_message('Running the 3PRF')
+    forecasts = three_pass_forecasts(panel, forecast_dates(panel))
+    print(forecasts.tail())
+
+    ################ Writing ################
+    write_frame(forecasts, 'forecasts_3prf', fmt = 'hdf')
@@ -1,17 +1,20 @@
 import pandas as pd
 from pandas.tseries.offsets import MonthEnd
-import matplotlib
 from datetime import datetime
-matplotlib.use("TkAgg")
-from multiprocess import Pool, cpu_count
+from os import cpu_count
 import numpy as np
-import scipy as sci
+from dates import parse_month_ends, parse_dates
+from instrumentation import instrumented, phase, peak_memory_mb
+# Only pandas and numpy are loaded with utils. scipy and multiprocess are imported by the functions
+# that use them, and plotting is left to the notebooks, so scripts and worker processes start quickly
+# and no GUI backend is needed.
 # import seaborn as sns
 # import matplotlib.pyplot as plt
 # from copy import copy
 
 
-def clean_data(df, type_dict):
+@instrumented()
+def clean_data(df, type_dict, verbose=True):
     """
     Coerces the columns of df to match the definitions laid out in type_dict.
 
@@ -19,7 +22,8 @@ def clean_data(df, type_dict):
     :param type_dict: a dictionary with three keys that each contain a list of variable name
 
     type_dict['date_vars'] - contains a list of the names of variables that should be coerced
-    to datetimes. The format should be '2000-01-31'.
+    to datetimes at the end of their month. The format should be '2000/01/31'. Each distinct
+    string is only parsed once (see dates.py).
 
     type_dict['float_vars'] - contains a list of the names of variables that should be coerced
     into floats.
@@ -27,27 +31,69 @@ def clean_data(df, type_dict):
     type_dict['int_vars'] - contains a list of the names of variables that should be coerced
     into ints.
 
+    Optional keys (see schema.py):
+
+    type_dict['exact_date_vars'] - variables coerced to datetimes without moving them to the end
+    of the month (e.g. report dates).
+
+    type_dict['float32_vars'] - variables coerced into single precision floats.
+
+    type_dict['nullable_int_vars'] - variables coerced into nullable Int32, which keep missing
+    values without becoming floats.
+
+    type_dict['category_vars'] - variables stored as pandas categoricals.
+
     If the coercion is unsuccessful, a NaN is placed instead.
 
+    :param verbose: if False, the variable names and final data types are not printed
     :return:the dataframe with the new coerced values
     """
-    print('Cleaning date variables:')
+    if verbose:
+        print('Cleaning date variables:')
     for v in type_dict['date_vars']:
-        print(v)
-        df[v] = pd.to_datetime(df[v], format='%Y/%m/%d', errors='coerce', cache=True).dt.tz_localize(None) + MonthEnd(0)
+        if verbose:
+            print(v)
+        df[v] = parse_month_ends(df[v].values)
+
+    for v in type_dict.get('exact_date_vars', []):
+        if verbose:
+            print(v)
+        df[v] = parse_dates(df[v].values)
 
-    print('Cleaning numeric variables:')
+    if verbose:
+        print('Cleaning numeric variables:')
     for v in type_dict['float_vars']:
-        print(v)
+        if verbose:
+            print(v)
         df[v] = pd.to_numeric(df[v], errors='coerce')
 
-    print('Cleaning integer variables:')
+    if verbose:
+        print('Cleaning integer variables:')
     for v in type_dict['int_vars']:
-        print(v)
+        if verbose:
+            print(v)
         df[v] = pd.to_numeric(df[v], downcast='signed', errors='coerce')
 
-    print('Final data types:')
-    print(df.dtypes)
+    for v in type_dict.get('float32_vars', []):
+        if verbose:
+            print(v)
+        df[v] = pd.to_numeric(df[v], errors='coerce').astype(np.float32)
+
+    for v in type_dict.get('nullable_int_vars', []):
+        if verbose:
+            print(v)
+        df[v] = pd.to_numeric(df[v], errors='coerce').round().astype('Int32')
+
+    if verbose:
+        print('Cleaning categorical variables:')
+    for v in type_dict.get('category_vars', []):
+        if verbose:
+            print(v)
+        df[v] = df[v].astype('category')
+
+    if verbose:
+        print('Final data types:')
+        print(df.dtypes)
 
     return df
 
@@ -59,12 +105,10 @@ def check_unique(dataframe, identifier_list):
     or the variables of dataframe
     :return: a dataframe of identifiers that are not uniquely identified along with the counts of
     how many times they occurred. If the dataframe is uniquely identified, the function returns
-    an empty dataframe
+    an empty dataframe. The keys are hashed rather than grouped (see integrity.duplicate_report)
     """
-    unique_identifier = dataframe.groupby(by = identifier_list).count().iloc[:, 0]
-    unique_identifier.name = 'Count'
-    unique_identifier = unique_identifier[unique_identifier > 1]
-    return unique_identifier.to_frame()
+    from integrity import duplicate_report
+    return duplicate_report(dataframe, identifier_list)
 
 def continuous_index(company_dataframe, num_months = 1):
     """
@@ -72,12 +116,22 @@ def continuous_index(company_dataframe, num_months = 1):
     :param company_dataframe -- a dataframe from a groupby object, indexed on Permco and the time variable at level 2
     :param num_months -- the maximum number of months between timestamps
     :returns True or False, depending on whether the return sequence is continuous
+
+    The build scripts use integrity.continuity_report, which checks every Permco at once.
     """
     times = company_dataframe.index.get_level_values('datadate')
-    diffs = times.shift(1, freq = 'M') - times
+    diffs = times.shift(1, freq = MonthEnd()) - times
     return (diffs.max().total_seconds() < 32 * num_months * 24 * 60 * 60)
 
+def Pool(*args, **kwargs):
+    """
+    multiprocess.Pool, imported on first use. The notebooks use it through `from utils import *`
+    """
+    from multiprocess import Pool
+    return Pool(*args, **kwargs)
+
 def print_message(text):
+    phase(text) # Every message starts a phase of the run report (see instrumentation.py)
     print('=====' + text + ' (' + str(datetime.now()) + ') =====')
 
 def safe_index(self, variable_list, **kwargs):
@@ -97,9 +151,11 @@ def safe_drop(self, variable_list, **kwargs):
 pd.DataFrame.safe_drop = safe_drop
 
 
-def parallel_apply(df, group_list, f, num_cores, print_every_n=1000, **kwargs):
+def parallel_apply(df, group_list, f, num_cores, print_every_n=1000, report_timing=False, **kwargs):
     """
-    A lightweight version of apply using the multiprocess library
+    A lightweight version of apply using the multiprocess library. The numeric columns are
+    shared with the worker processes through shared memory instead of being pickled, and df
+    is not modified. See parallel.shared_parallel_apply.
 
     :param df: the pandas dataframe that needs to be grouped
     :param group_list: a list of variable names to group by
@@ -107,6 +163,7 @@ def parallel_apply(df, group_list, f, num_cores, print_every_n=1000, **kwargs):
     :param num_cores: the number of cores to use
     :param print_every_n: a message will be printed every print_every_n groups processed by
     each core. If print_every_n = None, then no messages will be printed
+    :param report_timing: if True, prints the time spent by each worker
 
     :return: a dataframe that has had the apply function done on it
 
@@ -126,51 +183,9 @@ def parallel_apply(df, group_list, f, num_cores, print_every_n=1000, **kwargs):
     serial = df_one_group.groupby(['g1']).apply(slow_max).head()
     assert(np.all(par['data'].values == serial['data'].values))
     """
-
-    # Cut up the dataframes into a list
-    num_cores = int(num_cores)
-    group_numbers = df.groupby(by=group_list).ngroup()
-    group_cuts = group_numbers.quantile(np.linspace(0, 1, num=num_cores + 1), interpolation='nearest').values
-    df['_Group'] = group_numbers
-
-    if print_every_n != None:
-        print('Total of ' + str(group_cuts[-1]) + ' groups')
-
-    cuts = []
-    for ind in range(num_cores - 1):
-        cuts.append(
-            df.loc[(group_numbers >= group_cuts[ind]) & (group_numbers < group_cuts[ind + 1])].groupby(group_list))
-
-    cuts.append(df.loc[(group_numbers >= group_cuts[num_cores - 1]) & (group_numbers <= group_cuts[num_cores])].groupby(
-        group_list))
-
-    # Define functions to be passed to parallel process
-    def verbose_function(dataframe):
-        curr = dataframe['_Group'].values[0]
-        if curr % print_every_n == 0:
-            print('Group: ' + str(curr))
-        return f(dataframe, **kwargs)
-
-    def verbose_func_to_apply(group_by_object):
-        return group_by_object.apply(verbose_function)
-
-    def silent_func_to_apply(group_by_object):
-        return group_by_object.apply(f, **kwargs)
-
-    print('Mapping over: ' + str(len(cuts)) + ' cores')
-    with Pool(num_cores) as p:
-        if print_every_n != None:
-            parallel_results = p.map(verbose_func_to_apply, cuts)
-        else:
-            parallel_results = p.map(silent_func_to_apply, cuts)
-
-    ret = pd.concat(parallel_results)
-    df.safe_drop(['_Group'], inplace=True)
-
-    if len(ret.shape) > 1:  # The case when returning a series
-        ret.safe_drop(['_Group'], inplace=True)
-
-    return ret
+    from parallel import shared_parallel_apply
+    return shared_parallel_apply(df, group_list, f, num_cores, print_every_n=print_every_n,
+                                 report_timing=report_timing, **kwargs)
 
 def weighted_quantile(values, quantiles, sample_weight=None, values_sorted=False, old_style=False):
     """ Very close to numpy.percentile, but supports weights.
@@ -205,19 +220,18 @@ def weighted_quantile(values, quantiles, sample_weight=None, values_sorted=False
 
     weighted_quantiles = np.cumsum(sample_weight)
     weighted_quantiles = weighted_quantiles / weighted_quantiles[-1]
-    return sci.interpolate.interp1d(weighted_quantiles, values, kind = 'next', bounds_error = False, fill_value = (np.min(values), np.max(values)))(quantiles)
+    from scipy.interpolate import interp1d
+    return interp1d(weighted_quantiles, values, kind = 'next', bounds_error = False, fill_value = (np.min(values), np.max(values)))(quantiles)
 
 # Write a few test cases to demonstrate behavior
 def winsorize_at_explicit_input(x, lower_bound, upper_bound):
     """
-    Winsorizes the array x at the lower_bound and upper_bound.
+    Winsorizes the array x at the lower_bound and upper_bound. x is not modified; to winsorize
+    within each date at percentiles, see winsorize.winsorize.
 
     :param x: a numpy array-like object
     :param lower_bound: a scalar for the lower bound
     :param upper_bound: a scalar for the upper bound
     :return: the winsorized array
     """
-    ret = x
-    ret[x < lower_bound] = lower_bound
-    ret[x > upper_bound] = upper_bound
-    return ret
\ No newline at end of file
+    return np.clip(x, lower_bound, upper_bound)
\ No newline at end of file
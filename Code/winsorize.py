@@ -0,0 +1,152 @@
+"""
+Description: Cross-sectional winsorization and standardization of many variables at once, within
+each group of a panel (usually each datadate).
+
+Every variable is handled on arrays for all groups together. The percentile bounds of a variable
+come from a single sort of its values by group and value (see quantiles.py): the position of a
+percentile within each group follows from the number of values of the group, and the bounds of
+every group are read off the sorted array at once. Means and standard deviations are sums over the
+groups with np.bincount. The bounds can be computed on a subset of the rows only (e.g. NYSE stocks)
+and applied to every row.
+
+Missing values are ignored by the bounds and moments and stay missing. Rows with a missing group are
+in no group and their output is missing. The inputs are never modified.
+
+Usage:
+
+features = ['Return Momentum', 'Book to Market', 'Volume (% of Market Cap, 3mma)']
+winsorized = winsorize(merged, features, 0.01, 0.99, exchange_codes = [1])
+z_scores = standardize(winsorized, features)
+z_scores = cross_sectional_transform(merged, features, 0.01, 0.99, z_scores = True, exchange_codes = [1])  # Both at once
+"""
+
+import numpy as np
+import pandas as pd
+from integrity import variable_array
+from quantiles import group_value_order
+
+
+def group_codes(df, group='datadate'):
+    """
+    :param df: a pandas dataframe
+    :param group: the variable that defines the groups (column or index level)
+    :return: a tuple of the group code of every row (-1 for a missing group) and the number of groups
+    """
+    codes, uniques = pd.factorize(np.asarray(variable_array(df, group)))
+    return codes, len(uniques)
+
+
+def breakpoint_mask(df, exchange_codes=None, exchange_variable='Exchange Code'):
+    """
+    :return: a boolean numpy array of the rows whose exchange code is in exchange_codes, or None for every row
+    """
+    return None if exchange_codes is None else df[exchange_variable].isin(exchange_codes).to_numpy(dtype=bool)
+
+
+def grouped_percentiles(values, codes, num_groups, quantiles, mask=None):
+    """
+    Same as np.nanpercentile(values[group], 100 * quantiles) for every group (linear interpolation)
+
+    :param values: a float numpy array
+    :param codes: an integer numpy array with the group of every value, from 0 to num_groups - 1, or -1 for none
+    :param num_groups: the number of groups
+    :param quantiles: a list of quantiles in [0, 1]
+    :param mask: a boolean numpy array of the values used, or None for every value
+    :return: an array of shape (len(quantiles), num_groups). Groups without values are missing
+    """
+    keep = ~np.isnan(values) & (codes >= 0)
+    if mask is not None:
+        keep &= mask
+    kept_values = values[keep]
+    kept_codes = codes[keep]
+
+    # Each group's values are contiguous and sorted
+    sorted_values = kept_values[group_value_order(kept_values, kept_codes)]
+
+    counts = np.bincount(kept_codes, minlength=num_groups)
+    starts = np.cumsum(counts) - counts
+    has_values = counts > 0
+    ret = np.full((len(quantiles), num_groups), np.nan)
+    for i, q in enumerate(quantiles):
+        position = q * (counts[has_values] - 1)
+        below = np.floor(position).astype(np.int64)
+        above = np.minimum(below + 1, counts[has_values] - 1)
+        low = sorted_values[starts[has_values] + below]
+        high = sorted_values[starts[has_values] + above]
+        ret[i, has_values] = low + (position - below) * (high - low)
+    return ret
+
+
+def grouped_moments(values, codes, num_groups, mask=None):
+    """
+    :return: a tuple of arrays with the mean and standard deviation (ddof = 1) of the values of every group,
+    ignoring missing values and values without a group. The standard deviation is missing for groups with
+    fewer than two values
+    """
+    keep = ~np.isnan(values) & (codes >= 0)
+    if mask is not None:
+        keep &= mask
+    kept_values = values[keep]
+    kept_codes = codes[keep]
+    n = np.bincount(kept_codes, minlength=num_groups).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(kept_codes, kept_values, num_groups) / n
+        deviations = kept_values - mean[kept_codes]
+        std = np.sqrt(np.bincount(kept_codes, deviations * deviations, num_groups) / (n - 1))
+    std[n < 2] = np.nan
+    return mean, std
+
+
+def cross_sectional_transform(df, variables, lower=None, upper=None, z_scores=False, group='datadate',
+                              exchange_codes=None, exchange_variable='Exchange Code'):
+    """
+    Winsorizes and/or standardizes every variable within each group, in one pass over the variables
+
+    :param df: a pandas dataframe, e.g. merged
+    :param variables: a list of numeric variables
+    :param lower: the quantile of the lower bound, or None for no lower bound
+    :param upper: the quantile of the upper bound, or None for no upper bound
+    :param z_scores: if True, the (winsorized) values minus their group mean, over their group standard deviation
+    :param group: the variable that defines the cross sections (column or index level)
+    :param exchange_codes: a list of exchange codes whose stocks set the percentile bounds (e.g. [1] for NYSE),
+    or None for every stock. The bounds apply to every stock; means and standard deviations use every stock
+    :param exchange_variable: the variable with the exchange codes
+    :return: a float dataframe aligned with df with the transformed variables. Values of groups without
+    bounds are not clipped, and values without a group are missing
+    """
+    codes, num_groups = group_codes(df, group)
+    no_group = codes < 0
+    mask = breakpoint_mask(df, exchange_codes, exchange_variable)
+    quantiles = [q for q in [lower, upper] if q is not None]
+
+    ret = {}
+    for variable in variables:
+        values = df[variable].to_numpy(dtype=np.float64, na_value=np.nan)
+        if len(quantiles) > 0:
+            bounds = grouped_percentiles(values, codes, num_groups, quantiles, mask)
+            # Groups without bounds are not clipped; missing values stay missing
+            low = np.nan_to_num(bounds[0], nan=-np.inf) if lower is not None else np.full(num_groups, -np.inf)
+            high = np.nan_to_num(bounds[-1], nan=np.inf) if upper is not None else np.full(num_groups, np.inf)
+            values = np.clip(values, low[codes], high[codes])
+        if z_scores:
+            mean, std = grouped_moments(values, codes, num_groups)
+            values = (values - mean[codes]) / std[codes]
+        # codes of -1 read the bounds and moments of the last group
+        values[no_group] = np.nan
+        ret[variable] = values
+    return pd.DataFrame(ret, index=df.index, columns=list(variables))
+
+
+def winsorize(df, variables, lower=0.01, upper=0.99, group='datadate', exchange_codes=None,
+              exchange_variable='Exchange Code'):
+    """
+    Clips every variable at its lower and upper percentiles within each group (see cross_sectional_transform)
+    """
+    return cross_sectional_transform(df, variables, lower, upper, False, group, exchange_codes, exchange_variable)
+
+
+def standardize(df, variables, group='datadate'):
+    """
+    Z-scores of every variable within each group (see cross_sectional_transform)
+    """
+    return cross_sectional_transform(df, variables, None, None, True, group)
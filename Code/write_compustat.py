@@ -12,23 +12,28 @@ Last Updated: Jan 5, 2018
 
 # Custom functions
 from utils import *
+from instrumentation import enable_reports
+from ingest import read_chunked
+from dedup import select_least_missing
+from ytd import decumulate_ytd
+from storage import write_frame
+from schema import schema_from_types, apply_schema
+from integrity import continuity_report, print_continuity
+from state import write_state, last_fiscal_year
 import numpy as np
-from copy import copy
-from multiprocessing import Pool, cpu_count
 
-################ Import Data ################
-print_message('Loading Data')
-compustat_raw = pd.read_csv('../Data/compustat-merged.txt', sep = '\t', low_memory = False)#, nrows = 10000)
+CHUNKSIZE = 1000000 # Number of rows of the raw file parsed at a time
 
 ################ Types ################
-print_message('Defining Types')
 compustat_datatypes = {'date_vars': ['datadate'],
-                 'float_vars': ['cogsq', 'cshopq', 'cshoq', 'dpq', 'oiadpq', 'oibdpq', 'prcraq', 'saleq', 'txpq', 'xintq', 'xsgaq', 'aqcy', 'capxy', 'dvy', 'fincfy', 'oancfy', 'prccq', 'seqq', 'ceqq', 'pstkrq', 'atq', 'ltq', 'cheq'],
-                 'int_vars': ['GVKEY', 'LPERMNO', 'LPERMCO', 'fyearq', 'fqtr', 'cusip', 'exchg', 'cik', 'naics']}
-compustat = clean_data(copy(compustat_raw), compustat_datatypes)
+                 'exact_date_vars': ['rdq'],
+                 'float_vars': [],
+                 'float32_vars': ['cogsq', 'cshopq', 'cshoq', 'dpq', 'oiadpq', 'oibdpq', 'prcraq', 'saleq', 'txpq', 'xintq', 'xsgaq', 'aqcy', 'capxy', 'dvy', 'fincfy', 'oancfy', 'prccq', 'seqq', 'ceqq', 'pstkrq', 'atq', 'ltq', 'cheq', 'txditcq', 'dlttq', 'dlcq', 'niq', 'epsfiq', 'epsfxq', 'dltisy', 'dltry', 'cshfdq'],
+                 'int_vars': ['LPERMCO', 'cusip', 'exchg'],
+                 'nullable_int_vars': ['GVKEY', 'LPERMNO', 'fyearq', 'fqtr', 'cik', 'naics'],
+                 'category_vars': ['conm', 'curcdq']}
 
 ################ Renaming Concepts ################
-print_message('Renaming Features')
 compustat_names = \
     {  # Identifiers
         'GVKEY': 'Gvkey',
@@ -82,74 +87,95 @@ compustat_names = \
         'cshoq': 'Shares Outstanding (Compustat)',
         'prccq': 'Price (Compustat)',
         'cshfdq': 'Shares Outstanding for EPS'}
-compustat = compustat.rename(index=str, columns=compustat_names)
-compustat = compustat[list(compustat_names.values())]
-compustat = compustat.set_index(['Permco', 'datadate'])
-
-################ Dropping to Unique Identifiers ################
-# At this level, data should be identified by Permco - datadate. Count the number of non-valid variables for
-# each combination, pick the one with the fewer null entries
-
-print_message('Generating Unique Identifiers')
-def select_least_missing(dataframe):
-    dataframe.safe_drop(['_Group'], inplace = True) # Addition to make it work well with the parallel process
-    dataframe['Missing Count'] = dataframe.isnull().sum(axis = 1)
-    dataframe.sort_values(by = ['Missing Count'], ascending = True, inplace = True)
-    return dataframe.iloc[0, :]
-
-compustat = parallel_apply(compustat, ['Permco', 'datadate'], select_least_missing, 2, None)
-print_message('Finished parallel process')
-
-################ Reshaping the Annual Data ################
-print_message('Converting yearly to quarterly data')
+
+################ Quarterly Variables ################
+# Cash flow variables are reported fiscal year to date
 yearly_variables = sorted([compustat_names[x] for x in list(compustat_names.keys()) if x[-1] == 'y'])
 
-def take_diffs(x):
+################ Schema ################
+# Types of the output (see schema.py)
+COMPUSTAT_SCHEMA = schema_from_types(compustat_datatypes, compustat_names)
+
+
+def load_compustat(path = '../Data/compustat-merged.txt', row_filter = None, chunksize = CHUNKSIZE):
     """
-    Takes a Series of a "year to date" variable and converts it into a quarterly variable
+    Reads the raw Compustat file. Only the variables in compustat_names are read.
 
-    param x: a Series of a year to date variable, e.g. capex year to date
-    :return: a Series of the quarterly variable
+    :param path: the path to the raw tab-separated Compustat file
+    :param row_filter: a row filter from ingest.py (e.g. only new dates), or None
+    :param chunksize: the number of rows parsed at a time
+    :return: the typed dataframe with the renamed variables, indexed on Permco and datadate
     """
+    print_message('Loading Data')
+    compustat = read_chunked(path, compustat_datatypes, columns = list(compustat_names.keys()),
+                             row_filter = row_filter, chunksize = chunksize)
 
-    if all(np.isnan(x)):
-        return x
-    x = x.fillna(0)
-    ret = x.diff()
-    ret[0] = x[0]
-    return ret
+    print_message('Renaming Features')
+    compustat = compustat.rename(index=str, columns=compustat_names)
+    compustat = compustat[list(compustat_names.values())]
+    return compustat.set_index(['Permco', 'datadate'])
 
-def take_diff_across_columns(dataframe):
-    dataframe.safe_drop(['_Group'], inplace = True) # Addition to make it work well with the parallel process
-    ret = dataframe.transform(take_diffs)
-    return ret
 
-compustat = compustat.safe_index(['Permco', 'datadate', 'Fiscal Year'])
-compustat_yearly = compustat.loc[:, yearly_variables]
+def deduplicate_compustat(compustat):
+    """
+    At this level, data should be identified by Permco - datadate. Count the number of non-valid variables for
+    each combination, pick the one with the fewer null entries
+    """
+    print_message('Generating Unique Identifiers')
+    # Ties go to the most recent report, then to the lowest Gvkey
+    return select_least_missing(compustat, ['Permco', 'datadate'], tie_breakers = ['Report Date', 'Gvkey'],
+                                tie_ascending = [False, True])
 
-# compustat_yearly = parallel_apply(compustat_yearly, ['Permco', 'Fiscal Year'], take_diff_across_columns, 2, None)
-compustat[yearly_variables] = compustat[yearly_variables].groupby(['Permco', 'Fiscal Year']).transform(take_diffs)
 
-################ Data Integrity ################
+def quarterly_cash_flows(compustat, history = None):
+    """
+    Converts the year to date variables into quarterly variables
 
-compustat = compustat.safe_index(['Permco', 'datadate'])
+    :param compustat: the output of deduplicate_compustat
+    :param history: the year to date values of the latest fiscal year already processed (see
+    state.last_fiscal_year), used when only new quarters are being processed. None when building
+    from the full history
+    :return: compustat with quarterly values for yearly_variables
+    """
+    print_message('Converting yearly to quarterly data')
+    combined = compustat if history is None else pd.concat([history, compustat[history.columns]])
 
-# Check now that Permco + datadate uniquely identify each observation
-duplicated_values = check_unique(compustat, ['Permco', 'datadate'])
-print('Duplicated Permco - datadate pairs')
-print(duplicated_values)
-assert(duplicated_values.shape[0] == 0)
+    # Quarters are matched on Fiscal Quarter within Permco - Fiscal Year, so a missing report
+    # leaves the next quarter missing instead of absorbing two quarters of cash flow
+    quarterly = decumulate_ytd(combined, yearly_variables, ['Permco', 'Fiscal Year'], 'Fiscal Quarter')
+    compustat[yearly_variables] = quarterly.iloc[quarterly.shape[0] - compustat.shape[0]:].values
+    return apply_schema(compustat.safe_index(['Permco', 'datadate']), COMPUSTAT_SCHEMA, 'compustat')
 
-# Check that dates are contiguous
-valid_returns = parallel_apply(compustat, ['Permco'], continuous_index, 2, None)
-discontinuous_returns = valid_returns.loc[~valid_returns]
-print('Companies without continuous dates')
-print(discontinuous_returns)
-assert(discontinuous_returns.shape[0] == 0)
 
-################ Outputting Data ################
-print_message('Outputting Data')
-compustat.to_hdf('../Output/compustat.h5', 'compustat')
+def verify_compustat(compustat):
+    """
+    Checks that Permco + datadate uniquely identify each observation and reports the Permcos whose
+    quarterly dates are not contiguous
 
-with open('../Logs/compustat.log', 'w') as f:
-    f.write('Raw Compustat file has been written')
+    :return: the continuity report of every Permco (see integrity.continuity_report)
+    """
+    print_message('Verifying data integrity')
+    duplicated_values = check_unique(compustat, ['Permco', 'datadate'])
+    print('Duplicated Permco - datadate pairs')
+    print(duplicated_values)
+    assert(duplicated_values.shape[0] == 0)
+
+    # Check that dates are contiguous: one report every quarter
+    continuity = continuity_report(compustat, 'Permco', 'datadate', max_gap_months = 3)
+    print_continuity(continuity, 'Companies without continuous dates')
+    return continuity
+
+
+if __name__ == '__main__':
+    enable_reports()
+    compustat = deduplicate_compustat(load_compustat())
+    write_state(last_fiscal_year(compustat[['Fiscal Year', 'Fiscal Quarter'] + yearly_variables]), 'compustat')
+    compustat = quarterly_cash_flows(compustat)
+    verify_compustat(compustat)
+
+    ################ Outputting Data ################
+    print_message('Outputting Data')
+    write_frame(compustat, 'compustat_clean')
+
+    with open('../Logs/compustat.log', 'w') as f:
+        f.write('Raw Compustat file has been written')
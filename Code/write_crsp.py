@@ -11,30 +11,26 @@ individual share classes.
 
 # Custom functions for data cleaning
 from utils import *
+from instrumentation import enable_reports
+from aggregation import aggregate_groups
+from ingest import read_chunked, share_code_filter, combine_filters
+from storage import write_frame
+from schema import schema_from_types, apply_schema
+from integrity import continuity_report, print_continuity
 import numpy as np
-from copy import copy
 
 # Proper data cleaning
-################ Import Data ################
-print_message('Loading Data')
-crsp_raw = pd.read_csv('../Data/crsp.txt', sep = '\t', low_memory = False)#, nrows = 10000)
+CHUNKSIZE = 1000000 # Number of rows of the raw file parsed at a time
 
-# Filter down to only common shares
-crsp_raw = crsp_raw.loc[(crsp_raw['SHRCD'] == 10) | (crsp_raw['SHRCD'] == 11)]
-
-print('Data Size:')
-print(crsp_raw.shape)
-print(str(crsp_raw.shape[0] * crsp_raw.shape[1]) + ' observations')
-
-################ Setting Types ################
-print_message('Setting Types')
+################ Types ################
 crsp_datatypes = {'date_vars': ['date'],
-                 'float_vars': ['BIDLO', 'ASKHI', 'PRC', 'RET', 'DLRET', 'BID', 'ASK', 'RETX', 'CFACPR', 'CFACSHR'],
-                 'int_vars': ['PERMNO', 'PERMCO', 'HSICCD', 'CUSIP', 'SHROUT', 'VOL', 'EXCHCD']}
-crsp = clean_data(copy(crsp_raw), crsp_datatypes)
+                 'float_vars': ['RET', 'DLRET', 'RETX', 'CFACPR', 'CFACSHR'],
+                 'float32_vars': ['BIDLO', 'ASKHI', 'PRC', 'BID', 'ASK'],
+                 'int_vars': ['PERMCO', 'CUSIP', 'SHROUT', 'VOL', 'EXCHCD'],
+                 'nullable_int_vars': ['PERMNO', 'HSICCD'],
+                 'category_vars': ['COMNAM', 'TICKER', 'SHRCLS']}
 
-################ Setting Types ################
-print_message('Renaming Variables')
+################ Names ################
 crsp_names = {'RET': 'Return',
               'SHROUT': 'Shares Outstanding on Trading Day',
               'COMNAM': 'Company Name',
@@ -51,21 +47,8 @@ crsp_names = {'RET': 'Return',
               'CFACPR': 'Price Adjustment Factor',
               'CFACSHR': 'Share Adjustment Factor'}
 
-crsp = crsp.rename(index = str, columns = crsp_names)
-crsp = crsp[list(crsp_names.values())]
-
-# Make a few fundamental variables
-print_message('Create new features')
-crsp['Imputed Price'] = (crsp['Price with Flag'] < 0)
-crsp['Price on Trading Day'] = np.abs(crsp['Price with Flag'])
-crsp['Price'] = crsp['Price on Trading Day'] / crsp['Price Adjustment Factor']
-crsp['Shares Outstanding'] = crsp['Shares Outstanding on Trading Day'] * crsp['Share Adjustment Factor']
-crsp['Volume'] = crsp['Volume on Trading Day'] * crsp['Share Adjustment Factor']
-crsp['Market Cap (Billions, CRSP)'] = crsp['Shares Outstanding'] * crsp['Price'] / 1e6
-crsp = crsp.drop(['Price on Trading Day', 'Shares Outstanding on Trading Day', 'Volume on Trading Day'], axis = 1)
-
-################
-print_message('Aggregating share classes')
+################ Share Classes ################
+# Each key is an aggregation kind defined in aggregation.AGGREGATORS
 AGG_VAR_TYPES = {'First': ['Company Name', 'Permno', 'Ticker', 'Price', 'Bid', 'Ask', 'Exchange Code'],
                  'Add': ['Market Cap (Billions, CRSP)'],
                  'Market Cap Weighted Sum': ['Return'],
@@ -73,94 +56,111 @@ AGG_VAR_TYPES = {'First': ['Company Name', 'Permno', 'Ticker', 'Price', 'Bid', '
 
 ALL_CRSP_VAR = [item for sublist in AGG_VAR_TYPES.values() for item in sublist]
 
-def agg_share_classes(company_on_date):
-    """
-    Given a dataframe grouped on Permco and datadate, aggregates up the key variables from the individual
-    share classes. THe operation done on each variable is defined by the global dictionary AGG_
-
-    :param company_on_date - a dataframe from a pandas groupby object with all the variables inside ALL_CRSP_VAR
-    :return a dataframe with one row that has all the variables in ALL_CRSP_VAR, agrgregated across the share classes
-    """
-
-    company_on_date.safe_drop(['_Group'], inplace = True) # Addition to make it work well with the parallel process
-
-    # If only one share class
-    if company_on_date.shape[1] <= 1:
-        return company_on_date[ALL_CRSP_VAR]
-
-    # Then for the remainign cases
-    company_on_date['Market Cap (Billions, CRSP)'].fillna(0)
-    company_on_date.sort_values(by = ['Market Cap (Billions, CRSP)'], ascending = False, inplace = True)
-    new_frame = company_on_date.iloc[0, :][AGG_VAR_TYPES['First']]
+################ Schema ################
+# Types of the output (see schema.py)
+CRSP_SCHEMA = dict(schema_from_types(crsp_datatypes, crsp_names),
+                   **{'Price': 'float32', 'Volume': 'float32', 'Market Cap (Billions, CRSP)': 'float32'})
 
-    for v in AGG_VAR_TYPES['Add']:
-        new_frame[v] = company_on_date[v].fillna(0).sum()
 
-    for v in AGG_VAR_TYPES['Market Cap Weighted Sum']:
-        valid = ~company_on_date[v].isnull()
-        denominator = company_on_date.loc[valid, 'Market Cap (Billions, CRSP)'].sum()
-
-        if denominator > 0:
-            new_frame[v] = (company_on_date.loc[valid, v] * company_on_date.loc[
-                valid, 'Market Cap (Billions, CRSP)']).sum() / denominator
-        else:
-            new_frame[v] = company_on_date[v][0]
-
-    for v in AGG_VAR_TYPES['Price Weighted Sum']:
-        valid = ~company_on_date[v].isnull()
-        denominator = new_frame['Price']
+def load_crsp(path = '../Data/crsp.txt', row_filter = None, chunksize = CHUNKSIZE):
+    """
+    Reads the raw CRSP file. Only the variables in crsp_names are read and only common shares are kept.
 
-        if denominator > 0:
-            new_frame[v] = (company_on_date.loc[valid, v] * company_on_date.loc[
-                valid, 'Price']).sum() / denominator
-        else:
-            new_frame[v] = company_on_date[v][0]
+    :param path: the path to the raw tab-separated CRSP file
+    :param row_filter: an additional row filter from ingest.py (e.g. only new dates), or None
+    :param chunksize: the number of rows parsed at a time
+    :return: the typed dataframe with the renamed variables
+    """
+    print_message('Loading Data')
+    crsp_filter = share_code_filter((10, 11))
+    if row_filter is not None:
+        crsp_filter = combine_filters(crsp_filter, row_filter)
+    crsp = read_chunked(path, crsp_datatypes, columns = list(crsp_names.keys()),
+                        row_filter = crsp_filter, chunksize = chunksize)
 
-    return new_frame
+    print('Data Size:')
+    print(crsp.shape)
+    print(str(crsp.shape[0] * crsp.shape[1]) + ' observations')
 
-# First, pull every permco-date that isn't paired
-crsp = crsp.set_index(['Permco', 'datadate'])
-crsp_counts = check_unique(crsp, ['Permco', 'datadate'])
+    print_message('Renaming Variables')
+    crsp = crsp.rename(index = str, columns = crsp_names)
+    return crsp[list(crsp_names.values())]
 
-# Then isolate the problem observations
-crsp_merge = crsp_counts.join(crsp, how = 'outer')
-problem_children = crsp_merge.loc[~pd.isnull(crsp_merge['Count']), ALL_CRSP_VAR]
 
-if problem_children.shape[0] > 0:
-    good_children = crsp_merge.loc[pd.isnull(crsp_merge['Count']), ALL_CRSP_VAR]
-    merged_problems = parallel_apply(problem_children, ['Permco', 'datadate'], agg_share_classes, 2, None)
-    merged_problems = merged_problems[ALL_CRSP_VAR]
+def build_crsp(crsp):
+    """
+    Builds the basic variables, collapses share classes and drops null returns
 
-    # Combine the dataframes together again
-    crsp_merge = pd.concat([good_children[ALL_CRSP_VAR], merged_problems])
+    :param crsp: the output of load_crsp
+    :return: a dataframe uniquely identified by Permco - datadate with the variables in ALL_CRSP_VAR
+    """
+    # Make a few fundamental variables
+    print_message('Create new features')
+    crsp['Imputed Price'] = (crsp['Price with Flag'] < 0)
+    crsp['Price on Trading Day'] = np.abs(crsp['Price with Flag'])
+    crsp['Price'] = crsp['Price on Trading Day'] / crsp['Price Adjustment Factor']
+    crsp['Shares Outstanding'] = crsp['Shares Outstanding on Trading Day'] * crsp['Share Adjustment Factor']
+    crsp['Volume'] = crsp['Volume on Trading Day'] * crsp['Share Adjustment Factor']
+    crsp['Market Cap (Billions, CRSP)'] = crsp['Shares Outstanding'] * crsp['Price'] / 1e6
+    crsp = crsp.drop(['Price on Trading Day', 'Shares Outstanding on Trading Day', 'Volume on Trading Day'], axis = 1)
+
+    ################
+    print_message('Aggregating share classes')
+
+    # First, pull every permco-date that isn't paired
+    crsp = crsp.set_index(['Permco', 'datadate'])
+    crsp_counts = check_unique(crsp, ['Permco', 'datadate'])
+
+    # Then isolate the problem observations
+    crsp_merge = crsp_counts.join(crsp, how = 'outer')
+    problem_children = crsp_merge.loc[~pd.isnull(crsp_merge['Count']), ALL_CRSP_VAR]
+
+    if problem_children.shape[0] > 0:
+        good_children = crsp_merge.loc[pd.isnull(crsp_merge['Count']), ALL_CRSP_VAR]
+        merged_problems = aggregate_groups(problem_children, AGG_VAR_TYPES, 'Market Cap (Billions, CRSP)')
+        merged_problems = merged_problems[ALL_CRSP_VAR]
+
+        # Combine the dataframes together again
+        crsp_merge = pd.concat([good_children[ALL_CRSP_VAR], merged_problems])
+    else:
+        crsp_merge = crsp_merge[ALL_CRSP_VAR]
+
+    print_message('Dropping Null Returns')
+    crsp_merge = crsp_merge.loc[~pd.isnull(crsp_merge['Return'])]
+    return apply_schema(crsp_merge.safe_index(['Permco', 'datadate']), CRSP_SCHEMA, 'crsp')
+
+
+def verify_crsp(crsp_merge):
+    """
+    Check final assumptions on the data
+    1. Permco + datadate uniquely identify each observation
+    2. For each permco, there is a continuous stream of returns without interruption. Gaps are
+    reported rather than asserted: months with a null return are dropped above
 
-print_message('Dropping Null Returns')
-crsp_merge = crsp_merge.loc[~pd.isnull(crsp_merge['Return'])]
+    :return: the continuity report of every Permco (see integrity.continuity_report)
+    """
+    print_message('Verifying data integrity')
 
-#######
-print_message('Verifying data integrity')
-crsp_merge = crsp_merge.safe_index(['Permco', 'datadate'])
+    # Unique identification
+    duplicated_values = check_unique(crsp_merge, ['Permco', 'datadate'])
+    print('Duplicated permco-date pairs')
+    print(duplicated_values)
+    assert(duplicated_values.shape[0] == 0)
 
-# Check final assumptions on the data
-# 1. Permco + datadate uniquely identify each observation
-# 2. For each permco, there is a continuous stream of returns without interruption
+    # Continuity of returns
+    continuity = continuity_report(crsp_merge, 'Permco', 'datadate', max_gap_months = 1)
+    print_continuity(continuity, 'Companies without continuous returns')
+    return continuity
 
-# Unique identification
-duplicated_values = check_unique(crsp_merge, ['Permco', 'datadate'])
-print('Duplicated permco-date pairs')
-print(duplicated_values)
-assert(duplicated_values.shape[0] == 0)
 
-# Continuity of returns
-valid_returns = parallel_apply(crsp_merge, ['Permco'], continuous_index, 2, None)
-discontinuous_returns = valid_returns.loc[~valid_returns]
-print('Companies without continuous returns')
-print(discontinuous_returns)
-assert(discontinuous_returns.shape[0] == 0)
+if __name__ == '__main__':
+    enable_reports()
+    crsp_merge = build_crsp(load_crsp())
+    verify_crsp(crsp_merge)
 
-################
-print_message('Outputting Data')
-crsp_merge.to_hdf('../Output/crsp.h5', 'crsp')
+    ################
+    print_message('Outputting Data')
+    write_frame(crsp_merge, 'crsp_clean')
 
-with open('../Logs/crsp.log', 'w') as f:
-    f.write('Raw CRSP file has been written')
+    with open('../Logs/crsp.log', 'w') as f:
+        f.write('Raw CRSP file has been written')
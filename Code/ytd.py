@@ -0,0 +1,75 @@
+"""
+Description: Converts Compustat "year to date" variables (the cash flow statement items whose
+names end in 'y') into quarterly values.
+
+Rows are matched to the previous fiscal quarter of the same firm and fiscal year, rather than
+to the previous row, so a missing Q2 report makes Q3 missing instead of attributing the first
+three quarters of cash flow to Q3. Every variable is converted at once with array operations.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def variable_values(df, variable):
+    """
+    :return: a numpy array with the values of variable, whether it is a column or an index level of df
+    """
+    return df[variable].values if variable in df.columns else df.index.get_level_values(variable).values
+
+
+def decumulate_ytd(df, columns, group_list=('Permco', 'Fiscal Year'), quarter_variable='Fiscal Quarter',
+                   fill_missing=True, keep_all_nan=True):
+    """
+    Takes year to date variables and converts them into quarterly variables. Q1 keeps its year to
+    date value, and quarter q is the year to date value of q minus the year to date value of q - 1
+    in the same group. If the report of quarter q - 1 is absent, quarter q is missing.
+
+    :param df: a pandas dataframe. It is not modified
+    :param columns: a list of the year to date variables to convert
+    :param group_list: the variables (columns or index levels) that identify a firm's fiscal year
+    :param quarter_variable: the variable with the fiscal quarter, 1 to 4
+    :param fill_missing: if True, missing year to date values count as zero within a group, as in
+    the original take_diffs. If False, missing values propagate to the quarters that depend on them
+    :param keep_all_nan: when fill_missing is True, whether a group where a variable is always
+    missing stays missing (True) or becomes zeros (False)
+    :return: a dataframe with the same index as df and the quarterly values of columns
+
+    Usage:
+
+    df = pd.DataFrame({'Permco': 1, 'Fiscal Year': 2000, 'Fiscal Quarter': [1, 2, 4], 'Capex': [1., 3., 10.]})
+    ret = decumulate_ytd(df, ['Capex'])
+    assert(np.allclose(ret['Capex'].values, [1, 2, np.nan], equal_nan=True))
+    """
+    group_list = list(group_list)
+    group_numbers = df.groupby(by=group_list, sort=False, dropna=False).ngroup().values
+    quarters = pd.to_numeric(pd.Series(variable_values(df, quarter_variable)), errors='coerce').to_numpy(
+        dtype=np.float64, na_value=np.nan)
+
+    values = df[columns].to_numpy(dtype=np.float64, copy=True)
+    missing = np.isnan(values)
+    if fill_missing:
+        values[missing] = 0
+
+    # Sort by group and quarter; the previous row is usable if it is the previous quarter of the same group
+    order = np.lexsort((quarters, group_numbers))
+    sorted_values = values[order]
+    sorted_groups = group_numbers[order]
+    sorted_quarters = quarters[order]
+
+    has_previous = np.zeros(len(order), dtype=bool)
+    has_previous[1:] = (sorted_groups[1:] == sorted_groups[:-1]) & (sorted_quarters[1:] == sorted_quarters[:-1] + 1)
+
+    previous = np.full(sorted_values.shape, np.nan)
+    previous[1:] = sorted_values[:-1]
+    previous[~has_previous] = np.nan
+    previous[sorted_quarters == 1] = 0
+
+    ret = np.empty(values.shape)
+    ret[order] = sorted_values - previous
+
+    if fill_missing and keep_all_nan:
+        present_in_group = pd.DataFrame(~missing).groupby(group_numbers).transform('any').values
+        ret[~present_in_group] = np.nan
+
+    return pd.DataFrame(ret, index=df.index, columns=columns)
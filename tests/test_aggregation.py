@@ -0,0 +1,46 @@
+import pandas as pd
+from synthetic import make_crsp_share_classes
+from aggregation import aggregate_groups
+from write_crsp import AGG_VAR_TYPES
+
+
+def agg_share_classes_reference(company_on_date, agg_var_types):
+    # The per-group aggregation that write_crsp.py used to run through parallel_apply
+    company_on_date = company_on_date.sort_values(by=['Market Cap (Billions, CRSP)'], ascending=False)
+    new_frame = company_on_date.iloc[0, :][agg_var_types['First']]
+
+    for v in agg_var_types['Add']:
+        new_frame[v] = company_on_date[v].fillna(0).sum()
+
+    for v in agg_var_types['Market Cap Weighted Sum']:
+        valid = ~company_on_date[v].isnull()
+        denominator = company_on_date.loc[valid, 'Market Cap (Billions, CRSP)'].sum()
+        if denominator > 0:
+            new_frame[v] = (company_on_date.loc[valid, v] * company_on_date.loc[
+                valid, 'Market Cap (Billions, CRSP)']).sum() / denominator
+        else:
+            new_frame[v] = company_on_date[v].iloc[0]
+
+    for v in agg_var_types['Price Weighted Sum']:
+        valid = ~company_on_date[v].isnull()
+        denominator = new_frame['Price']
+        if denominator > 0:
+            new_frame[v] = (company_on_date.loc[valid, v] * company_on_date.loc[valid, 'Price']).sum() / denominator
+        else:
+            new_frame[v] = company_on_date[v].iloc[0]
+
+    return new_frame
+
+
+def test_aggregate_groups_matches_share_class_loop():
+    crsp = make_crsp_share_classes(num_firms=60, num_months=12)
+    problem_children = crsp.loc[crsp.index.duplicated(keep=False)]
+    variables = [v for variables in AGG_VAR_TYPES.values() for v in variables]
+
+    expected = problem_children.groupby(level=['Permco', 'datadate']).apply(
+        lambda d: agg_share_classes_reference(d, AGG_VAR_TYPES))
+    result = aggregate_groups(problem_children, AGG_VAR_TYPES, 'Market Cap (Billions, CRSP)')
+
+    assert problem_children.shape[0] > 0
+    pd.testing.assert_frame_equal(expected[variables].infer_objects(), result[variables], check_dtype=False,
+                                  check_names=False)
@@ -0,0 +1,21 @@
+import pandas as pd
+from synthetic import make_merged_panel, make_compustat_panel
+from asof import asof_merge
+
+
+def join_ffill_reference(crsp, compustat):
+    # merge_crsp_compustat.py before asof_merge: a join on datadate, then a forward fill within each Permco
+    merged = crsp.join(compustat, how='left', rsuffix='.comp')
+    return merged.groupby(level='Permco').ffill()
+
+
+def test_asof_merge_on_datadate_matches_forward_fill():
+    crsp = make_merged_panel(num_firms=30, num_months=60, num_float_variables=2)
+    compustat = make_compustat_panel(num_firms=30, num_years=5, duplicate_share=0, missing_share=0).sort_index()
+
+    expected = join_ffill_reference(crsp, compustat)
+    result = asof_merge(crsp, compustat, report_variable=None, fallback_lag_months=0)
+
+    # Without missing values and lags, the as-of merge on datadate is the same as the forward fill
+    variables = compustat.columns.drop('Exchange Code').tolist()
+    pd.testing.assert_frame_equal(expected[variables], result[variables], check_dtype=False)
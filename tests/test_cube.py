@@ -0,0 +1,19 @@
+import numpy as np
+from synthetic import make_merged_panel
+from cube import write_cube, open_cube, cross_section, firm_history
+
+
+def test_cube_slices_match_xs(tmp_path):
+    merged = make_merged_panel(num_firms=100, num_months=36, num_float_variables=2)
+    merged = merged.loc[np.random.RandomState(0).random_sample(merged.shape[0]) > 0.3] # Firms enter and exit
+    write_cube(merged, ['Return', 'Market Cap (Billions, CRSP)', 'Cumulative Return'], str(tmp_path / 'cube'))
+    cube = open_cube(str(tmp_path / 'cube'))
+
+    for date in merged.index.get_level_values('datadate').unique()[::5]:
+        expected = merged.xs(date, level='datadate')['Market Cap (Billions, CRSP)'].values
+        section = cross_section(cube, date, 'Market Cap (Billions, CRSP)')
+        np.testing.assert_array_equal(expected, section[~np.isnan(section)])
+    for permco in merged.index.get_level_values('Permco').unique()[::10]:
+        expected = merged.xs(permco, level='Permco')['Return'].values
+        history = firm_history(cube, permco, 'Return')
+        np.testing.assert_array_equal(expected, history[~np.isnan(history)])
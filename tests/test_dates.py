@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+from dates import parse_month_ends, parse_dates
+
+
+def month_ends_reference(values):
+    # clean_data before dates.py: every row parsed by pd.to_datetime, then moved to its month end
+    return pd.to_datetime(values, format='%Y/%m/%d', errors='coerce') + pd.offsets.MonthEnd(0)
+
+
+def dates_reference(values):
+    return pd.to_datetime(values, format='%Y/%m/%d', errors='coerce')
+
+
+def raw_dates():
+    # Raw CRSP dates: the last trading day of each month, repeated over many rows, and a few invalid values
+    trading_days = pd.bdate_range('1925-12-31', '1940-12-31')
+    last_days = trading_days.to_series().groupby(trading_days.to_period('M')).max()
+    distinct = list(pd.DatetimeIndex(last_days.values).strftime('%Y/%m/%d').values) + ['', 'C', '1999/02/30']
+    return pd.Series(np.random.RandomState(0).choice(distinct, size=5000), dtype=str)
+
+
+def test_parse_month_ends_matches_to_datetime():
+    raw = raw_dates()
+    expected = month_ends_reference(raw)
+    result = parse_month_ends(raw.values)
+
+    assert expected.isnull().any()
+    np.testing.assert_array_equal(expected.values, np.asarray(result.values, dtype=expected.values.dtype))
+
+
+def test_parse_dates_matches_to_datetime():
+    raw = raw_dates()
+    expected = dates_reference(raw)
+    result = parse_dates(raw.values)
+
+    np.testing.assert_array_equal(expected.values, np.asarray(result.values, dtype=expected.values.dtype))
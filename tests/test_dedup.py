@@ -0,0 +1,31 @@
+import pandas as pd
+from synthetic import make_compustat_panel
+from dedup import select_least_missing
+
+
+def select_least_missing_reference(dataframe):
+    # The per-group deduplication that write_compustat.py used to run through parallel_apply
+    dataframe = dataframe.copy()
+    dataframe['Missing Count'] = dataframe.isnull().sum(axis=1)
+    dataframe.sort_values(by=['Missing Count'], ascending=True, inplace=True, kind='stable')
+    return dataframe.iloc[0, :]
+
+
+def test_select_least_missing_matches_group_loop():
+    compustat = make_compustat_panel(num_firms=40, num_years=5, duplicate_share=0.2)
+
+    expected = compustat.groupby(level=['Permco', 'datadate']).apply(select_least_missing_reference)
+    result = select_least_missing(compustat, ['Permco', 'datadate'])
+
+    # Without tie breakers, ties go to the first row like the original path
+    assert compustat.index.duplicated().any()
+    pd.testing.assert_frame_equal(expected.drop(columns=['Missing Count']).infer_objects(), result,
+                                  check_dtype=False, check_names=False)
+
+
+def test_select_least_missing_tie_breakers():
+    compustat = make_compustat_panel(num_firms=40, num_years=5, duplicate_share=0.2)
+    result = select_least_missing(compustat, ['Permco', 'datadate'], ['Report Date', 'Gvkey'], [False, True])
+
+    assert not result.index.duplicated().any()
+    assert result.shape[0] == compustat.index.unique().shape[0]
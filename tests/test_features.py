@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+from synthetic import make_merged_panel
+from features import build_features
+from features_crsp import CRSP_FEATURES, ROLLING_WINDOW
+
+
+def crsp_features_reference(crsp):
+    # The groupby features of features_crsp.py before features.py
+    def rolling_mean(series, window):
+        return series.groupby(level='Permco').rolling(window).mean().reset_index(level=0, drop=True)
+
+    ret = pd.DataFrame(index=crsp.index)
+    ret['Cumulative Return'] = crsp['Log Return'].groupby(['Permco'], group_keys=False).cumsum()
+    ret['Price Volume (3mma)'] = rolling_mean(crsp['Price Volume (Billions)'], ROLLING_WINDOW).reindex(crsp.index)
+    ret['Market Cap (3mma)'] = rolling_mean(crsp['Market Cap (Billions, CRSP)'], ROLLING_WINDOW).reindex(crsp.index)
+    return ret
+
+
+def test_build_features_match_groupby():
+    rng = np.random.RandomState(0)
+    crsp = make_merged_panel(num_firms=100, num_months=36, num_float_variables=0)
+    crsp = crsp.loc[rng.random_sample(crsp.shape[0]) > 0.05]
+    crsp['Log Return'] = np.log(1 + crsp['Return'])
+    crsp['Price Volume (Billions)'] = np.where(rng.random_sample(crsp.shape[0]) > 0.05,
+                                               rng.lognormal(-3, 2, crsp.shape[0]), np.nan)
+
+    pd.testing.assert_frame_equal(crsp_features_reference(crsp), build_features(crsp, CRSP_FEATURES), rtol=1e-9)
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.regression.linear_model as sm
+from pandas.tseries.offsets import MonthEnd
+from forecast_evaluation import expanding_forecasts, rolling_forecasts, oos_r2_by_split_date, evaluate_forecasts
+
+
+def forecast_from_extracted_factor(data):
+    # The refit loop of the Visualizing the replication notebook (without the Pool), for one date
+    yesterday = data[:-1]
+    today = data.tail(1)
+    reg = sm.OLS(yesterday['Next Month Return'], yesterday[['Factor', 'Intercept']]).fit()
+    return reg.predict(today[['Factor', 'Intercept']]).values[0]
+
+
+def rolling_forecast(dataframe, target_date, window, min_periods):
+    # pandas no longer has the 'M' Timedelta unit of the notebook, so pd.Timedelta(window, 'M') is written in days
+    valid_dates = dataframe.loc[(dataframe['datadate'] <= target_date) & (dataframe['datadate'] >= target_date - pd.Timedelta(days=30.436875 * window))]
+    if valid_dates.shape[0] < min_periods:
+        return np.nan
+    return forecast_from_extracted_factor(valid_dates)
+
+
+def expanding_forecast(dataframe, target_date, min_periods):
+    valid_dates = dataframe.loc[(dataframe['datadate'] <= target_date)]
+    if valid_dates.shape[0] < min_periods:
+        return np.nan
+    return forecast_from_extracted_factor(valid_dates)
+
+
+def oos_by_split_date(dataframe, split_date, min_periods):
+    before = dataframe.loc[dataframe['datadate'] < split_date, :]
+    after = dataframe.loc[dataframe['datadate'] >= split_date, :].copy()
+    if (before.shape[0] < min_periods) or (after.shape[0] < min_periods):
+        return np.nan
+    factor_coef = sm.OLS(before['Next Month Return'], before[['Intercept', 'Factor']]).fit()
+    mse_3prf = ((factor_coef.predict(after[['Intercept', 'Factor']]) - after['Next Month Return']) ** 2).mean()
+    mse_sample_mean = ((before['Next Month Return'].mean() - after['Next Month Return']) ** 2).mean()
+    return 1 - mse_3prf / mse_sample_mean
+
+
+@pytest.fixture
+def forecasts():
+    num_months = 120
+    rng = np.random.RandomState(0)
+    factor = rng.normal(0, 0.2, num_months)
+    return pd.DataFrame({'Factor': factor,
+                         'Next Month Return': 0.005 + 0.01 * factor + rng.normal(0, 0.05, num_months),
+                         'datadate': pd.date_range('1930-01-31', periods=num_months, freq=MonthEnd()),
+                         'Intercept': 1})
+
+
+def test_running_sums_match_statsmodels_refits(forecasts):
+    window, min_periods = 48, 24
+    dates = forecasts['datadate']
+
+    np.testing.assert_allclose(rolling_forecasts(forecasts, window, min_periods),
+                               [rolling_forecast(forecasts, t, window, min_periods) for t in dates],
+                               rtol=1e-8, atol=1e-12)
+    np.testing.assert_allclose(expanding_forecasts(forecasts, min_periods),
+                               [expanding_forecast(forecasts, t, min_periods) for t in dates],
+                               rtol=1e-8, atol=1e-12)
+    np.testing.assert_allclose(oos_r2_by_split_date(forecasts, min_periods=min_periods),
+                               [oos_by_split_date(forecasts, t, min_periods) for t in dates],
+                               rtol=1e-8, atol=1e-12)
+
+
+def test_evaluate_forecasts_matches_stored_notebook_output():
+    # Output/forecasts_3prf.h5 holds the columns computed by the Visualizing the replication notebook
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Output', 'forecasts_3prf.h5')
+    stored = pd.read_hdf(path).sort_values('datadate').reset_index(drop=True)
+    result = evaluate_forecasts(stored[['Factor', 'Next Month Return', 'datadate', 'Intercept']])
+
+    for variable in ['Rolling Forecast', 'Expanding Forecast', 'OOS R Squared (Rolling)', 'OOS R Squared (Expanding)']:
+        np.testing.assert_allclose(result[variable].values, stored[variable].values, rtol=1e-8, atol=1e-12)
+    np.testing.assert_allclose(result['OOS By Split Date'].values, stored['OOS By Split Date (2018 Sample)'].values,
+                               rtol=1e-8, atol=1e-12)
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+from synthetic import make_merged_panel
+from integrity import continuity_report, duplicate_report
+
+
+def check_unique_reference(dataframe, identifier_list):
+    # utils.check_unique before duplicate_report
+    unique_identifier = dataframe.groupby(by=identifier_list).count().iloc[:, 0]
+    unique_identifier.name = 'Count'
+    unique_identifier = unique_identifier[unique_identifier > 1]
+    return unique_identifier.to_frame()
+
+
+def test_continuity_report_counts_gaps():
+    crsp = make_merged_panel(num_firms=50, num_months=60, num_float_variables=0)
+    crsp = crsp.loc[np.random.RandomState(0).random_sample(crsp.shape[0]) > 0.05]
+    result = continuity_report(crsp)
+
+    months = pd.Series(crsp.index.get_level_values('datadate').to_period('M').asi8, index=crsp.index)
+    gaps = (months.groupby(level='Permco').diff() > 1).groupby(level='Permco').sum()
+    assert gaps.sum() > 0
+    assert (result['Gaps'] == gaps).all()
+
+
+def test_duplicate_report_matches_groupby_count():
+    crsp = make_merged_panel(num_firms=50, num_months=24, num_float_variables=0)
+    crsp = pd.concat([crsp, crsp.iloc[[3, 3, 70]]])
+    expected = check_unique_reference(crsp, ['Permco', 'datadate'])
+    result = duplicate_report(crsp, ['Permco', 'datadate'])
+
+    assert expected.shape[0] == 2
+    pd.testing.assert_frame_equal(expected, result.sort_index(), check_dtype=False)
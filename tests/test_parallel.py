@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+from synthetic import make_merged_panel
+from utils import parallel_apply
+
+
+def parallel_apply_reference(df, group_list, f, num_cores):
+    # The original utils.parallel_apply: each core receives a pickled groupby object
+    from multiprocess import Pool
+    group_numbers = df.groupby(by=group_list).ngroup()
+    group_cuts = group_numbers.quantile(np.linspace(0, 1, num=num_cores + 1), interpolation='nearest').values
+
+    cuts = []
+    for ind in range(num_cores - 1):
+        cuts.append(df.loc[(group_numbers >= group_cuts[ind]) & (group_numbers < group_cuts[ind + 1])].groupby(group_list))
+    cuts.append(df.loc[(group_numbers >= group_cuts[num_cores - 1]) & (group_numbers <= group_cuts[num_cores])].groupby(group_list))
+
+    with Pool(num_cores) as p:
+        parallel_results = p.map(lambda g: g.apply(f), cuts)
+    return pd.concat(parallel_results)
+
+
+def test_parallel_apply_matches_groupby_apply():
+    panel = make_merged_panel(num_firms=50, num_months=24, num_float_variables=2)
+    last_return = lambda d: d['Return'].values[-1]
+
+    expected = panel.groupby(level='Permco').apply(last_return)
+    result = parallel_apply(panel, ['Permco'], last_return, 2, None)
+
+    assert np.array_equal(np.ravel(expected.values), np.ravel(result.values))
+
+
+def test_parallel_apply_matches_pickled_groupby():
+    panel = make_merged_panel(num_firms=50, num_months=24, num_float_variables=2)
+    last_return = lambda d: d['Return'].values[-1]
+
+    expected = parallel_apply_reference(panel, ['Permco'], last_return, 2)
+    result = parallel_apply(panel, ['Permco'], last_return, 2, None)
+
+    assert np.array_equal(np.ravel(expected.values), np.ravel(result.values))
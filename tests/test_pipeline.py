@@ -0,0 +1,36 @@
+import os
+import re
+from synthetic import write_raw_files
+from storage import OUTPUT_DIR, artifact_path
+from pipeline import PIPELINE_DIR, STAGES, run_pipeline, publish, prune
+
+
+def versioned_entries(directory):
+    return sorted(e for e in os.listdir(directory) if re.match(r'^.+-[0-9a-f]{12}\.[a-z0-9]+$', e))
+
+
+def test_prune_keeps_only_the_current_artifacts(tmp_path, monkeypatch):
+    write_raw_files(str(tmp_path / 'Data'), num_firms=30, num_months=36)
+    os.makedirs(str(tmp_path / 'Code'))
+    monkeypatch.chdir(str(tmp_path / 'Code'))
+
+    first = run_pipeline(num_workers=1)
+    publish(first)
+    assert prune(first) == []
+
+    # New Compustat rows change the fingerprints of the Compustat branch and of the merge only
+    with open('../Data/compustat-merged.txt') as f:
+        lines = f.readlines()
+    with open('../Data/compustat-merged.txt', 'w') as f:
+        f.writelines(lines[:-5])
+    second = run_pipeline(num_workers=1)
+    publish(second)
+    changed = [s for s in STAGES if first[s] != second[s]]
+    assert sorted(changed) == ['features_compustat', 'merge_crsp_compustat', 'write_compustat']
+
+    deleted = prune(second)
+    assert len(deleted) == sum(len(STAGES[s]['outputs']) + 1 for s in changed)
+    assert versioned_entries(PIPELINE_DIR) == sorted(s + '-' + second[s] + '.json' for s in STAGES)
+    assert versioned_entries(OUTPUT_DIR) == sorted(os.path.basename(artifact_path(o + '-' + second[s]))
+                                                   for s in STAGES for o in STAGES[s]['outputs'])
+    assert os.path.exists(artifact_path('merged'))
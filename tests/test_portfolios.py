@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+from synthetic import make_merged_panel
+from utils import weighted_quantile
+from portfolios import add_sort_variables, double_sort, portfolio_returns
+
+
+def double_sort_reference(df, first, second, num_portfolios):
+    # One date at a time, with NYSE breakpoints as in the Sorting by Momentum notebook
+    def sort_date(x):
+        nyse = (x['Exchange Code'] == 1).values
+        ret = pd.DataFrame(index=x.index)
+        for v in [first, second]:
+            breaks = weighted_quantile(x.loc[nyse, v].values, np.arange(1, num_portfolios) / num_portfolios)
+            ret[v + ' Portfolio'] = np.searchsorted(breaks, x[v].values, side='left') + 1
+        return ret
+
+    portfolios = df.groupby(level='datadate', group_keys=False).apply(sort_date)
+    df = pd.concat([df, portfolios], axis=1)
+    keys = ['datadate', first + ' Portfolio', second + ' Portfolio']
+    weighted = (df['Return'] * df['Lagged Market Cap']).groupby([df.index.get_level_values('datadate'),
+                                                                 df[keys[1]], df[keys[2]]]).sum()
+    grouped = df.reset_index().groupby(keys)
+    return pd.DataFrame({'Equal Weighted Return': grouped['Return'].mean(),
+                         'Value Weighted Return': weighted.values / grouped['Lagged Market Cap'].sum().values,
+                         'Count': grouped.size()})
+
+
+def test_double_sort_matches_notebook():
+    variables = add_sort_variables(make_merged_panel(num_firms=300, num_months=36, num_float_variables=0))
+    sorted_variables = pd.concat([variables, double_sort(variables, 'Return Momentum', 'Lagged Market Cap', 3, 3,
+                                                         exchange_codes=[1])], axis=1)
+    result = portfolio_returns(sorted_variables, ['Return Momentum Portfolio', 'Lagged Market Cap Portfolio'])
+
+    complete = variables.dropna(subset=['Return Momentum', 'Lagged Market Cap'])
+    expected = double_sort_reference(complete, 'Return Momentum', 'Lagged Market Cap', 3)
+
+    assert (result['Count'].values == expected['Count'].values).all()
+    np.testing.assert_allclose(result.drop(columns='Count').values, expected.drop(columns='Count').values)
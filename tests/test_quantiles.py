@@ -0,0 +1,23 @@
+import numpy as np
+import pandas as pd
+from synthetic import make_merged_panel
+from utils import weighted_quantile
+from quantiles import breakpoints
+
+
+def breakpoints_reference(df, variable, quantiles):
+    # As in the Percentiles by Size notebook: market cap weighted NYSE quantiles, one date at a time
+    nyse = df.loc[df['Exchange Code'] == 1, variable]
+    return nyse.groupby(level='datadate').apply(
+        lambda x: pd.Series(weighted_quantile(x.values, quantiles, x.values), index=quantiles)).unstack()
+
+
+def test_breakpoints_match_weighted_quantile():
+    quantiles = [0.05, 0.10, 0.25, 0.5, 0.75, 0.90, 0.95, 0.99, 1]
+    merged = make_merged_panel(num_firms=200, num_months=24, num_float_variables=0)
+    size = 'Market Cap (Billions, CRSP)'
+
+    expected = breakpoints_reference(merged, size, quantiles)
+    result = breakpoints(merged, size, quantiles, size, exchange_codes=[1])
+
+    np.testing.assert_allclose(expected.values, result.values)
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+from synthetic import make_merged_panel
+from storage import write_frame, read_frame
+from security_master import build_security_master, write_security_master, load_security_master, lookup_ticker, \
+    firm_frame, read_firm
+
+
+def find_permcos_reference(dataframe, ticker):
+    # find_permcos of the Data Explorer notebook
+    right_ticker = dataframe.loc[dataframe['Ticker'] == ticker]
+    right_ticker = right_ticker.safe_index(['Permco'])
+    possible = right_ticker.groupby(by=['Permco']).last()
+    return possible.sort_values(['datadate'], ascending=False)
+
+
+def merged_panel(num_firms=100):
+    merged = make_merged_panel(num_firms=num_firms, num_months=24, num_float_variables=2)
+    merged['Gvkey'] = pd.array(merged.index.get_level_values('Permco') + 1000, dtype='Int32')
+    return merged
+
+
+def test_lookup_ticker_matches_find_permcos():
+    merged = merged_panel()
+    master = build_security_master(merged)
+    for ticker in ['T' + str(p) for p in np.random.RandomState(0).randint(0, 100, size=10)]:
+        expected = merged.xs(find_permcos_reference(merged, ticker).index[0], level='Permco', drop_level=False)
+        pd.testing.assert_frame_equal(expected, firm_frame(merged, master, lookup_ticker(master, ticker)))
+
+
+def test_read_firm_matches_read_frame(tmp_path):
+    merged = merged_panel()
+    write_frame(merged, 'merged', fmt='parquet', output_dir=str(tmp_path))
+    write_security_master(build_security_master(merged), fmt='parquet', output_dir=str(tmp_path))
+    master = load_security_master(fmt='parquet', output_dir=str(tmp_path))
+    permco = lookup_ticker(master, 'T7')
+
+    expected = read_frame('merged', fmt='parquet', output_dir=str(tmp_path)).xs(permco, level='Permco',
+                                                                                drop_level=False)
+    pd.testing.assert_frame_equal(expected, read_firm(master, permco, fmt='parquet', output_dir=str(tmp_path)),
+                                  check_dtype=False)
@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pandas as pd
+from synthetic import write_raw_files
+import sharding
+
+
+def test_sharded_build_matches_single_process(tmp_path, monkeypatch):
+    write_raw_files(str(tmp_path / 'Data'), num_firms=60, num_months=48)
+    os.makedirs(str(tmp_path / 'Code'))
+    monkeypatch.chdir(str(tmp_path / 'Code'))
+
+    sharding.build(num_shards=3, num_workers=1)
+    sharding.verify()
+
+
+def test_shard_of_spreads_permcos_with_a_common_stride():
+    # A hash that keeps the residue of the Permco modulo a power of two would put all of them in one shard
+    for num_shards in [2, 4, 8, 3]:
+        counts = np.bincount(sharding.shard_of(np.arange(0, 4000 * num_shards, num_shards), num_shards),
+                             minlength=num_shards)
+        assert counts.min() > 0.8 * 4000 / num_shards
+
+
+def test_split_raw_file_parses_quoted_fields(tmp_path):
+    raw = str(tmp_path / 'raw.txt')
+    with open(raw, 'w', newline='') as f:
+        f.write('COMNAM\tPERMCO\tPRC\n'
+                '"A\tB CORP"\t7\t1.5\n'
+                '"C\nD INC"\t8\t2.5\n'
+                'E CO\t9\t\n')
+    paths = sharding.split_raw_file(raw, 'PERMCO', 4, str(tmp_path / 'shards'))
+
+    rows = pd.concat([pd.read_csv(p, sep='\t') for p in paths])
+    assert sorted(rows['PERMCO']) == [7, 8, 9]
+    for permco, shard in zip([7, 8, 9], sharding.shard_of([7, 8, 9], 4)):
+        assert permco in pd.read_csv(paths[shard], sep='\t')['PERMCO'].values
+    expected = pd.read_csv(raw, sep='\t')
+    # Empty shards give object columns
+    pd.testing.assert_frame_equal(expected, rows.sort_values('PERMCO').reset_index(drop=True), check_dtype=False)
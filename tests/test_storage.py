@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+from synthetic import make_merged_panel
+from storage import write_frame, read_frame, append_frame
+
+COLUMNS = ['Market Cap (Billions, CRSP)', 'Exchange Code', 'Cumulative Return']
+
+
+def read_hdf_subset(path, key, columns):
+    # How the notebooks loaded a few columns before storage.py: read all of the HDF5 file, then subset
+    return pd.read_hdf(path, key)[columns]
+
+
+@pytest.fixture
+def merged():
+    return make_merged_panel(num_firms=50, num_months=36, num_float_variables=2)
+
+
+def test_parquet_subsets_match_hdf(merged, tmp_path):
+    hdf_path = write_frame(merged, 'merged', fmt='hdf', output_dir=str(tmp_path))
+    write_frame(merged, 'merged', fmt='parquet', output_dir=str(tmp_path))
+
+    expected = read_hdf_subset(hdf_path, 'merged', COLUMNS).sort_index()
+    pd.testing.assert_frame_equal(expected, read_frame('merged', COLUMNS, fmt='parquet', output_dir=str(tmp_path)),
+                                  check_dtype=False, check_index_type=False)
+    recent = read_frame('merged', COLUMNS, start='1971-06-30', fmt='parquet', output_dir=str(tmp_path))
+    pd.testing.assert_frame_equal(expected.loc[expected.index.get_level_values('datadate') >= '1971-06-30'], recent,
+                                  check_dtype=False, check_index_type=False)
+
+
+@pytest.mark.parametrize('fmt', ['parquet', 'hdf'])
+def test_append_frame(merged, tmp_path, fmt):
+    dates = merged.index.get_level_values('datadate')
+    permcos = merged.index.get_level_values('Permco')
+    last = dates.max()
+
+    # The last month is held back, and so are the last two months of a late firm
+    late = (permcos == permcos[0]) & (dates >= dates.unique()[-2])
+    write_frame(merged.loc[(dates < last) & ~late], 'merged', fmt=fmt, output_dir=str(tmp_path))
+    append_frame(merged.loc[dates == last], 'merged', fmt=fmt, output_dir=str(tmp_path))
+    appended = read_frame('merged', fmt=fmt, output_dir=str(tmp_path))
+    assert appended.shape[0] == merged.shape[0] - late.sum() + (late & (dates == last)).sum()
+
+    # Replacing rows keeps the later months of the other firms
+    append_frame(merged.loc[late], 'merged', fmt=fmt, output_dir=str(tmp_path), replace_rows=True)
+    pd.testing.assert_frame_equal(merged.sort_index(), read_frame('merged', fmt=fmt, output_dir=str(tmp_path)),
+                                  check_dtype=False, check_index_type=False)
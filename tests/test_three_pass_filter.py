@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+import pytest
+from pandas.tseries.offsets import MonthEnd
+from synthetic import make_merged_panel
+from three_pass_filter import pma_panel, three_pass_forecasts, forecast_dates
+
+sm = pytest.importorskip('statsmodels.regression.linear_model')
+
+
+def notebook_forecast(returns_only, forecast_date, estimation_window=5, company_per_date=100):
+    # calculate_forecast_on_date of the Replicating 3PRF notebook. pandas no longer has the 'Y' and 'M'
+    # Timedelta units, so they are written in days. The regressions on past factors are left out: they
+    # do not change the result
+    MIN_NON_MISSING = 0.7
+
+    def calc_ts_regression(one_company):
+        valuation_on_returns = sm.OLS(one_company['Price Diff to Moving Average'], one_company[['Intercept', 'Next Month Return']]).fit()
+        return valuation_on_returns.params['Next Month Return']
+
+    def calc_cross_sectional_regression(one_date):
+        valuations_on_loadings = sm.OLS(one_date['Price Diff to Moving Average'], one_date[['Intercept', 'TS Loading']]).fit()
+        return valuations_on_loadings.params['TS Loading']
+
+    target_datetime = pd.to_datetime(forecast_date, format='%Y-%m-%d')
+    first_datetime = target_datetime - pd.Timedelta(days=365.2425 * estimation_window)
+    dates = returns_only.index.get_level_values('datadate')
+    forecast_sample = returns_only.loc[(dates <= target_datetime) & (dates > first_datetime)]
+
+    firms_in_sample = forecast_sample[['Market Cap (Billions, CRSP)']].groupby(['Permco']).last()
+    firms_in_sample = firms_in_sample.nlargest(columns=['Market Cap (Billions, CRSP)'], n=company_per_date)
+    large_firms_for_forecast = forecast_sample.join(firms_in_sample['Market Cap (Billions, CRSP)'], rsuffix='.sort', how='inner')
+
+    cos_with_missing = large_firms_for_forecast['Price Diff to Moving Average'].groupby(['Permco']).apply(lambda s: s.isna().mean())
+    valid_cos = cos_with_missing[cos_with_missing > MIN_NON_MISSING]
+    valid_cos.name = 'Number Missing'
+    large_firms_for_forecast = large_firms_for_forecast.join(valid_cos)
+
+    yesterday = large_firms_for_forecast.loc[large_firms_for_forecast.index.get_level_values('datadate') < target_datetime - pd.Timedelta(days=30.436875) - MonthEnd(1), :]
+    ts_loadings = yesterday.groupby(['Permco']).apply(calc_ts_regression)
+    ts_loadings.name = 'TS Loading'
+
+    today = large_firms_for_forecast.loc[large_firms_for_forecast.index.get_level_values('datadate') == target_datetime, :]
+    today = today.join(ts_loadings)
+    today = today.loc[~today['TS Loading'].isnull(), :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        red_form_correl = np.corrcoef(today['TS Loading'], today['Price Diff to Moving Average'])[0, 1]
+    return calc_cross_sectional_regression(today), red_form_correl
+
+
+@pytest.fixture(scope='module')
+def panel():
+    rng = np.random.RandomState(0)
+    crsp = make_merged_panel(num_firms=40, num_months=120, num_float_variables=0, seed=0)
+    # Firms list at different times, miss some months and some market caps
+    listing = rng.randint(0, 70, size=40)
+    months = crsp.groupby(level='Permco').cumcount().values
+    crsp = crsp.loc[(months >= np.repeat(listing, 120)) & (rng.random_sample(crsp.shape[0]) > 0.1)]
+    crsp.loc[rng.random_sample(crsp.shape[0]) < 0.05, 'Market Cap (Billions, CRSP)'] = np.nan
+
+    dates = crsp.index.get_level_values('datadate').unique().sort_values()
+    returns = rng.normal(0.01, 0.05, len(dates))
+    sp500 = pd.DataFrame({'S&P 500 Return': returns, 'Next Month Return': np.r_[returns[1:], np.nan]},
+                         index=pd.Index(dates, name='datadate')).dropna()
+    ret = pma_panel(crsp, sp500)
+    ret['Intercept'] = 1
+    return ret
+
+
+# Firms with a single month before the forecast date get the pseudo-inverse solution
+@pytest.mark.filterwarnings('ignore:The design matrix is rank-deficient')
+def test_three_pass_forecasts_match_notebook(panel):
+    targets = forecast_dates(panel)[-30:]
+    forecasts = three_pass_forecasts(panel, targets, company_per_date=15)
+    assert forecasts['Factor'].notnull().all()
+    expected = [notebook_forecast(panel, t, company_per_date=15) for t in targets]
+
+    np.testing.assert_allclose(forecasts['Factor'].values, [e[0] for e in expected], rtol=1e-8)
+    np.testing.assert_allclose(forecasts['sorting_loading_correl'].values, [e[1] for e in expected], rtol=1e-8)
+
+
+def test_three_pass_forecasts_optional_rules(panel):
+    targets = forecast_dates(panel)[-30:]
+    default = three_pass_forecasts(panel, targets, company_per_date=15)
+    months = three_pass_forecasts(panel, targets, company_per_date=15, window_in_months=True)
+    coverage = three_pass_forecasts(panel, targets, company_per_date=15, min_non_missing=0.99)
+
+    assert not np.allclose(default['Factor'].values, months['Factor'].values, equal_nan=True)
+    # Few firms are observed in every month, so most dates are left without a factor
+    assert coverage['Factor'].isnull().sum() > default['Factor'].isnull().sum()
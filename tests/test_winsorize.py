@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+from synthetic import make_merged_panel
+from utils import winsorize_at_explicit_input
+from winsorize import cross_sectional_transform
+
+
+def winsorize_standardize_reference(df, variables, lower, upper, exchange_codes):
+    # One date and one variable at a time, with NYSE percentile bounds
+    ret = []
+    for date, x in df.groupby(level='datadate'):
+        nyse = x['Exchange Code'].isin(exchange_codes).values
+        columns = {}
+        for variable in variables:
+            bounds = x.loc[nyse, variable].quantile([lower, upper]).values
+            winsorized = winsorize_at_explicit_input(x[variable].values, bounds[0], bounds[1])
+            columns[variable] = (winsorized - np.nanmean(winsorized)) / np.nanstd(winsorized, ddof=1)
+        ret.append(pd.DataFrame(columns, index=x.index))
+    return pd.concat(ret).reindex(df.index)
+
+
+def test_cross_sectional_transform_matches_loop():
+    merged = make_merged_panel(num_firms=200, num_months=24, num_float_variables=4)
+    variables = ['Variable ' + str(ind) for ind in range(4)]
+    rng = np.random.RandomState(0)
+    for variable in variables:
+        merged.loc[rng.random_sample(merged.shape[0]) < 0.05, variable] = np.nan
+    inputs = merged[variables].copy()
+
+    result = cross_sectional_transform(merged, variables, 0.01, 0.99, z_scores=True, exchange_codes=[1])
+
+    pd.testing.assert_frame_equal(inputs, merged[variables])
+    pd.testing.assert_frame_equal(winsorize_standardize_reference(merged, variables, 0.01, 0.99, [1]), result)
+
+
+def test_cross_sectional_transform_leaves_rows_without_a_group_missing():
+    merged = make_merged_panel(num_firms=50, num_months=6, num_float_variables=2)
+    variables = ['Variable 0', 'Variable 1']
+    merged['Group'] = merged.index.get_level_values('datadate').month.astype(float)
+    merged.loc[np.random.RandomState(0).random_sample(merged.shape[0]) < 0.1, 'Group'] = np.nan
+    grouped = merged['Group'].notnull()
+
+    result = cross_sectional_transform(merged, variables, 0.05, 0.95, z_scores=True, group='Group',
+                                       exchange_codes=[1])
+
+    assert result.loc[~grouped].isnull().all().all()
+    expected = cross_sectional_transform(merged.loc[grouped], variables, 0.05, 0.95, z_scores=True, group='Group',
+                                         exchange_codes=[1])
+    pd.testing.assert_frame_equal(expected, result.loc[grouped])
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+from synthetic import make_compustat_panel, COMPUSTAT_YTD_VARIABLES
+from ytd import decumulate_ytd
+
+
+def take_diffs_reference(x):
+    # The per-group conversion that write_compustat.py used to run through groupby().transform
+    if all(np.isnan(x)):
+        return x
+    x = x.fillna(0)
+    ret = x.diff()
+    ret.iloc[0] = x.iloc[0]
+    return ret
+
+
+def ytd_reference(df, variables):
+    df = df.safe_index(['Permco', 'datadate', 'Fiscal Year'])
+    return df[variables].groupby(['Permco', 'Fiscal Year']).transform(take_diffs_reference)
+
+
+def test_decumulate_ytd_matches_take_diffs():
+    compustat = make_compustat_panel(num_firms=40, num_years=5, duplicate_share=0).sort_index()
+
+    expected = ytd_reference(compustat, COMPUSTAT_YTD_VARIABLES)
+    result = decumulate_ytd(compustat, COMPUSTAT_YTD_VARIABLES)
+
+    # Every quarter is reported, so matching on Fiscal Quarter agrees with the row-by-row diff
+    np.testing.assert_allclose(expected.values, result.values, equal_nan=True)
+
+
+def test_decumulate_ytd_missing_quarter():
+    df = pd.DataFrame({'Permco': 1, 'Fiscal Year': 2000, 'Fiscal Quarter': [1, 2, 4], 'Capex': [1., 3., 10.],
+                       'M&A': np.nan})
+    result = decumulate_ytd(df, ['Capex', 'M&A'])
+
+    np.testing.assert_allclose(result['Capex'].values, [1, 2, np.nan], equal_nan=True)
+    assert result['M&A'].isnull().all()
+    assert (decumulate_ytd(df, ['M&A'], keep_all_nan=False)['M&A'].values[:2] == 0).all()